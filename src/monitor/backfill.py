@@ -0,0 +1,160 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Historical replication checks over a range of pushes.
+
+The pushlog is read in fixed-size ranges of pushes and every changeset in each
+range is checked against the mirror by a bounded pool of threads.  Results come
+out in push order, one record per changeset and one for each push without
+changesets, so they can be streamed to a file and an interrupted run can pick up
+where it left off.
+"""
+import csv
+import json
+import logging
+from typing import IO, Iterator, NamedTuple, Optional
+
+from monitor import pushlog
+from monitor.config import Mirror
+from monitor.main import commit_in_mirror
+from monitor.util import iter_concurrently, requests_retry_session
+
+log = logging.getLogger(__name__)
+
+FORMATS = ("csv", "jsonl")
+
+# The number of pushes requested from the pushlog at a time.
+DEFAULT_CHUNK_SIZE = 100
+
+# The number of mirror checks that may be in flight at once.
+DEFAULT_CONCURRENCY = 8
+
+
+class BackfillRecord(NamedTuple):
+    """The replication state of one changeset at the time of the backfill.
+
+    Args:
+        pushid: The pushlog pushid the changeset belongs to.
+        node: The changeset ID, or None for a push without changesets.
+        pushdate: The UTC Unix time of the push.
+        mirrored: True if the changeset is present in the mirror.  Always True for
+            a push without changesets, since there is nothing to replicate.
+    """
+
+    pushid: int
+    node: Optional[str]
+    pushdate: int
+    mirrored: bool
+
+
+def check_pushes(
+    mirror: Mirror,
+    start_id: int,
+    end_id: int,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> Iterator[BackfillRecord]:
+    """Check every changeset in a range of pushes for presence in a mirror.
+
+    Only one chunk of pushes and a small window of in-flight checks are held in
+    memory at a time, whatever the size of the range.
+
+    Args:
+        mirror: The mirror to check.
+        start_id: The first pushid to check.
+        end_id: The last pushid to check.
+        chunk_size: The number of pushes to read from the pushlog at a time.
+        concurrency: The number of mirror checks to run at once.
+
+    Yields:
+        A BackfillRecord for each changeset, in push order, and one with no node
+        for each push without changesets.
+    """
+    source = pushlog.source_for_mirror(mirror)
+    session = requests_retry_session(pool_maxsize=concurrency)
+
+    def check(job):
+        push, node = job
+        if node is None:
+            return True
+        return commit_in_mirror(mirror, node, session=session)
+
+    for chunk_start in range(start_id, end_id + 1, chunk_size):
+        chunk_end = min(chunk_start + chunk_size - 1, end_id)
+        log.info(f"checking pushes {chunk_start} to {chunk_end}")
+        # The pushlog range is exclusive of startID.
+        pushes = list(source.pushes(chunk_start - 1, chunk_end, session=session))
+        jobs = ((push, node) for push in pushes for node in (push.changesets or [None]))
+        for (push, node), result in iter_concurrently(check, jobs, concurrency):
+            yield BackfillRecord(push.pushid, node, push.date, result.result())
+
+
+class RecordWriter:
+    """Writes BackfillRecords to a text stream as CSV or JSON lines.
+
+    Args:
+        stream: A text stream open for writing.
+        fmt: One of FORMATS.
+        header: Write a CSV header line before the first record.
+    """
+
+    def __init__(self, stream: IO[str], fmt: str, header: bool = True):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown output format {fmt!r}")
+        self.stream = stream
+        self.fmt = fmt
+        self._csv = csv.writer(stream, lineterminator="\n")
+        if fmt == "csv" and header:
+            self._csv.writerow(BackfillRecord._fields)
+
+    def write(self, record: BackfillRecord):
+        if self.fmt == "csv":
+            self._csv.writerow(record)
+        else:
+            self.stream.write(json.dumps(record._asdict()) + "\n")
+
+
+def truncate_partial_push(path: str, fmt: str) -> Optional[int]:
+    """Prepare an interrupted backfill output file to be resumed.
+
+    The rows of the last push in the file may be incomplete, so they are removed
+    along with any partially written line.  The file is read one line at a time.
+
+    Args:
+        path: The output file of an earlier backfill run.
+        fmt: The file's format, one of FORMATS.
+
+    Returns:
+        The pushid of the removed push, which is where the backfill should resume,
+        or None if the file holds no records.
+    """
+    offset = 0
+    run_start = 0
+    last_pushid = None
+
+    with open(path, "rb+") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            pushid = _pushid_from_line(line, fmt)
+            if pushid is None:
+                # A header line.
+                run_start = offset + len(line)
+            elif pushid != last_pushid:
+                run_start = offset
+                last_pushid = pushid
+            offset += len(line)
+        f.truncate(run_start if last_pushid is not None else offset)
+
+    return last_pushid
+
+
+def _pushid_from_line(line: bytes, fmt: str) -> Optional[int]:
+    text = line.decode("utf-8")
+    try:
+        if fmt == "csv":
+            return int(text.split(",", 1)[0])
+        return int(json.loads(text)["pushid"])
+    except (ValueError, KeyError):
+        return None
@@ -0,0 +1,122 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Concurrent replication checks for large lists of changesets.
+"""
+import logging
+import time
+from typing import IO, Iterable, Iterator, NamedTuple, Optional
+
+from monitor.config import Mirror
+from monitor.main import ReplicationStatus, determine_commit_replication_status
+from monitor.util import iter_concurrently, requests_retry_session
+
+log = logging.getLogger(__name__)
+
+# The number of changesets that may be checked at once.
+DEFAULT_CONCURRENCY = 16
+
+
+class NodeResult(NamedTuple):
+    """The outcome of checking one changeset.
+
+    Args:
+        node: The changeset ID that was checked.
+        status: The changeset's ReplicationStatus, or None if the check failed.
+        error: A description of the failure, or None if the check succeeded.
+    """
+
+    node: str
+    status: Optional[ReplicationStatus]
+    error: Optional[str] = None
+
+
+class BatchSummary:
+    """Running totals for a batch of changeset checks."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.checked = 0
+        self.stale = 0
+        self.errors = 0
+        self.duplicates = 0
+
+    def add(self, result: NodeResult):
+        self.checked += 1
+        if result.error is not None:
+            self.errors += 1
+        elif result.status.is_stale:
+            self.stale += 1
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def __str__(self):
+        rate = self.checked / self.elapsed if self.elapsed > 0 else 0.0
+        return (
+            f"checked {self.checked} changesets "
+            f"({self.stale} stale, {self.errors} errors, "
+            f"{self.duplicates} duplicates skipped) "
+            f"in {self.elapsed:.1f}s, {rate:.1f} changesets/s"
+        )
+
+
+def read_node_ids(stream: IO[str]) -> Iterator[str]:
+    """Yield changeset IDs from a text stream, one or more per line.
+
+    Blank lines and lines starting with '#' are skipped.
+    """
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        yield from line.split()
+
+
+def check_nodes(
+    mirror: Mirror,
+    node_ids: Iterable[str],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    summary: BatchSummary = None,
+) -> Iterator[NodeResult]:
+    """Check the replication status of many changesets at once.
+
+    Node IDs are read lazily, so they can be streamed from a pipe.  Repeated IDs are
+    only checked once.  All checks share one HTTP session.
+
+    Args:
+        mirror: The mirror to check.
+        node_ids: The changeset IDs to check.
+        concurrency: The number of checks to run at once.
+        summary: Optional BatchSummary to update as results come in.
+
+    Yields:
+        A NodeResult for each unique changeset, in the order the checks finish.
+    """
+    session = requests_retry_session(pool_maxsize=concurrency)
+    summary = summary or BatchSummary()
+    seen = set()
+
+    def unique_nodes():
+        for node in node_ids:
+            if node in seen:
+                summary.duplicates += 1
+                continue
+            seen.add(node)
+            yield node
+
+    def check(node):
+        return determine_commit_replication_status(mirror, node, session)
+
+    for node, future in iter_concurrently(
+        check, unique_nodes(), concurrency, ordered=False
+    ):
+        try:
+            result = NodeResult(node, future.result())
+        except Exception as e:
+            log.debug(f"check failed for changeset {node}", exc_info=True)
+            result = NodeResult(node, None, f"{type(e).__name__}: {e}")
+        summary.add(result)
+        yield result
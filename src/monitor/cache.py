@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+A size-bounded on-disk cache for HTTP response bodies.
+
+Entries are stored under the SHA-256 digest of their URL, one body file and one
+small JSON metadata file per entry.  Bodies can be read back whole or in chunks.
+When the cache grows past its size limit the least recently used entries are
+deleted, along with temporary files left behind by writers that crashed.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from monitor import metrics
+
+log = logging.getLogger(__name__)
+
+# When evicting, delete entries until the cache is this fraction of its limit.
+EVICTION_TARGET = 0.9
+
+# Bytes read at a time by DiskCache.iter_chunks().
+CHUNK_SIZE = 64 * 1024
+
+# A CacheWriter's temporary file this old belongs to a writer that crashed.
+STALE_TEMP_SECONDS = 60 * 60
+
+cache_requests = metrics.counter(
+    "monitor_cache_requests_total", "Response cache lookups, by cache and result."
+)
+cache_bytes = metrics.gauge(
+    "monitor_cache_size_bytes", "Bytes stored in the response cache, by cache."
+)
+
+
+class CacheEntry(NamedTuple):
+    """A cached response body and its metadata.
+
+    Args:
+        path: The file holding the body.
+        size: The size of the body in bytes.
+        metadata: Free-form metadata stored with the body, such as HTTP validators.
+    """
+
+    path: Path
+    size: int
+    metadata: Dict
+
+
+class DiskCache:
+    """A content-addressed, size-bounded cache of response bodies.
+
+    Args:
+        directory: The directory to keep entries in.  Created if missing.
+        max_bytes: Evict entries when the bodies take up more than this.
+        name: A label for this cache's metrics.
+    """
+
+    def __init__(self, directory, max_bytes: int, name="hgmo"):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.name = name
+        self._lock = threading.Lock()
+        self._remove_stale_temp_files()
+        self._size = sum(path.stat().st_size for path in self._body_files())
+        cache_bytes.labels(cache=name).set(self._size)
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        """Return the entry for a URL, or None if it is not cached."""
+        path = self._path(url)
+        try:
+            metadata = json.loads(path.with_suffix(".json").read_text())
+            size = path.stat().st_size
+            # Record the access time for least-recently-used eviction.
+            os.utime(str(path))
+        except (OSError, ValueError):
+            cache_requests.labels(cache=self.name, result="miss").inc()
+            return None
+        cache_requests.labels(cache=self.name, result="hit").inc()
+        return CacheEntry(path, size, metadata)
+
+    def read(self, entry: CacheEntry) -> bytes:
+        """Return an entry's body."""
+        return entry.path.read_bytes()
+
+    def iter_chunks(self, entry: CacheEntry, chunk_size=CHUNK_SIZE) -> Iterator[bytes]:
+        """Yield an entry's body in pieces without loading all of it."""
+        with open(str(entry.path), "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def put(self, url: str, body: bytes, metadata: Dict = None):
+        """Store a response body for a URL."""
+        with self.writer(url, metadata) as writer:
+            writer.write(body)
+            writer.commit()
+
+    def writer(self, url: str, metadata: Dict = None) -> "CacheWriter":
+        """Return a CacheWriter for storing a body that arrives in pieces."""
+        return CacheWriter(self, url, metadata or {})
+
+    def _commit(self, url: str, temp_path: Path, metadata: Dict):
+        path = self._path(url)
+        path.parent.mkdir(exist_ok=True)
+        size = temp_path.stat().st_size
+        with self._lock:
+            try:
+                self._size -= path.stat().st_size
+            except OSError:
+                pass
+            os.replace(str(temp_path), str(path))
+            path.with_suffix(".json").write_text(json.dumps(metadata))
+            self._size += size
+            over_limit = self._size > self.max_bytes
+            cache_bytes.labels(cache=self.name).set(self._size)
+        cache_requests.labels(cache=self.name, result="store").inc()
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache is under its limit."""
+        with self._lock:
+            target = self.max_bytes * EVICTION_TARGET
+            if self._size <= target:
+                return
+            entries = []
+            for path in self._body_files():
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            for _, size, path in entries:
+                if self._size <= target:
+                    break
+                for victim in (path, path.with_suffix(".json")):
+                    try:
+                        victim.unlink()
+                    except OSError:
+                        pass
+                self._size -= size
+                cache_requests.labels(cache=self.name, result="evict").inc()
+            log.debug(f"evicted cache entries down to {self._size} bytes")
+            cache_bytes.labels(cache=self.name).set(self._size)
+        self._remove_stale_temp_files()
+
+    def _remove_stale_temp_files(self):
+        # Other processes may share the directory, so only remove old files.
+        cutoff = time.time() - STALE_TEMP_SECONDS
+        for path in self.directory.glob("*.tmp"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    log.info(f"removed stale cache temporary file {path}")
+            except OSError:
+                pass
+
+    def _path(self, url: str) -> Path:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / (digest[2:] + ".body")
+
+    def _body_files(self):
+        return self.directory.glob("*/*.body")
+
+
+class CacheWriter:
+    """Collects a response body in a temporary file until it is committed.
+
+    Nothing is added to the cache unless commit() is called, so partial downloads
+    are never stored.  Use it as a context manager to discard the temporary file if
+    the block ends without a commit.
+    """
+
+    def __init__(self, cache: DiskCache, url: str, metadata: Dict):
+        self.cache = cache
+        self.url = url
+        self.metadata = metadata
+        fd, name = tempfile.mkstemp(dir=str(cache.directory), suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+        self._path = Path(name)
+        self._finished = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self._finished:
+            self.discard()
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+
+    def commit(self):
+        self._file.close()
+        self.cache._commit(self.url, self._path, self.metadata)
+        self._finished = True
+
+    def discard(self):
+        self._file.close()
+        try:
+            self._path.unlink()
+        except OSError:
+            pass
+        self._finished = True
@@ -0,0 +1,239 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Record and replay the monitor's external traffic.
+
+A cassette is a gzipped JSON-lines file.  The first line is a header naming the
+mirror that was monitored.  Every following line is an event: a Pulse message
+body seen by monitor.pulse.process_push_message(), or an HTTP response received
+through monitor.util.InstrumentedHTTPAdapter together with its latency.  Events
+carry their offset in seconds from the start of the recording.
+
+While a Recorder is installed every message and response is appended to the
+cassette.  While a Player is installed HTTP requests are answered from the
+cassette instead of the network, so the whole pipeline can be driven from
+recorded traffic.
+"""
+import base64
+import gzip
+import io
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, Iterator
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from monitor.config import Mirror
+
+log = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+SPEEDS = ("recorded", "fast")
+
+# Response headers that describe the body as it was sent over the wire.  Bodies
+# are stored decoded, so these would be wrong on replay.
+_TRANSPORT_HEADERS = ("Content-Encoding", "Content-Length", "Transfer-Encoding")
+
+_current = None
+
+
+class Error(Exception):
+    pass
+
+
+class InvalidCassette(Error):
+    """Raised when a file is not a cassette this version can read."""
+
+    pass
+
+
+class NoRecordedResponse(Error):
+    """Raised when a replayed request has no response in the cassette."""
+
+    pass
+
+
+class Recorder:
+    """Appends Pulse messages and HTTP responses to a new cassette.
+
+    Args:
+        path: The cassette file to write.  An existing file is replaced.
+        mirror: The mirror being monitored.
+    """
+
+    def __init__(self, path, mirror: Mirror):
+        self.path = path
+        self._file = gzip.open(str(path), "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._write(
+            {"type": "header", "version": FORMAT_VERSION, "mirror": mirror._asdict()}
+        )
+
+    def record_message(self, body: Dict):
+        self._write({"type": "message", "t": self._offset(), "body": body})
+
+    def send(self, send, request, **kwargs):
+        """Send a request through `send` and record the response.
+
+        The response body is read in full so it can be stored.
+        """
+        start = time.perf_counter()
+        response = send(request, **kwargs)
+        content = response.content
+        latency = time.perf_counter() - start
+        headers = {
+            k: v for k, v in response.headers.items() if k not in _TRANSPORT_HEADERS
+        }
+        event = {
+            "type": "http",
+            "t": self._offset(),
+            "method": request.method,
+            "url": request.url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": headers,
+            "latency": latency,
+        }
+        try:
+            event["body"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            event["body_base64"] = base64.b64encode(content).decode("ascii")
+        self._write(event)
+        return response
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _offset(self) -> float:
+        return time.monotonic() - self._started
+
+    def _write(self, event: Dict):
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+            # Keep everything up to here readable if the process is killed.
+            self._file.flush()
+
+
+class Player:
+    """Answers HTTP requests from a cassette and yields its Pulse messages.
+
+    Responses are matched by method and URL in the order they were recorded.
+    When a request is repeated more often than it was recorded, the last
+    recorded response is used again.
+
+    Args:
+        path: The cassette file to read.
+        speed: "recorded" to wait out recorded message gaps and response latencies,
+            or "fast" to replay everything as quickly as possible.
+    """
+
+    def __init__(self, path, speed: str = "fast"):
+        if speed not in SPEEDS:
+            raise ValueError(f"unknown replay speed {speed!r}")
+        self.speed = speed
+        self.mirror = None
+        self.messages = []
+        self.responses = 0
+        self._responses = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._load(path)
+
+    def iter_messages(self) -> Iterator[Dict]:
+        """Yield the recorded Pulse message bodies, paced by the replay speed."""
+        started = time.monotonic()
+        for offset, body in self.messages:
+            if self.speed == "recorded":
+                delay = offset - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield body
+
+    def send(self, send, request, **kwargs):
+        """Return the recorded response for a request.  `send` is never called."""
+        key = (request.method, request.url)
+        with self._lock:
+            recorded = self._responses.get(key)
+            if not recorded:
+                raise NoRecordedResponse(f"no recorded response for {key[0]} {key[1]}")
+            event = recorded.popleft() if len(recorded) > 1 else recorded[0]
+        if self.speed == "recorded":
+            time.sleep(event["latency"])
+        return _build_response(request, event)
+
+    def record_message(self, body: Dict):
+        pass
+
+    def _load(self, path):
+        for event in _read_events(path):
+            kind = event.get("type")
+            if kind == "header":
+                if event.get("version") != FORMAT_VERSION:
+                    raise InvalidCassette(
+                        f"{path} has unsupported format version {event.get('version')}"
+                    )
+                self.mirror = Mirror(**event["mirror"])
+            elif kind == "message":
+                self.messages.append((event["t"], event["body"]))
+            elif kind == "http":
+                self._responses[(event["method"], event["url"])].append(event)
+                self.responses += 1
+        if self.mirror is None:
+            raise InvalidCassette(f"{path} has no cassette header")
+
+
+def _read_events(path) -> Iterator[Dict]:
+    with gzip.open(str(path), "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+        except EOFError:
+            # The recording process was killed; everything it flushed is usable.
+            log.warning(f"cassette {path} was not closed cleanly")
+
+
+def _build_response(request, event: Dict) -> requests.Response:
+    if "body_base64" in event:
+        content = base64.b64decode(event["body_base64"])
+    else:
+        content = event["body"].encode("utf-8")
+    response = requests.Response()
+    response.status_code = event["status"]
+    response.reason = event.get("reason")
+    response.headers = CaseInsensitiveDict(event["headers"])
+    response.headers["Content-Length"] = str(len(content))
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.raw = io.BytesIO(content)
+    response.url = request.url
+    response.request = request
+    return response
+
+
+def install(tape):
+    """Start recording to a Recorder or replaying from a Player.
+
+    Pass None to go back to using the network without recording.
+    """
+    global _current
+    _current = tape
+
+
+def current():
+    """Return the installed Recorder or Player, or None."""
+    return _current
+
+
+def record_message(body: Dict):
+    """Add a Pulse message body to the cassette being recorded, if any."""
+    if _current is not None:
+        _current.record_message(body)
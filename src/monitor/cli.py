@@ -1,19 +1,63 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import atexit
 import functools
+import itertools
 import logging
+import os
 import sys
+import time
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 import click
 import datadog
+import requests
 
-from monitor import config, reporting
-from monitor.main import determine_commit_replication_status
-from monitor.pulse import run_pulse_listener
+from monitor import (
+    backfill,
+    batch,
+    cassette,
+    config,
+    coordination,
+    deadline,
+    hgmo,
+    jobs,
+    metrics,
+    phabricator,
+    poll,
+    reporting,
+    supervisor,
+)
+from monitor.main import (
+    ReplicationStatus,
+    determine_commit_replication_status,
+    determine_mirror_replication_status,
+    probe_mirror_replication_status,
+    report_replication_status,
+    walk_mirror_replication_status,
+)
+from monitor.pulse import HaltQueueProcessing, process_push_message, run_pulse_listener
 from monitor.sentry import record_exceptions
 
+log = logging.getLogger(__name__)
+
+# Ways of measuring the replication lag of a whole repository.
+PROBES = ("commits", "repository")
+
+# Ways of learning about new pushes.
+SOURCES = ("pulse", "poll")
+
+# The most seconds two lag measurements of the same repository may differ by in
+# display-lag --cross-check.  The push heads are read after the probe, so the lag
+# can grow in between.
+CROSS_CHECK_TOLERANCE = 60
+
+# Minutes between scheduled checks, and the default time budget for each check
+# in seconds, which leaves some slack before the next one is due.
+CHECK_INTERVAL_MINUTES = supervisor.CHECK_INTERVAL_MINUTES
+DEFAULT_JOB_TIMEOUT = CHECK_INTERVAL_MINUTES * 60 * 0.9
+
 
 @click.command()
 @click.option(
@@ -22,8 +66,46 @@ from monitor.sentry import record_exceptions
     is_flag=True,
     help="Print debugging messages about the script's progress.",
 )
+@click.option(
+    "--batch",
+    "batch_file",
+    type=click.File("r"),
+    default=None,
+    help="Check the changeset IDs listed in this file concurrently. "
+    "Use '-' to read from stdin.",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["table", "jsonl"]),
+    default="table",
+    show_default=True,
+    help="Output format for --batch results.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=batch.DEFAULT_CONCURRENCY,
+    show_default=True,
+    help="Number of changesets to check at once in --batch mode.",
+)
+@click.option(
+    "--probe",
+    type=click.Choice(PROBES),
+    default="commits",
+    show_default=True,
+    help="How to measure the lag of the whole repository.  'commits' checks the "
+    "changesets of each queued push.  'repository' asks Phabricator for its newest "
+    "commit and compares it with the pushlog.",
+)
+@click.option(
+    "--cross-check",
+    is_flag=True,
+    help="With --probe repository, also check push heads one at a time and warn "
+    "if the results differ.",
+)
 @click.argument("node_ids", nargs=-1)
-def display_lag(debug, node_ids):
+def display_lag(debug, batch_file, fmt, concurrency, probe, cross_check, node_ids):
     """Display the replication lag for a repo or an individual commit.
 
     Does not drain any queues or send any data.
@@ -33,7 +115,31 @@ def display_lag(debug, node_ids):
 
     mirror = config.mirror_config_from_environ()
 
-    if node_ids:
+    if probe == "repository" and not (batch_file or node_ids):
+        if cross_check:
+            try:
+                status = probe_mirror_replication_status(mirror)
+            except (phabricator.Error, hgmo.Error, requests.RequestException) as e:
+                log.warning(f"repository probe failed, nothing to cross-check: {e}")
+                status = walk_mirror_replication_status(mirror)
+            else:
+                walked = walk_mirror_replication_status(mirror)
+                if not statuses_agree(status, walked):
+                    log.warning(
+                        f"repository probe found {status.seconds_behind}s of lag but "
+                        f"checking push heads found {walked.seconds_behind}s"
+                    )
+        else:
+            status = determine_mirror_replication_status(mirror)
+        reporting.print_replication_lag(mirror, status)
+    elif batch_file:
+        summary = batch.BatchSummary()
+        nodes = itertools.chain(node_ids, batch.read_node_ids(batch_file))
+        results = batch.check_nodes(mirror, nodes, concurrency, summary)
+        for result in results:
+            reporting.print_node_result(result, fmt)
+        click.echo(str(summary), err=True)
+    elif node_ids:
         for node_id in node_ids:
             status = determine_commit_replication_status(mirror, node_id)
             reporting.print_replication_lag(mirror, status)
@@ -53,6 +159,14 @@ def display_lag(debug, node_ids):
         )
 
 
+def statuses_agree(status: ReplicationStatus, other: ReplicationStatus) -> bool:
+    """Do two measurements of a repository's lag agree, within CROSS_CHECK_TOLERANCE?"""
+    return (
+        status.is_stale == other.is_stale
+        and abs(status.seconds_behind - other.seconds_behind) <= CROSS_CHECK_TOLERANCE
+    )
+
+
 @click.command()
 @click.option(
     "--debug",
@@ -65,7 +179,86 @@ def display_lag(debug, node_ids):
     is_flag=True,
     help="Do not drain any queues or send any data. Useful for debugging.",
 )
-def report_lag(debug, no_send):
+@click.option(
+    "--metrics-port",
+    envvar="METRICS_PORT",
+    type=int,
+    default=None,
+    help="Serve internal metrics for scraping over HTTP on this port.",
+)
+@click.option(
+    "--workers",
+    envvar="MONITOR_WORKERS",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Monitor the mirrors listed in MIRRORS from this many worker processes. "
+    "Defaults to one per mirror, up to the number of CPU cores, if MIRRORS is set.",
+)
+@click.option(
+    "--record",
+    "record_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Record Pulse messages and HTTP responses to this cassette file "
+    "for bin/replay-lag.",
+)
+@click.option(
+    "--probe",
+    envvar="LAG_PROBE",
+    type=click.Choice(PROBES),
+    default="commits",
+    show_default=True,
+    help="'commits' checks the changesets of each push read from Pulse.  "
+    "'repository' compares Phabricator's newest commit with the pushlog using a "
+    "fixed number of requests and does not read from Pulse.",
+)
+@click.option(
+    "--source",
+    envvar="PUSH_SOURCE",
+    type=click.Choice(SOURCES),
+    default="pulse",
+    show_default=True,
+    help="Where to learn about new pushes.  'poll' asks the pushlog for pushes "
+    "made since the last check and needs no Pulse credentials.",
+)
+@click.option(
+    "--state-file",
+    envvar="POLL_STATE_FILE",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="With --source poll, remember the last checked push in this file so "
+    "restarts resume where they left off.  Defaults to keeping it in memory.  "
+    "Not used with COORDINATION_URL, which keeps it in the shared store.",
+)
+@click.option(
+    "--job-timeout",
+    envvar="JOB_TIMEOUT",
+    type=click.FloatRange(min=0),
+    default=DEFAULT_JOB_TIMEOUT,
+    show_default=True,
+    help="Stop each check after this many seconds, keeping what it finished.  "
+    "0 means no limit.",
+)
+@click.option(
+    "--overlap",
+    envvar="JOB_OVERLAP",
+    type=click.Choice(jobs.OVERLAP_POLICIES),
+    default="coalesce",
+    show_default=True,
+    help="What to do when a check is due while the previous one is still running.",
+)
+def report_lag(
+    debug,
+    no_send,
+    metrics_port,
+    workers,
+    record_path,
+    probe,
+    source,
+    state_file,
+    job_timeout,
+    overlap,
+):
     """Measure and report repository replication lag to a metrics service."""
 
     if debug:
@@ -75,21 +268,74 @@ def report_lag(debug, no_send):
 
     logging.basicConfig(stream=sys.stdout, level=log_level)
 
+    # Only checking the commits of pushes announced over Pulse reads from Pulse.
+    if probe == "commits" and source == "pulse":
+        pulse_config = config.pulse_config_from_environ()
+
+    if metrics_port is not None:
+        metrics.start_http_server(metrics_port)
+
+    if workers is not None or os.environ.get("MIRRORS"):
+        if record_path:
+            raise click.UsageError("--record only supports monitoring a single mirror")
+        if probe != "commits":
+            raise click.UsageError("--probe only supports monitoring a single mirror")
+        if source != "pulse":
+            raise click.UsageError("--source only supports monitoring a single mirror")
+        run_supervisor(pulse_config, no_send, workers, log_level, job_timeout, overlap)
+        return
+
     mirror = config.mirror_config_from_environ()
-    pulse_config = config.pulse_config_from_environ()
+    start_coordination()
+
+    if record_path:
+        recorder = cassette.Recorder(record_path, mirror)
+        atexit.register(recorder.close)
+        cassette.install(recorder)
+        log.info(f"recording traffic to {record_path}")
 
     if no_send:
         reporting_function = reporting.print_replication_lag
         empty_queue_function = None
+        overrun_function = None
     else:
         datadog.initialize()
         reporting_function = reporting.report_to_statsd
         empty_queue_function = functools.partial(
             reporting.report_all_caught_up_to_statsd, mirror
         )
+        overrun_function = reporting.report_overrun_to_statsd
+
+    if source == "poll":
+        # Without --no-send progress is saved, like acknowledging Pulse messages.
+        if no_send:
+            poll_state = poll.PollState()
+        else:
+            poll_state = poll.PollState(state_file, coordination.current())
 
     @record_exceptions
+    @deadline.with_budget(job_timeout, overrun_function=overrun_function)
     def job():
+        if (probe == "repository" or source == "poll") and not coordination.owns(
+            mirror
+        ):
+            log.info(f"another instance is checking {mirror.repo_callsign}")
+            return
+
+        if probe == "repository":
+            status = determine_mirror_replication_status(mirror)
+            report_replication_status(mirror, status, reporting_function)
+            return
+
+        if source == "poll":
+            poll.poll_pushes(
+                mirror,
+                poll_state,
+                reporting_function,
+                empty_queue_callback=empty_queue_function,
+            )
+            return
+
         run_pulse_listener(
             pulse_config.PULSE_USERNAME,
             pulse_config.PULSE_PASSWORD,
@@ -104,11 +350,203 @@ def report_lag(debug, no_send):
             empty_queue_callback=empty_queue_function,
         )
 
+    guarded_job = jobs.OverlapGuard(job, overlap)
     sched = BlockingScheduler()
 
     # Run once right away, then run at intervals
-    sched.add_job(job)
-    sched.add_job(job, "interval", minutes=5)
+    sched.add_job(guarded_job, **jobs.SCHEDULER_JOB_OPTIONS)
+    sched.add_job(
+        guarded_job,
+        "interval",
+        minutes=CHECK_INTERVAL_MINUTES,
+        **jobs.SCHEDULER_JOB_OPTIONS,
+    )
 
     # This does not return
     sched.start()
+
+
+def start_coordination():
+    """Share work with other instances if COORDINATION_URL is set."""
+    coordinator = coordination.from_environ()
+    if coordinator is None:
+        return
+    coordination.install(coordinator)
+    # Hand leases over straight away instead of when they expire.
+    atexit.register(coordinator.release_all)
+    log.info(f"coordinating with other instances as {coordinator.instance_id}")
+
+
+def run_supervisor(pulse_config, no_send, workers, log_level, job_timeout, overlap):
+    """Monitor every configured mirror from a pool of worker processes."""
+    shards = config.mirror_shards_from_environ()
+    workers = workers or supervisor.default_worker_count(shards)
+
+    if no_send:
+        reporting_function = reporting.print_replication_lag
+    else:
+        datadog.initialize()
+        reporting_function = reporting.report_to_statsd
+
+    pool = supervisor.Supervisor(
+        supervisor.assign_shards(shards, workers),
+        (pulse_config, no_send, job_timeout, overlap),
+        reporting_function,
+        log_level=log_level,
+    )
+
+    # This does not return
+    pool.run()
+
+
+@click.command()
+@click.option(
+    "--debug",
+    envvar="DEBUG",
+    is_flag=True,
+    help="Print debugging messages about the script's progress.",
+)
+@click.option("--start", "start_id", type=int, required=True, help="First pushid.")
+@click.option("--end", "end_id", type=int, required=True, help="Last pushid.")
+@click.option(
+    "--output",
+    "-o",
+    default="-",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="File to write results to.  Defaults to stdout.",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(backfill.FORMATS),
+    default="csv",
+    show_default=True,
+    help="Output format.",
+)
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=backfill.DEFAULT_CHUNK_SIZE,
+    show_default=True,
+    help="Number of pushes to fetch from the pushlog per request.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=backfill.DEFAULT_CONCURRENCY,
+    show_default=True,
+    help="Number of mirror checks to run at once.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted run that wrote to the same --output file.",
+)
+def backfill_lag(debug, start_id, end_id, output, fmt, chunk_size, concurrency, resume):
+    """Check which changesets in a range of pushes are present in the mirror.
+
+    Writes one record per changeset with its pushid, node, pushdate and mirrored
+    state, and one without a node for each push without changesets.  Does not
+    drain any queues or send any data.
+    """
+    if debug:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+
+    # Results may be going to stdout, so keep the logs out of the way.
+    logging.basicConfig(stream=sys.stderr, level=log_level)
+
+    mirror = config.mirror_config_from_environ()
+
+    if output == "-":
+        if resume:
+            raise click.UsageError("--resume needs an --output file")
+        stream = click.get_text_stream("stdout")
+        header = True
+    else:
+        if resume and os.path.exists(output):
+            resume_id = backfill.truncate_partial_push(output, fmt)
+            if resume_id is not None:
+                start_id = max(start_id, resume_id)
+                log.info(f"resuming at pushid {start_id}")
+            header = os.path.getsize(output) == 0
+        else:
+            header = True
+        stream = open(output, "a" if resume else "w", encoding="utf-8")
+
+    writer = backfill.RecordWriter(stream, fmt, header=header)
+    records = backfill.check_pushes(mirror, start_id, end_id, chunk_size, concurrency)
+    last_pushid = None
+    try:
+        for record in records:
+            if record.pushid != last_pushid:
+                # Only whole pushes need to survive an interruption; see --resume.
+                stream.flush()
+                last_pushid = record.pushid
+            writer.write(record)
+    finally:
+        if output == "-":
+            stream.flush()
+        else:
+            stream.close()
+
+
+@click.command()
+@click.option(
+    "--debug",
+    envvar="DEBUG",
+    is_flag=True,
+    help="Print debugging messages about the script's progress.",
+)
+@click.option(
+    "--speed",
+    type=click.Choice(cassette.SPEEDS),
+    default="fast",
+    show_default=True,
+    help="'recorded' keeps the recorded gaps between messages and the recorded "
+    "HTTP latencies.  'fast' replays everything as quickly as possible.",
+)
+@click.argument("cassette_path", type=click.Path(exists=True, dir_okay=False))
+def replay_lag(debug, speed, cassette_path):
+    """Process the traffic recorded by report-lag --record again.
+
+    Pulse messages are read from the cassette and HTTP requests are answered from
+    it, so no network connections are made.  The measured lag is printed, not
+    sent.  The HTTP_* request limits do not apply to replayed requests.
+    """
+    if debug:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+
+    # Results go to stdout, so keep the logs out of the way.
+    logging.basicConfig(stream=sys.stderr, level=log_level)
+
+    player = cassette.Player(cassette_path, speed)
+    cassette.install(player)
+    worker_args = dict(
+        mirror_config=player.mirror, reporting_function=reporting.print_replication_lag
+    )
+
+    messages = stale = errors = 0
+    started = time.monotonic()
+    try:
+        for body in player.iter_messages():
+            messages += 1
+            try:
+                process_push_message(body, None, no_send=True, extra_data=worker_args)
+            except HaltQueueProcessing:
+                stale += 1
+            except Exception:
+                errors += 1
+                log.exception(f"failed to replay message {messages}")
+    finally:
+        cassette.install(None)
+
+    elapsed = time.monotonic() - started
+    click.echo(
+        f"replayed {messages} messages ({stale} stale, {errors} errors) "
+        f"using {player.responses} recorded HTTP responses in {elapsed:.2f}s",
+        err=True,
+    )
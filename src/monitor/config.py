@@ -2,9 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """Functions for reading application configuration values"""
+import json
 import os
 import types
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
 
 class Mirror(NamedTuple):
@@ -15,11 +16,30 @@ class Mirror(NamedTuple):
         url: The base URL of the Phabricator installation.
         repo_callsign: The Phabricator callsign for the mirrored repository.
             e.g. 'MOZILLACENTRAL'
+        local_repository_path: Optional path to a local clone of the source
+            repository.  If given, pushlog data is read from the clone's pushlog
+            database instead of over HTTP.
     """
 
     source_repository_url: str
     url: str
     repo_callsign: str
+    local_repository_path: Optional[str] = None
+
+
+class Shard(NamedTuple):
+    """A mirror and the Pulse queue that carries its source repository's pushes.
+
+    Args:
+        mirror: The mirror to monitor.
+        queue_name: The name of this mirror's Pulse queue, without the
+            'queue/<username>/' prefix.
+        routing_key: The Pulse routing key for the source repository.
+    """
+
+    mirror: Mirror
+    queue_name: str
+    routing_key: str
 
 
 def mirror_config_from_environ():
@@ -28,10 +48,54 @@ def mirror_config_from_environ():
         os.environ["SOURCE_REPOSITORY"],
         os.environ.get("PHABRICATOR_URL", "https://phabricator.services.mozilla.com"),
         os.environ["REPOSITORY_CALLSIGN"],
+        os.environ.get("LOCAL_REPOSITORY_PATH") or None,
     )
     return mirror
 
 
+def mirror_shards_from_environ():
+    """Return a list of Shard configurations from os.environ.
+
+    MIRRORS holds a JSON list with one object per mirrored repository, e.g.
+
+        [{"source_repository_url": "https://hg.mozilla.org/integration/autoland",
+          "repo_callsign": "AUTOLAND",
+          "routing_key": "integration/autoland"}]
+
+    Each object may also set "url" (the Phabricator URL), "local_repository_path"
+    and "queue_name".  The queue name defaults to PULSE_QUEUE_NAME followed by the
+    lowercased callsign.  Without MIRRORS the single mirror from
+    mirror_config_from_environ() is used.
+    """
+    default_url = os.environ.get(
+        "PHABRICATOR_URL", "https://phabricator.services.mozilla.com"
+    )
+    queue_prefix = os.environ["PULSE_QUEUE_NAME"]
+
+    if not os.environ.get("MIRRORS"):
+        return [
+            Shard(
+                mirror_config_from_environ(),
+                queue_prefix,
+                os.environ["PULSE_QUEUE_ROUTING_KEY"],
+            )
+        ]
+
+    shards = []
+    for entry in json.loads(os.environ["MIRRORS"]):
+        mirror = Mirror(
+            entry["source_repository_url"],
+            entry.get("url", default_url),
+            entry["repo_callsign"],
+            entry.get("local_repository_path"),
+        )
+        queue_name = entry.get(
+            "queue_name", f"{queue_prefix}-{mirror.repo_callsign.lower()}"
+        )
+        shards.append(Shard(mirror, queue_name, entry["routing_key"]))
+    return shards
+
+
 def pulse_config_from_environ():
     """Initialize a Pulse queue worker configuration from os.environ.
 
@@ -45,3 +109,67 @@ def pulse_config_from_environ():
         PULSE_QUEUE_ROUTING_KEY=os.environ["PULSE_QUEUE_ROUTING_KEY"],
         PULSE_QUEUE_READ_TIMEOUT=os.environ.get("PULSE_QUEUE_READ_TIMEOUT", 1.0),
     )
+
+
+def governor_config_from_environ():
+    """Initialize the per-host HTTP request limits from os.environ.
+
+    See monitor.governor.
+    """
+    return types.SimpleNamespace(
+        HTTP_RATE_LIMIT=float(os.environ.get("HTTP_RATE_LIMIT", 20.0)),
+        HTTP_RATE_BURST=float(os.environ.get("HTTP_RATE_BURST", 20.0)),
+        HTTP_INITIAL_CONCURRENCY=int(os.environ.get("HTTP_INITIAL_CONCURRENCY", 4)),
+        HTTP_MIN_CONCURRENCY=int(os.environ.get("HTTP_MIN_CONCURRENCY", 1)),
+        HTTP_MAX_CONCURRENCY=int(os.environ.get("HTTP_MAX_CONCURRENCY", 32)),
+    )
+
+
+def cache_config_from_environ():
+    """Initialize the hg.mozilla.org response cache settings from os.environ.
+
+    The cache is disabled unless HGMO_CACHE_DIR is set.  See monitor.cache.
+    """
+    return types.SimpleNamespace(
+        HGMO_CACHE_DIR=os.environ.get("HGMO_CACHE_DIR") or None,
+        HGMO_CACHE_MAX_BYTES=int(os.environ.get("HGMO_CACHE_MAX_BYTES", 2 ** 30)),
+    )
+
+
+def tracing_config_from_environ():
+    """Initialize the trace span export settings from os.environ.
+
+    Tracing is disabled unless TRACE_FILE is set.  See monitor.tracing.
+    """
+    return types.SimpleNamespace(
+        TRACE_FILE=os.environ.get("TRACE_FILE") or None,
+        TRACE_SAMPLE_RATE=float(os.environ.get("TRACE_SAMPLE_RATE", 1.0)),
+        TRACE_FILE_MAX_BYTES=int(os.environ.get("TRACE_FILE_MAX_BYTES", 50 * 2 ** 20)),
+        TRACE_FILE_BACKUP_COUNT=int(os.environ.get("TRACE_FILE_BACKUP_COUNT", 5)),
+    )
+
+
+def phabricator_config_from_environ():
+    """Initialize the Phabricator Conduit API settings from os.environ.
+
+    PHABRICATOR_API_TOKEN is only needed by the repository-level lag probe.
+    See monitor.phabricator.
+    """
+    return types.SimpleNamespace(
+        PHABRICATOR_API_TOKEN=os.environ.get("PHABRICATOR_API_TOKEN") or None
+    )
+
+
+def coordination_config_from_environ():
+    """Initialize the settings for sharing work between instances from os.environ.
+
+    Coordination is disabled unless COORDINATION_URL is set.  The default lease
+    lasts two check intervals.  See monitor.coordination.
+    """
+    return types.SimpleNamespace(
+        COORDINATION_URL=os.environ.get("COORDINATION_URL") or None,
+        COORDINATION_INSTANCE_ID=os.environ.get("COORDINATION_INSTANCE_ID") or None,
+        COORDINATION_LEASE_SECONDS=float(
+            os.environ.get("COORDINATION_LEASE_SECONDS", 600)
+        ),
+    )
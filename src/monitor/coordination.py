@@ -0,0 +1,440 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Share work and measurements between monitor instances.
+
+Several report-lag processes can watch the same mirrors, for example two dynos
+reading from one Pulse queue.  Pulse hands each message to only one of them, so
+they share the work, and they coordinate the rest through a shared store:
+
+Leases
+    A lease names one instance as the owner of something until it expires.  Work
+    that cannot be split, polling a pushlog or probing a whole repository, is only
+    done by the instance holding the mirror's owner lease.  The others stand by
+    and take over once the lease runs out.
+Mirrored commits
+    A commit that is in a mirror stays there.  Every instance records the commits
+    it finds, and no instance checks a recorded commit again.
+Poll positions
+    The last push checked by polling each mirror's pushlog is kept in the store,
+    so the next owner of the mirror carries on from it.
+The reporter
+    Every instance shares its latest measurement of each mirror.  Only the
+    instance holding the mirror's reporter lease sends a measurement to the
+    metrics service: the worst one taken within the last check interval.
+    Instances never overwrite each other's gauges.
+
+The store is chosen by URL: sqlite:///path/to/file.db for instances on one host,
+or redis://host:port/db for instances on many hosts, which needs the redis
+package.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from monitor import config, metrics
+from monitor.cache import cache_requests
+from monitor.config import Mirror
+
+log = logging.getLogger(__name__)
+
+# How long commits found in a mirror are remembered.
+MIRRORED_COMMIT_SECONDS = 7 * 24 * 60 * 60
+
+# How long a shared measurement counts towards the reported one.  This is one
+# check interval, so every instance's entry is replaced by its next check or
+# dropped.
+MEASUREMENT_SECONDS = 5 * 60
+
+# How long a mirror's poll position is kept without being updated.
+POLL_STATE_SECONDS = 30 * 24 * 60 * 60
+
+_current = None
+
+leases_held = metrics.gauge(
+    "monitor_coordination_leases_held",
+    "Whether this instance holds a coordination lease, by lease.",
+)
+
+
+class Error(Exception):
+    pass
+
+
+class UnsupportedStore(Error):
+    """Raised when a coordination store URL cannot be used."""
+
+    pass
+
+
+class SharedStore(ABC):
+    """The operations every coordination store provides.
+
+    Values are strings and every value expires.  Leases and values live in
+    separate key spaces.
+    """
+
+    @abstractmethod
+    def acquire_lease(self, name: str, owner: str, seconds: float) -> bool:
+        """Take a lease, or renew it if `owner` already holds it.
+
+        Returns:
+            True if `owner` holds the lease for the next `seconds`, False if
+            another owner holds it.
+        """
+
+    @abstractmethod
+    def release_lease(self, name: str, owner: str):
+        """Give up a lease if `owner` holds it."""
+
+    @abstractmethod
+    def put(self, namespace: str, key: str, value: str, seconds: float):
+        """Store a value for `seconds`."""
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        """Return a value, or None if it is missing or expired."""
+
+    @abstractmethod
+    def items(self, namespace: str) -> Dict[str, str]:
+        """Return every value in a namespace that has not expired, by key."""
+
+
+class SQLiteStore(SharedStore):
+    """A store kept in an SQLite database file, for instances on one host.
+
+    Args:
+        path: The database file.  Created if missing.
+        clock: Returns the current time in seconds since the epoch.  Every
+            process sharing the file must use the same clock.
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = str(path)
+        self._clock = clock
+        # sqlite3 connections may only be used by the thread that created them.
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, "
+                "key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)"
+            )
+
+    def acquire_lease(self, name: str, owner: str, seconds: float) -> bool:
+        now = self._clock()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT owner, expires FROM leases WHERE name = ?", (name,)
+            ).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                (name, owner, now + seconds),
+            )
+        return True
+
+    def release_lease(self, name: str, owner: str):
+        with self._transaction() as db:
+            db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def put(self, namespace: str, key: str, value: str, seconds: float):
+        now = self._clock()
+        with self._transaction() as db:
+            db.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+            db.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, expires) "
+                "VALUES (?, ?, ?, ?)",
+                (namespace, key, value, now + seconds),
+            )
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value FROM entries "
+                "WHERE namespace = ? AND key = ? AND expires > ?",
+                (namespace, key, self._clock()),
+            )
+            .fetchone()
+        )
+        return row[0] if row is not None else None
+
+    def items(self, namespace: str) -> Dict[str, str]:
+        rows = self._connection().execute(
+            "SELECT key, value FROM entries WHERE namespace = ? AND expires > ?",
+            (namespace, self._clock()),
+        )
+        return dict(rows)
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        # Take the write lock up front so that reading a lease and replacing it
+        # cannot interleave with another process doing the same.
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # isolation_level=None leaves transactions to _transaction().
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+
+class RedisStore(SharedStore):
+    """A store kept in Redis, for instances on many hosts.
+
+    Expiry is left to the Redis server, so the instances' clocks do not matter.
+
+    Args:
+        url: A redis:// or rediss:// URL.
+        client: A redis.Redis client to use instead of connecting to `url`.  It
+            must decode responses to str.
+    """
+
+    # Renew or release a lease only if the caller still holds it.
+    _RENEW_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+    )
+    _RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) end return 0"
+    )
+
+    def __init__(self, url: str, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise UnsupportedStore(f"{url} needs the redis package") from None
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self._redis = client
+        self._renew = self._redis.register_script(self._RENEW_SCRIPT)
+        self._release = self._redis.register_script(self._RELEASE_SCRIPT)
+
+    def acquire_lease(self, name: str, owner: str, seconds: float) -> bool:
+        key = f"lease:{name}"
+        milliseconds = int(seconds * 1000)
+        if self._redis.set(key, owner, px=milliseconds, nx=True):
+            return True
+        return bool(self._renew(keys=[key], args=[owner, milliseconds]))
+
+    def release_lease(self, name: str, owner: str):
+        self._release(keys=[f"lease:{name}"], args=[owner])
+
+    def put(self, namespace: str, key: str, value: str, seconds: float):
+        self._redis.set(f"value:{namespace}:{key}", value, px=int(seconds * 1000))
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        return self._redis.get(f"value:{namespace}:{key}")
+
+    def items(self, namespace: str) -> Dict[str, str]:
+        prefix = f"value:{namespace}:"
+        keys = list(self._redis.scan_iter(match=prefix + "*"))
+        if not keys:
+            return {}
+        values = self._redis.mget(keys)
+        return {
+            key[len(prefix) :]: value
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+
+def store_from_url(url: str) -> SharedStore:
+    """Return the store for a sqlite:///path or redis://host:port/db URL.
+
+    Raises:
+        UnsupportedStore if the URL's scheme is not supported.
+    """
+    parts = urlsplit(url)
+    if parts.scheme == "sqlite":
+        return SQLiteStore(parts.path)
+    if parts.scheme in ("redis", "rediss"):
+        return RedisStore(url)
+    raise UnsupportedStore(f"unsupported coordination store {url!r}")
+
+
+def default_instance_id() -> str:
+    """Return a name for this process that no other instance has."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Coordinator:
+    """Coordinates this instance with the others sharing a store.
+
+    Args:
+        store: The SharedStore the instances share.
+        instance_id: This instance's name.  It must differ from every other
+            instance's.  Defaults to default_instance_id().
+        lease_seconds: How long leases last.  An instance that stops renewing its
+            leases loses them after this long.
+    """
+
+    def __init__(
+        self, store: SharedStore, instance_id: str = None, lease_seconds: float = 600
+    ):
+        self.store = store
+        self.instance_id = instance_id or default_instance_id()
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._held = set()
+
+    def owns(self, mirror: Mirror) -> bool:
+        """Take or renew this instance's ownership of a mirror's unsplittable work."""
+        return self._lease(f"owner:{mirror.repo_callsign}")
+
+    def is_reporter(self, mirror: Mirror) -> bool:
+        """Take or renew the right to report a mirror's measurements."""
+        return self._lease(f"reporter:{mirror.repo_callsign}")
+
+    def is_mirrored(self, mirror: Mirror, commit_sha: str) -> bool:
+        """Has any instance found this commit in the mirror?"""
+        found = self.store.get(f"mirrored:{mirror.repo_callsign}", commit_sha)
+        result = "miss" if found is None else "hit"
+        cache_requests.labels(cache="mirrored_commits", result=result).inc()
+        return found is not None
+
+    def mark_mirrored(self, mirror: Mirror, commit_sha: str):
+        """Tell the other instances that a commit is in the mirror."""
+        self.store.put(
+            f"mirrored:{mirror.repo_callsign}", commit_sha, "1", MIRRORED_COMMIT_SECONDS
+        )
+        cache_requests.labels(cache="mirrored_commits", result="store").inc()
+
+    def poll_state(self, mirror: Mirror) -> Dict:
+        """Return the poll position saved by any instance, or {} if there is none."""
+        value = self.store.get("poll_state", mirror.repo_callsign)
+        return json.loads(value) if value is not None else {}
+
+    def save_poll_state(self, mirror: Mirror, state: Dict):
+        """Save a mirror's poll position for whichever instance polls it next."""
+        self.store.put(
+            "poll_state", mirror.repo_callsign, json.dumps(state), POLL_STATE_SECONDS
+        )
+
+    def reconcile(self, mirror: Mirror, replication_status):
+        """Share a measurement and return the one this instance should report.
+
+        Each instance's entry is replaced by its next measurement and expires
+        after MEASUREMENT_SECONDS, so an old stale reading cannot hide a mirror
+        that has caught up for longer than one check interval.  Within that
+        interval the worst entry wins: instances reading one Pulse queue see
+        different pushes, and a fresh push seen by one does not mean the push
+        another is holding has been mirrored.
+
+        Args:
+            mirror: The mirror that was measured.
+            replication_status: This instance's monitor.main.ReplicationStatus.
+
+        Returns:
+            The worst ReplicationStatus any instance measured within the last
+            MEASUREMENT_SECONDS if this instance is the mirror's reporter, else
+            None.
+        """
+        namespace = f"status:{mirror.repo_callsign}"
+        self.store.put(
+            namespace,
+            self.instance_id,
+            json.dumps(replication_status),
+            MEASUREMENT_SECONDS,
+        )
+        if not self.is_reporter(mirror):
+            log.debug(f"another instance reports for {mirror.repo_callsign}")
+            return None
+        shared = [
+            replication_status._make(json.loads(value))
+            for value in self.store.items(namespace).values()
+        ]
+        return max(shared + [replication_status])
+
+    def release_all(self):
+        """Give up every lease this instance holds, for a quick handover."""
+        with self._lock:
+            held, self._held = self._held, set()
+        for name in held:
+            self.store.release_lease(name, self.instance_id)
+            leases_held.labels(lease=name).set(0)
+
+    def _lease(self, name: str) -> bool:
+        held = self.store.acquire_lease(name, self.instance_id, self.lease_seconds)
+        with self._lock:
+            changed = held != (name in self._held)
+            if held:
+                self._held.add(name)
+            else:
+                self._held.discard(name)
+        if changed:
+            log.info(f"{'acquired' if held else 'lost'} lease {name}")
+        leases_held.labels(lease=name).set(1 if held else 0)
+        return held
+
+
+def from_environ(instance_suffix: str = None) -> Optional[Coordinator]:
+    """Return a Coordinator configured from os.environ, or None if disabled.
+
+    See config.coordination_config_from_environ().
+
+    Args:
+        instance_suffix: Appended to a configured COORDINATION_INSTANCE_ID, for
+            processes that share the environment but must be separate instances,
+            such as supervisor workers.
+    """
+    settings = config.coordination_config_from_environ()
+    if not settings.COORDINATION_URL:
+        return None
+    instance_id = settings.COORDINATION_INSTANCE_ID
+    if instance_id and instance_suffix:
+        instance_id = f"{instance_id}:{instance_suffix}"
+    return Coordinator(
+        store_from_url(settings.COORDINATION_URL),
+        instance_id,
+        settings.COORDINATION_LEASE_SECONDS,
+    )
+
+
+def install(coordinator: Optional[Coordinator]):
+    """Coordinate this process through `coordinator`, or stop if it is None."""
+    global _current
+    _current = coordinator
+
+
+def current() -> Optional[Coordinator]:
+    """Return the installed Coordinator, or None."""
+    return _current
+
+
+def owns(mirror: Mirror) -> bool:
+    """Should this instance do a mirror's unsplittable work?
+
+    Always True when no Coordinator is installed.
+    """
+    if _current is None:
+        return True
+    return _current.owns(mirror)
@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Time budgets for scheduled jobs.
+
+A job runs inside a Deadline.  HTTP requests made through
+monitor.util.requests_retry_session() and the Pulse connection take their
+timeouts from the current thread's deadline, so a job cannot run much past its
+budget however slow the servers are.  Once the budget is spent the next network
+call raises DeadlineExceeded.  Work finished before that, such as reported lag
+and saved polling progress, is kept.
+"""
+import functools
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from monitor import metrics
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+job_overruns = metrics.counter(
+    "monitor_job_overruns_total",
+    "Scheduled job runs stopped because they used up their time budget, by job.",
+)
+
+
+class Deadline:
+    """A point in time by which the current job must be done.
+
+    Use it as a context manager to make it the current thread's deadline.
+
+    Args:
+        seconds: The time budget, starting now.
+    """
+
+    def __init__(self, seconds: float, clock=time.monotonic):
+        self.seconds = seconds
+        self._clock = clock
+        self._expires = clock() + seconds
+        self._previous = None
+
+    def remaining(self) -> float:
+        """Return the seconds left in the budget, never less than zero."""
+        return max(0.0, self._expires - self._clock())
+
+    @property
+    def expired(self) -> bool:
+        return self._clock() >= self._expires
+
+    def check(self):
+        """Raise DeadlineExceeded if the budget is used up."""
+        if self.expired:
+            raise DeadlineExceeded(f"job exceeded its {self.seconds:.0f}s time budget")
+
+    def timeout(self, default: Optional[float] = None) -> float:
+        """Return a timeout for a blocking call that ends with the budget.
+
+        Args:
+            default: The timeout the call would use without a deadline.  The
+                smaller of the two is returned.
+
+        Raises:
+            DeadlineExceeded if there is no time left.
+        """
+        self.check()
+        remaining = self.remaining()
+        if default is None:
+            return remaining
+        return min(default, remaining)
+
+    def __enter__(self):
+        self._previous = getattr(_local, "deadline", None)
+        _local.deadline = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.deadline = self._previous
+        return False
+
+
+def current() -> Optional[Deadline]:
+    """Return the current thread's deadline, or None if there is no time budget."""
+    return getattr(_local, "deadline", None)
+
+
+def check():
+    """Raise DeadlineExceeded if the current thread's deadline has passed."""
+    deadline = current()
+    if deadline is not None:
+        deadline.check()
+
+
+def timeout(default: Optional[float] = None) -> Optional[float]:
+    """Return a timeout for a blocking call, limited by the current deadline.
+
+    Returns `default` unchanged when there is no current deadline.
+
+    Raises:
+        DeadlineExceeded if the current deadline has passed.
+    """
+    deadline = current()
+    if deadline is None:
+        return default
+    return deadline.timeout(default)
+
+
+def with_budget(
+    seconds: Optional[float],
+    name: str = "report_lag",
+    overrun_function: Optional[Callable] = None,
+):
+    """Decorate a job function so that each run has a time budget.
+
+    A run that uses up its budget is stopped at its next network call, logged
+    and counted in the monitor_job_overruns_total metric instead of raising.
+
+    Args:
+        seconds: The budget for each run.  None or 0 disables the budget.
+        name: The job name used in logs and metrics.
+        overrun_function: Called with the job name after each overrun, for
+            example reporting.report_overrun_to_statsd.
+    """
+
+    def decorator(fn):
+        if not seconds:
+            return fn
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with Deadline(seconds):
+                try:
+                    return fn(*args, **kwargs)
+                except DeadlineExceeded as e:
+                    log.warning(f"stopped job {name}: {e}")
+                    job_overruns.labels(job=name).inc()
+                    if overrun_function is not None:
+                        overrun_function(name)
+
+        return run
+
+    return decorator
+
+
+class Error(Exception):
+    pass
+
+
+class DeadlineExceeded(Error):
+    """Raised when a job's time budget runs out."""
+
+    pass
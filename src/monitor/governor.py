@@ -0,0 +1,246 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Per-host request rate and concurrency limits.
+
+Every HTTP request made through monitor.util.requests_retry_session() passes
+through the governor for its host.  A governor combines a token bucket, which
+caps the request rate, with an adaptive concurrency limit.  The concurrency limit
+grows by one request per round of healthy responses and is cut back
+multiplicatively when the server answers 429 or 5XX, fails to answer, or gets
+noticeably slower than usual.
+
+Waiting for either limit counts against the current monitor.deadline.Deadline.
+A request that cannot start before the deadline raises DeadlineExceeded.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from monitor import config, deadline, metrics
+
+log = logging.getLogger(__name__)
+
+# Multiply the concurrency limit by this when the server shows signs of overload.
+BACKOFF_FACTOR = 0.7
+
+# Treat latency as rising when the recent average exceeds the long-run average
+# by this factor.
+LATENCY_TOLERANCE = 2.0
+
+# Smoothing factors for the recent and long-run latency averages.
+SHORT_LATENCY_WEIGHT = 0.3
+LONG_LATENCY_WEIGHT = 0.02
+
+concurrency_limit = metrics.gauge(
+    "monitor_governor_concurrency_limit", "Current concurrent request limit, by host."
+)
+in_flight = metrics.gauge(
+    "monitor_governor_in_flight", "Requests currently in flight, by host."
+)
+rate_limit = metrics.gauge(
+    "monitor_governor_rate_limit", "Request rate limit in requests/second, by host."
+)
+throttled = metrics.counter(
+    "monitor_governor_throttled_total",
+    "Requests that waited for the rate or concurrency limit, by host.",
+)
+
+
+class TokenBucket:
+    """Limits the average rate of events while allowing short bursts.
+
+    Args:
+        rate: Tokens added per second.
+        burst: The most tokens the bucket can hold.
+    """
+
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, sleeping until one is available.
+
+        Returns:
+            The number of seconds spent waiting.
+
+        Raises:
+            deadline.DeadlineExceeded if the current deadline passes before a token
+            is available.  The token is given back.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Take the token now, even if that leaves the bucket in debt, so that
+            # waiting callers are served in the order they arrived.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            try:
+                if deadline.timeout(wait) < wait:
+                    raise deadline.DeadlineExceeded(
+                        "the job deadline passes before the rate limit allows "
+                        "another request"
+                    )
+            except deadline.DeadlineExceeded:
+                with self._lock:
+                    self._tokens += 1
+                raise
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveLimit:
+    """A concurrency limit that adjusts itself to the server's health.
+
+    Args:
+        initial: The starting limit.
+        minimum: The limit never drops below this.
+        maximum: The limit never rises above this.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._limit = float(max(minimum, min(initial, maximum)))
+        self._in_flight = 0
+        self._short_latency = None
+        self._long_latency = None
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self) -> bool:
+        """Wait for a free slot and take it.
+
+        Returns:
+            True if the caller had to wait for a slot.
+
+        Raises:
+            deadline.DeadlineExceeded if the current deadline passes first.
+        """
+        waited = False
+        with self._condition:
+            while self._in_flight >= self.limit:
+                waited = True
+                # deadline.timeout() raises once the deadline has passed.
+                self._condition.wait(deadline.timeout())
+            self._in_flight += 1
+        return waited
+
+    def cancel(self):
+        """Give back a slot that was never used, leaving the limit as it is."""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def release(self, latency: float, overloaded: bool):
+        """Give back a slot and adjust the limit using the request's outcome.
+
+        Args:
+            latency: How long the request took, in seconds.
+            overloaded: True if the server answered 429 or 5XX or did not answer.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded or self._latency_rising(latency):
+                self._limit = max(self.minimum, self._limit * BACKOFF_FACTOR)
+            else:
+                # Additive increase: about +1 once every `limit` healthy requests.
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def _latency_rising(self, latency: float) -> bool:
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+            return False
+        self._short_latency += SHORT_LATENCY_WEIGHT * (latency - self._short_latency)
+        self._long_latency += LONG_LATENCY_WEIGHT * (latency - self._long_latency)
+        return self._short_latency > self._long_latency * LATENCY_TOLERANCE
+
+
+class HostGovernor:
+    """The rate and concurrency limits for requests to a single host."""
+
+    def __init__(self, host: str, bucket: TokenBucket, limit: AdaptiveLimit):
+        self.host = host
+        self.bucket = bucket
+        self.limit = limit
+        rate_limit.labels(host=host).set(bucket.rate)
+        self._publish()
+
+    @contextmanager
+    def request(self):
+        """Hold a request slot for the duration of the with-block.
+
+        The block is given a function to call with the response's HTTP status code.
+        Responses with status 429 or 5XX, blocks that never report a status and
+        blocks that raise all count as signs of overload.
+        """
+        waited = self.limit.acquire()
+        try:
+            waited = self.bucket.acquire() > 0 or waited
+        except BaseException:
+            self.limit.cancel()
+            raise
+        if waited:
+            throttled.labels(host=self.host).inc()
+        self._publish()
+
+        outcome = {"overloaded": True}
+
+        def observe(status_code: int):
+            outcome["overloaded"] = status_code == 429 or status_code >= 500
+
+        start = time.perf_counter()
+        try:
+            yield observe
+        finally:
+            self.limit.release(time.perf_counter() - start, outcome["overloaded"])
+            self._publish()
+
+    def _publish(self):
+        concurrency_limit.labels(host=self.host).set(self.limit.limit)
+        in_flight.labels(host=self.host).set(self.limit.in_flight)
+
+
+_governors = {}  # type: Dict[str, HostGovernor]
+_governors_lock = threading.Lock()
+
+
+def governor_for(host: str) -> HostGovernor:
+    """Return the shared governor for a host, creating it on first use."""
+    governor = _governors.get(host)
+    if governor is None:
+        with _governors_lock:
+            governor = _governors.get(host)
+            if governor is None:
+                settings = config.governor_config_from_environ()
+                governor = HostGovernor(
+                    host,
+                    TokenBucket(settings.HTTP_RATE_LIMIT, settings.HTTP_RATE_BURST),
+                    AdaptiveLimit(
+                        settings.HTTP_INITIAL_CONCURRENCY,
+                        settings.HTTP_MIN_CONCURRENCY,
+                        settings.HTTP_MAX_CONCURRENCY,
+                    ),
+                )
+                _governors[host] = governor
+    return governor
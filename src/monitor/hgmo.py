@@ -4,15 +4,40 @@
 """
 Functions for interacting with hg.mozilla.org APIs.
 """
+import functools
+import json
 import logging
-from typing import Dict, List
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
 
+from monitor import cassette, config, jsonstream, tracing
+from monitor.cache import DiskCache, cache_requests
+from monitor.metrics import time_stage
+from monitor.nodes import NodeList
 from monitor.util import requests_retry_session
 
 log = logging.getLogger(__name__)
 
+# Bytes read from the network at a time when streaming pushlog data.
+PUSHLOG_CHUNK_SIZE = 64 * 1024
 
-def changesets_for_pushid(pushid: int, push_json_url: str) -> List[str]:
+
+class Push(NamedTuple):
+    """A single push from a repository pushlog.
+
+    Args:
+        pushid: The integer pushlog pushid.
+        date: The UTC Unix time of the push.
+        changesets: The changeset IDs in the push, oldest first.
+    """
+
+    pushid: int
+    date: int
+    changesets: NodeList
+
+
+def changesets_for_pushid(pushid: int, push_json_url: str) -> NodeList:
     """Return a list of changeset IDs in a repository push.
 
     Reads data published by the Mozilla hgweb pushlog extension.
@@ -27,27 +52,229 @@ def changesets_for_pushid(pushid: int, push_json_url: str) -> List[str]:
             function.
 
     Returns:
-        A list of changeset ID strings (40 char hex strings).
+        A NodeList of the push's changeset IDs, oldest first.  It is empty if
+        the push has no changesets.
+
+    Raises:
+        NoSuchPush if the pushlog data does not contain the push.
+        requests.HTTPError for all other problems.
+    """
+    with time_stage("pushlog_fetch"):
+        return NodeList(iter_changesets_for_pushid(pushid, push_json_url))
+
+
+def iter_changesets_for_pushid(pushid: int, push_json_url: str) -> Iterator[str]:
+    """Yield the changeset IDs in a repository push as the pushlog data arrives.
+
+    Like changesets_for_pushid(), but a caller that stops early, for example at
+    the first changeset missing from a mirror, also stops the download.  Close the
+    generator to stop it straight away.
+
+    Raises:
+        NoSuchPush once the pushlog data has been read if it does not contain the
+        push.
+        requests.HTTPError for all other problems.
     """
     log.info(f"processing pushid {pushid}")
-    response = requests_retry_session().get(push_json_url)
-    response.raise_for_status()
+    seen = set()
+    count = 0
+    for _, node in stream_pushlog_changesets(push_json_url, [pushid], seen):
+        count += 1
+        yield node
+    if pushid not in seen:
+        raise NoSuchPush(f"The pushlog at {push_json_url} has no push {pushid}")
+    log.info(f"got {count} changesets for pushid {pushid}")
+
+
+def stream_pushlog_changesets(
+    push_json_url: str, pushids: Iterable[int] = None, seen: Set[int] = None
+) -> Iterator[Tuple[int, str]]:
+    """Yield (pushid, changeset ID) pairs from a pushlog URL as the data arrives.
+
+    The response body is decoded incrementally, so changesets are yielded while the
+    download is still in progress and memory use does not grow with the size of
+    the pushes.
+
+    Args:
+        push_json_url: A json-pushes URL that returns version 2 pushlog data.
+        pushids: Only yield changesets from these pushes.  Defaults to all of the
+            pushes in the response.
+        seen: If given, the pushid of every wanted push found in the response is
+            added to it, including pushes without changesets.
+    """
+    seen = set() if seen is None else seen
+    with PushlogBody(push_json_url) as body:
+        for pushid, node in iter_pushlog_changesets(body.chunks, pushids, seen):
+            yield pushid, node
+        body.complete = _covers_requested_pushes(push_json_url, seen)
+
+
+def iter_pushlog_changesets(
+    chunks: Iterable[bytes], pushids: Iterable[int] = None, seen: Set[int] = None
+) -> Iterator[Tuple[int, str]]:
+    """Yield (pushid, changeset ID) pairs from chunks of a version 2 pushlog document.
+
+    Changesets are yielded in document order.  Both the plain list of changeset IDs
+    and the 'full=1' list of changeset objects are understood.
+
+    See https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/pushlog.html#version-2
+
+    Args:
+        chunks: The document in pieces.
+        pushids: Only yield changesets from these pushes.
+        seen: If given, the pushid of every wanted push in the document is added
+            to it, including pushes without changesets.
+    """
+    wanted = None if pushids is None else {str(pushid) for pushid in pushids}
+    for path, value in jsonstream.iter_leaves(chunks):
+        if len(path) < 3 or path[0] != "pushes":
+            continue
+        if wanted is not None and path[1] not in wanted:
+            continue
+        if seen is not None:
+            # Every push has a date and user, so even an empty push is seen.
+            seen.add(int(path[1]))
+        # ("pushes", "<pushid>", "changesets", None) for a plain changeset list,
+        # ("pushes", "<pushid>", "changesets", None, "node") for full=1 output.
+        if len(path) < 4 or path[2] != "changesets":
+            continue
+        if len(path) == 4 or path[4:] == ("node",):
+            yield int(path[1]), value
+
+
+def stream_pushes(push_json_url: str, session=None) -> Iterator[Push]:
+    """Yield each Push in a pushlog URL's response as the data arrives.
+
+    Only one push is held in memory at a time.
+
+    Args:
+        push_json_url: A json-pushes URL that returns version 2 pushlog data.
+        session: Optional requests.Session to reuse.
+    """
+    seen = set()
+    with PushlogBody(push_json_url, session) as body:
+        for push in iter_pushlog_pushes(body.chunks):
+            seen.add(push.pushid)
+            yield push
+        body.complete = _covers_requested_pushes(push_json_url, seen)
+
+
+def iter_pushlog_pushes(chunks: Iterable[bytes]) -> Iterator[Push]:
+    """Yield each Push from chunks of a version 2 pushlog document.
+
+    Pushes are yielded in document order.
+    """
+    push = None
+    for path, value in jsonstream.iter_leaves(chunks):
+        if len(path) < 3 or path[0] != "pushes":
+            continue
+        pushid = int(path[1])
+        if push is None or push.pushid != pushid:
+            if push is not None:
+                yield push
+            push = Push(pushid, None, NodeList())
+        if path[2:] == ("date",):
+            push = push._replace(date=value)
+        elif path[2:] in (("changesets", None), ("changesets", None, "node")):
+            push.changesets.append(value)
+    if push is not None:
+        yield push
+
+
+class PushBatch(NamedTuple):
+    """Pushes read from the pushlog and the validators for re-checking the request.
+
+    Args:
+        pushes: The pushes, oldest first.
+        validators: The response's ETag and Last-Modified values, if any, for use
+            with fetch_pushes().
+    """
+
+    pushes: List[Push]
+    validators: Dict
+
+
+def fetch_pushes(
+    push_json_url: str, validators: Dict = None, session=None
+) -> Optional[PushBatch]:
+    """Fetch the pushes in a pushlog URL's response unless they are unchanged.
+
+    The response cache is not used, so that new pushes are always seen.
+
+    Args:
+        push_json_url: A json-pushes URL that returns version 2 pushlog data.
+        validators: The validators of an earlier PushBatch for the same URL.  They
+            are sent as conditional request headers.
+        session: Optional requests.Session to reuse.
+
+    Returns:
+        A PushBatch, or None if the server says the response has not changed.
+    """
+    session = session or requests_retry_session()
+    headers = _validator_headers(validators or {})
+    with time_stage("pushlog_fetch"):
+        response = session.get(push_json_url, headers=headers, stream=True)
+        with closing(response):
+            if validators and response.status_code == 304:
+                return None
+            response.raise_for_status()
+            pushes = list(
+                iter_pushlog_pushes(response.iter_content(PUSHLOG_CHUNK_SIZE))
+            )
+    return PushBatch(pushes, _validators(response))
 
-    # See https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/pushlog.html#version-2
-    changesets = response.json()["pushes"][str(pushid)]["changesets"]
-    log.info(f"got {len(changesets)} changesets for pushid {pushid}")
-    return changesets
 
+class PushTips(NamedTuple):
+    """The newest changeset of each push in a range, and the repository's last push.
 
-def fetch_changeset(changesetid: str, repo_url: str) -> Dict:
+    Args:
+        pushes: The pushes in the range, oldest first.  Each Push holds only its
+            newest changeset.
+        last_pushid: The pushid of the newest push in the whole repository.
+    """
+
+    pushes: List[Push]
+    last_pushid: int
+
+
+def fetch_push_tips(push_json_url: str, session=None) -> PushTips:
+    """Fetch a pushlog URL's pushes and the repository's last pushid.
+
+    The response is read without the response cache because the last pushid
+    changes with every push.
+
+    Args:
+        push_json_url: A json-pushes URL that returns version 2 pushlog data,
+            usually with 'tipsonly=1' to keep the response small.
+        session: Optional requests.Session to reuse.
+    """
+    session = session or requests_retry_session()
+    with time_stage("pushlog_fetch"):
+        response = session.get(push_json_url)
+    response.raise_for_status()
+    data = response.json()
+    pushes = [
+        Push(int(pushid), push["date"], NodeList(push["changesets"][-1:]))
+        for pushid, push in sorted(data["pushes"].items(), key=lambda i: int(i[0]))
+    ]
+    return PushTips(pushes, data["lastpushid"])
+
+
+def fetch_changeset(changesetid: str, repo_url: str, session=None) -> Dict:
     """Fetch changeset JSON from hg.mozilla.org.
 
+    Args:
+        changesetid: The changeset ID to fetch.
+        repo_url: The full URL of the repository holding the changeset.
+        session: Optional requests.Session to reuse.
+
     Raises:
         NoSuchChangeset if the changeset does not exist on hg.mozilla.org.
         requests.HTTPError for all other problems.
     """
     # Example URL: https://hg.mozilla.org/mozilla-central/json-rev/deafa2891c61
-    response = requests_retry_session().get(f"{repo_url}/json-rev/{changesetid}")
+    with time_stage("changeset_fetch"):
+        response = _get_immutable(f"{repo_url}/json-rev/{changesetid}", session)
     if response.status_code == 404:
         raise NoSuchChangeset(
             f"The changeset {changesetid} does not exist in repository {repo_url}"
@@ -64,7 +291,8 @@ def fetch_raw_diff_for_changeset(changesetid: str, repo_url: str) -> str:
         requests.HTTPError for all other problems.
     """
     # Example URL: https://hg.mozilla.org/mozilla-central/raw-rev/f0fe810b3d7863cdb
-    response = requests_retry_session().get(f"{repo_url}/raw-rev/{changesetid}")
+    with time_stage("raw_diff_fetch"):
+        response = _get_immutable(f"{repo_url}/raw-rev/{changesetid}")
     if response.status_code == 404:
         raise NoSuchChangeset(
             f"The changeset {changesetid} does not exist in repository {repo_url}"
@@ -73,6 +301,171 @@ def fetch_raw_diff_for_changeset(changesetid: str, repo_url: str) -> str:
     return response.text
 
 
+def response_cache() -> Optional[DiskCache]:
+    """Return the on-disk cache for hg.mozilla.org responses, or None if disabled.
+
+    The cache is bypassed while traffic is recorded or replayed, so that every
+    response goes through the cassette.  See monitor.cassette.
+    """
+    if cassette.current() is not None:
+        return None
+    return _disk_cache()
+
+
+@functools.lru_cache(maxsize=None)
+def _disk_cache() -> Optional[DiskCache]:
+    settings = config.cache_config_from_environ()
+    if not settings.HGMO_CACHE_DIR:
+        return None
+    log.info(f"caching hg.mozilla.org responses in {settings.HGMO_CACHE_DIR}")
+    return DiskCache(settings.HGMO_CACHE_DIR, settings.HGMO_CACHE_MAX_BYTES)
+
+
+class CachedResponse:
+    """A stand-in for a successful requests.Response that was read from the cache."""
+
+    status_code = 200
+
+    def __init__(self, content, encoding: str = None):
+        self.content = content
+        self.encoding = encoding or "utf-8"
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding)
+
+
+def _get_immutable(url: str, session=None):
+    """GET a URL whose successful response never changes, using the response cache.
+
+    json-rev and raw-rev responses for a public changeset never change once the
+    changeset exists, so a cached copy is used without checking the server.
+
+    Returns:
+        A requests.Response, or a CachedResponse if the body came from the cache.
+    """
+    cache = response_cache()
+    if cache is not None:
+        entry = cache.lookup(url)
+        if entry is not None:
+            return CachedResponse(cache.read(entry), entry.metadata.get("encoding"))
+
+    session = session or requests_retry_session()
+    response = session.get(url)
+    if cache is not None and response.status_code == 200:
+        metadata = {"encoding": response.encoding, "immutable": True}
+        cache.put(url, response.content, metadata)
+    return response
+
+
+class PushlogBody:
+    """The body of a json-pushes response, read from the response cache if possible.
+
+    Use as a context manager and read the body from `.chunks`.  The number of
+    bytes read is recorded on the current trace span as pushlog.bytes_read when
+    the context ends.  A downloaded body is copied to the cache as it is read.  It is kept as an immutable entry if the
+    reader sets `.complete` to say that every requested push was present, since
+    existing pushes never change.  Other bodies are only kept if the server sent
+    validators, and are revalidated with a conditional request before reuse.
+
+    Args:
+        push_json_url: The json-pushes URL to read.
+        session: Optional requests.Session to reuse.
+    """
+
+    def __init__(self, push_json_url: str, session=None):
+        self.url = push_json_url
+        self.session = session
+        self.complete = False
+        self.chunks = None
+        self.bytes_read = 0
+        self._response = None
+        self._writer = None
+
+    def __enter__(self):
+        cache = response_cache()
+        entry = cache.lookup(self.url) if cache is not None else None
+        if entry is not None and entry.metadata.get("immutable"):
+            self.chunks = self._count(cache.iter_chunks(entry))
+            return self
+
+        headers = _validator_headers(entry.metadata) if entry is not None else {}
+        session = self.session or requests_retry_session()
+        self._response = session.get(self.url, stream=True, headers=headers)
+        try:
+            if entry is not None and self._response.status_code == 304:
+                cache_requests.labels(cache=cache.name, result="revalidated").inc()
+                self.chunks = self._count(cache.iter_chunks(entry))
+                return self
+            self._response.raise_for_status()
+        except Exception:
+            self._response.close()
+            raise
+
+        self.chunks = self._count(self._response.iter_content(PUSHLOG_CHUNK_SIZE))
+        if cache is not None:
+            self._writer = cache.writer(self.url, _validators(self._response))
+            self.chunks = self._tee(self.chunks)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        tracing.current_span().set_attribute("pushlog.bytes_read", self.bytes_read)
+        if self._writer is not None:
+            with self._writer:
+                metadata = self._writer.metadata
+                revalidatable = bool(_validator_headers(metadata))
+                metadata["immutable"] = self.complete
+                if exc_type is None and (self.complete or revalidatable):
+                    self._writer.commit()
+        if self._response is not None:
+            self._response.close()
+
+    def _count(self, chunks):
+        for chunk in chunks:
+            self.bytes_read += len(chunk)
+            yield chunk
+
+    def _tee(self, chunks):
+        for chunk in chunks:
+            self._writer.write(chunk)
+            yield chunk
+
+
+def _validators(response) -> Dict:
+    validators = {}
+    if response.headers.get("ETag"):
+        validators["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return validators
+
+
+def _validator_headers(metadata: Dict) -> Dict:
+    headers = {}
+    if "etag" in metadata:
+        headers["If-None-Match"] = metadata["etag"]
+    if "last_modified" in metadata:
+        headers["If-Modified-Since"] = metadata["last_modified"]
+    return headers
+
+
+def _covers_requested_pushes(push_json_url: str, seen_pushids) -> bool:
+    """Did a json-pushes response hold every push in its URL's startID/endID range?"""
+    query = parse_qs(urlsplit(push_json_url).query)
+    try:
+        start_id = int(query["startID"][0])
+        end_id = int(query["endID"][0])
+    except (KeyError, ValueError):
+        return False
+    return all(pushid in seen_pushids for pushid in range(start_id + 1, end_id + 1))
+
+
 def utc_hgwebdate(hgweb_datejson):
     """Turn a (unixtime, offset) tuple back into a UTC Unix timestamp.
 
@@ -101,3 +494,7 @@ class Error(Exception):
 
 class NoSuchChangeset(Error):
     """Raised if the given changeset ID does not exist in the target system."""
+
+
+class NoSuchPush(Error):
+    """Raised if the given pushid does not exist in the pushlog data."""
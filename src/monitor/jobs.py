@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Control what happens when a scheduled job is still running at its next start.
+
+The monitor's jobs run on an interval.  A slow run can still be going when the
+next one is due, and the policy chosen here decides what the new run does:
+
+coalesce
+    Run once more as soon as the current run finishes, however many runs came
+    due in the meantime.
+skip
+    Do nothing.  The next scheduled run will catch up.
+queue
+    Run after the current run finishes, once for every run that came due, up to
+    MAX_QUEUED_RUNS.
+"""
+import logging
+import threading
+from typing import Callable
+
+from monitor import metrics
+
+log = logging.getLogger(__name__)
+
+OVERLAP_POLICIES = ("coalesce", "skip", "queue")
+
+# The most runs the 'queue' policy keeps waiting behind a running job.
+MAX_QUEUED_RUNS = 3
+
+# APScheduler add_job() options for jobs wrapped in an OverlapGuard.  The guard
+# itself decides what overlapping runs do, so the scheduler must be allowed to
+# start a second instance; it returns straight away.  Runs missed while the
+# scheduler was busy are merged into one.
+SCHEDULER_JOB_OPTIONS = {"max_instances": 2, "coalesce": True}
+
+job_overlaps = metrics.counter(
+    "monitor_job_overlaps_total",
+    "Scheduled job runs that came due while an earlier run was going, by job "
+    "and action.",
+)
+
+
+class OverlapGuard:
+    """Wraps a job function so overlapping runs follow an overlap policy.
+
+    If a run raises, runs waiting behind it are dropped and the exception is
+    passed on to the scheduler.
+
+    Args:
+        fn: The job function.
+        policy: One of OVERLAP_POLICIES.
+        name: The job name used in logs and metrics.
+    """
+
+    def __init__(self, fn: Callable, policy: str = "coalesce", name="report_lag"):
+        if policy not in OVERLAP_POLICIES:
+            raise ValueError(f"unknown overlap policy {policy!r}")
+        self.fn = fn
+        self.policy = policy
+        self.name = name
+        self._lock = threading.Lock()
+        self._running = False
+        self._pending = 0
+
+    def __call__(self):
+        with self._lock:
+            if self._running:
+                self._overlap()
+                return
+            self._running = True
+
+        try:
+            while True:
+                self.fn()
+                with self._lock:
+                    if not self._pending:
+                        self._running = False
+                        return
+                    self._pending -= 1
+                log.info(f"starting a delayed run of job {self.name}")
+        except BaseException:
+            with self._lock:
+                self._running = False
+                self._pending = 0
+            raise
+
+    def _overlap(self):
+        if self.policy == "coalesce":
+            self._pending = 1
+            action = "coalesced"
+        elif self.policy == "queue" and self._pending < MAX_QUEUED_RUNS:
+            self._pending += 1
+            action = "queued"
+        else:
+            action = "skipped"
+        log.warning(f"job {self.name} is still running, new run {action}")
+        job_overlaps.labels(job=self.name, action=action).inc()
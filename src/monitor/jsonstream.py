@@ -0,0 +1,160 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Incremental decoding of JSON documents that arrive in chunks.
+
+The decoder only holds the token it is currently reading, so documents of any
+size can be scanned in bounded memory while they are still downloading.
+"""
+import codecs
+import json
+import re
+from typing import Iterable, Iterator, Tuple, Union
+
+# The position of a value inside a document: object keys and None for each
+# array level.  e.g. ("pushes", "1234", "changesets", None)
+Path = Tuple[Union[str, None], ...]
+
+_WHITESPACE = " \t\n\r"
+_WHITESPACE_RUN = re.compile(r"[ \t\n\r]+")
+_PUNCTUATION = "{}[]:,"
+_DELIMITERS = _WHITESPACE + _PUNCTUATION
+_SCALAR = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null")
+_LITERALS = {"true": True, "false": False, "null": None}
+
+# Sentinel token for a complete string; it is followed by the decoded value.
+_STRING = object()
+
+
+def iter_leaves(chunks: Iterable[Union[bytes, str]]) -> Iterator[Tuple[Path, object]]:
+    """Yield (path, value) for every scalar value in a JSON document.
+
+    Args:
+        chunks: The document as an iterable of UTF-8 bytes or str pieces, such as
+            requests.Response.iter_content().
+
+    Raises:
+        MalformedJSON if the document is not valid JSON.
+    """
+    path = []
+    # For each open container: True for objects, False for arrays.
+    in_object = []
+    expecting_key = False
+
+    for token, value in _tokens(chunks):
+        if token is _STRING and expecting_key:
+            path[-1] = value
+            expecting_key = False
+        elif token is _STRING or token is None:
+            yield tuple(path), value
+        elif token == "{":
+            in_object.append(True)
+            path.append(None)
+            expecting_key = True
+        elif token == "[":
+            in_object.append(False)
+            path.append(None)
+        elif token in "}]":
+            if not in_object or in_object.pop() != (token == "}"):
+                raise MalformedJSON(f"unexpected {token!r}")
+            path.pop()
+            expecting_key = False
+        elif token == ",":
+            expecting_key = bool(in_object) and in_object[-1]
+        elif token == ":":
+            if expecting_key or not in_object or not in_object[-1]:
+                raise MalformedJSON("unexpected ':'")
+
+    if in_object:
+        raise MalformedJSON("document ended inside a container")
+
+
+def _tokens(chunks):
+    """Yield (token, value) pairs from a chunked JSON document.
+
+    Punctuation is yielded as (char, None), strings as (_STRING, str) and other
+    scalars as (None, value).
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    final = False
+    chunks = iter(chunks)
+
+    while not final:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            final = True
+            chunk = b""
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk, final=final)
+        buf += chunk
+
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            char = buf[pos]
+            if char in _WHITESPACE:
+                pos = _WHITESPACE_RUN.match(buf, pos).end()
+            elif char in _PUNCTUATION:
+                yield char, None
+                pos += 1
+            elif char == '"':
+                close = _find_string_end(buf, pos + 1)
+                if close < 0:
+                    break
+                try:
+                    value, pos = json.decoder.scanstring(buf, pos + 1)
+                except ValueError as e:
+                    raise MalformedJSON(str(e)) from e
+                yield _STRING, value
+            else:
+                match = _SCALAR.match(buf, pos)
+                complete = match and (
+                    match.end() < end
+                    and buf[match.end()] in _DELIMITERS
+                    or match.end() == end
+                    and final
+                )
+                if not complete:
+                    if not final:
+                        # The value may continue in the next chunk.
+                        break
+                    raise MalformedJSON(f"unexpected data at {buf[pos:pos + 20]!r}")
+                text = match.group()
+                if text in _LITERALS:
+                    yield None, _LITERALS[text]
+                elif "." in text or "e" in text or "E" in text:
+                    yield None, float(text)
+                else:
+                    yield None, int(text)
+                pos = match.end()
+
+        buf = buf[pos:]
+
+    if buf.strip():
+        raise MalformedJSON("document ended inside a value")
+
+
+def _find_string_end(buf: str, start: int) -> int:
+    """Return the index of the quote closing a string, or -1 if it isn't in buf."""
+    pos = start
+    while True:
+        pos = buf.find('"', pos)
+        if pos < 0:
+            return -1
+        backslashes = 0
+        while buf[pos - 1 - backslashes] == "\\":
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return pos
+        pos += 1
+
+
+class Error(Exception):
+    """Generic error class for this module."""
+
+
+class MalformedJSON(Error):
+    """Raised if a streamed document is not valid JSON."""
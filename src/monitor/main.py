@@ -3,17 +3,32 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """The core routines for this program."""
 import logging
-from typing import List, NamedTuple
+from typing import Iterable, NamedTuple
 
+import requests
 from maya import MayaDT, MayaInterval, now
 
 from monitor.config import Mirror
-from monitor.hgmo import utc_hgwebdate
+from monitor.metrics import time_stage
 from monitor.util import requests_retry_session
-from monitor import hgmo
+from monitor import coordination, hgmo, metrics, phabricator, pushlog, tracing
 
 log = logging.getLogger(__name__)
 
+# The most pushes walk_mirror_replication_status() looks through, and the number
+# of pushes it reads from the pushlog at a time.
+MAX_WALK_PUSHES = 200
+WALK_CHUNK_SIZE = 20
+
+replication_lag = metrics.gauge(
+    "monitor_replication_lag_seconds",
+    "The most recently measured replication lag, by mirrored repository.",
+)
+commits_checked = metrics.counter(
+    "monitor_commits_checked_total",
+    "Commits checked for presence in a mirror, by repository and result.",
+)
+
 
 class ReplicationStatus(NamedTuple):
     """Represents a mirrored object's replication status: fresh or stale by X seconds.
@@ -43,16 +58,38 @@ def is_stale(dt_interval: MayaInterval) -> bool:
     return dt_interval.duration > 0
 
 
-def commit_in_mirror(mirror, commit_sha: str) -> bool:
-    """Is the given commit SHA present in the mirrored repository?"""
+def commit_in_mirror(mirror, commit_sha: str, session=None) -> bool:
+    """Is the given commit SHA present in the mirrored repository?
+
+    Args:
+        mirror: The mirror to check.
+        commit_sha: The changeset ID to look for.
+        session: Optional requests.Session to reuse.  Sharing one session between
+            many checks keeps connections to Phabricator open.
+    """
     # Example URL: https://phabricator.services.mozilla.com/rMOZILLACENTRAL7395257233f2fce9f80a7660cbfb2b91d379b28f
+    coordinator = coordination.current()
+    if coordinator is not None and coordinator.is_mirrored(mirror, commit_sha):
+        # Another instance already found it.  Commits never leave a mirror.
+        commits_checked.labels(repository=mirror.repo_callsign, result="shared").inc()
+        return True
+
     url = f"{mirror.url}/r{mirror.repo_callsign}{commit_sha}"
-    response = requests_retry_session().head(url)
+    session = session or requests_retry_session()
+    with time_stage("mirror_check"), tracing.span(
+        "mirror_check", repository=mirror.repo_callsign, changeset=commit_sha
+    ) as span:
+        response = session.head(url)
+        span.set_attribute("present", response.status_code == 200)
     if response.status_code == 404:
         # The commit is missing from Phabricator.
+        commits_checked.labels(repository=mirror.repo_callsign, result="missing").inc()
         return False
     elif response.status_code == 200:
         # The commit has been imported into Phabricator.
+        commits_checked.labels(repository=mirror.repo_callsign, result="present").inc()
+        if coordinator is not None:
+            coordinator.mark_mirrored(mirror, commit_sha)
         return True
     else:
         # Uh oh.
@@ -65,33 +102,46 @@ def commit_in_mirror(mirror, commit_sha: str) -> bool:
 
 
 def fetch_commit_publication_time(
-    source_repository_url: str, commit_sha: str
+    mirror: Mirror, commit_sha: str, session=None
 ) -> MayaDT:
-    """Return a commit's publication time in the source repo."""
-    changeset_json = hgmo.fetch_changeset(commit_sha, source_repository_url)
-    utc_epoch = utc_hgwebdate(changeset_json["pushdate"])
+    """Return a commit's publication time in the mirror's source repo."""
+    with time_stage("publication_time"), tracing.span(
+        "publication_time", changeset=commit_sha
+    ):
+        utc_epoch = pushlog.source_for_mirror(mirror).push_time(commit_sha, session)
     return MayaDT(utc_epoch)
 
 
 def determine_commit_replication_status(
-    mirror: Mirror, commit_sha: str
+    mirror: Mirror, commit_sha: str, session=None
 ) -> ReplicationStatus:
-    """Return the replication status of a single changeset."""
-    if not commit_in_mirror(mirror, commit_sha):
-        delay = stale_since(
-            fetch_commit_publication_time(mirror.source_repository_url, commit_sha)
-        )
+    """Return the replication status of a single changeset.
+
+    Args:
+        mirror: The mirror to check.
+        commit_sha: The changeset ID to check.
+        session: Optional requests.Session to reuse for every request made.
+    """
+    if not commit_in_mirror(mirror, commit_sha, session):
+        delay = stale_since(fetch_commit_publication_time(mirror, commit_sha, session))
         return ReplicationStatus.behind_by(delay.timedelta.seconds)
     else:
         return ReplicationStatus.fresh()
 
 
 def find_first_lagged_changset(
-    mirror: Mirror, changesets: List[str]
+    mirror: Mirror, changesets: Iterable[str]
 ) -> ReplicationStatus:
     """Return the replication delay of the first un-mirrored changeset in a commit list.
 
     If no commits are delayed it returns a lag of zero duration.
+
+    Args:
+        mirror: The mirror to check.
+        changesets: Changeset IDs in push order, such as a NodeList or the
+            generator from hgmo.iter_changesets_for_pushid().  The IDs are read one
+            at a time, so checking can start while the push is still downloading
+            and stops reading at the first lagged changeset.
     """
     for commit_sha in changesets:
         status = determine_commit_replication_status(mirror, commit_sha)
@@ -105,11 +155,144 @@ def find_first_lagged_changset(
         return ReplicationStatus.fresh()
 
 
+def probe_mirror_replication_status(mirror: Mirror, session=None) -> ReplicationStatus:
+    """Return a mirror's replication status using a fixed number of requests.
+
+    Phabricator is asked for the newest commit it has discovered in the mirror and
+    the pushlog for the push holding that commit and the push after it.  The lag
+    is the age of the oldest push that is not completely in the mirror.  The cost
+    does not depend on the size of the pushes or of the backlog, except that empty
+    pushes after the newest commit take one more pushlog request per
+    WALK_CHUNK_SIZE of them.
+
+    Args:
+        mirror: The mirror to check.
+        session: Optional requests.Session to reuse for every request made.
+
+    Raises:
+        phabricator.Error if Phabricator cannot say which commit is newest.
+        hgmo.NoSuchChangeset if the newest commit is not in the source repository.
+        requests.HTTPError for all other problems.
+    """
+    source = pushlog.source_for_mirror(mirror)
+    with tracing.span("repository_probe", repository=mirror.repo_callsign) as span:
+        latest = phabricator.latest_imported_commit(mirror, session)
+        pushid = source.pushid_for_changeset(latest, session)
+        tips = source.push_tips(pushid - 1, pushid + 1, session)
+        span.set_attribute("pushid", pushid)
+        span.set_attribute("last_pushid", tips.last_pushid)
+
+        # Empty pushes have nothing to mirror, so read past them to the next push
+        # with changesets.
+        pushes = list(tips.pushes)
+        end_id = pushid + 1
+        while end_id < tips.last_pushid and not any(
+            push.changesets for push in pushes if push.pushid > pushid
+        ):
+            start_id, end_id = end_id, min(tips.last_pushid, end_id + WALK_CHUNK_SIZE)
+            pushes.extend(source.push_tips(start_id, end_id, session).pushes)
+
+    for push in pushes:
+        if not push.changesets:
+            # An empty push has nothing to mirror.
+            continue
+        if push.pushid == pushid and latest in push.changesets:
+            # The latest commit is the last one in its push, so its push is done.
+            continue
+        log.info(
+            f"oldest push missing from {mirror.repo_callsign} is {push.pushid} "
+            f"(newest mirrored changeset {latest} is in push {pushid})"
+        )
+        return ReplicationStatus.behind_by(_seconds_since(push.date))
+    return ReplicationStatus.fresh()
+
+
+def walk_mirror_replication_status(
+    mirror: Mirror, session=None, max_pushes: int = MAX_WALK_PUSHES
+) -> ReplicationStatus:
+    """Return a mirror's replication status by checking push heads one at a time.
+
+    Starting from the newest push, the newest changeset of each push is looked up
+    in the mirror until one is found.  The lag is the age of the push after it.
+    This costs one mirror check per lagging push, up to max_pushes.
+
+    Args:
+        mirror: The mirror to check.
+        session: Optional requests.Session to reuse for every request made.
+        max_pushes: Give up looking for a mirrored push after this many pushes and
+            report the lag of the oldest push checked.
+    """
+    source = pushlog.source_for_mirror(mirror)
+    session = session or requests_retry_session()
+    end_id = source.push_tips(0, 0, session).last_pushid
+    stop_id = max(0, end_id - max_pushes)
+    oldest_missing = None
+
+    while end_id > stop_id:
+        start_id = max(stop_id, end_id - WALK_CHUNK_SIZE)
+        for push in reversed(source.push_tips(start_id, end_id, session).pushes):
+            if not push.changesets:
+                continue
+            if commit_in_mirror(mirror, push.changesets[0], session):
+                end_id = stop_id
+                break
+            oldest_missing = push
+        else:
+            end_id = start_id
+
+    if oldest_missing is None:
+        return ReplicationStatus.fresh()
+    return ReplicationStatus.behind_by(_seconds_since(oldest_missing.date))
+
+
+def determine_mirror_replication_status(
+    mirror: Mirror, session=None
+) -> ReplicationStatus:
+    """Return a mirror's replication status, probing the repository if possible.
+
+    Uses probe_mirror_replication_status() and falls back to
+    walk_mirror_replication_status() if the probe fails, for example because no
+    Phabricator API token is configured.
+    """
+    session = session or requests_retry_session()
+    try:
+        return probe_mirror_replication_status(mirror, session)
+    except (phabricator.Error, hgmo.Error, requests.RequestException) as e:
+        log.warning(f"repository probe failed, checking push heads instead: {e}")
+        return walk_mirror_replication_status(mirror, session)
+
+
+def _seconds_since(utc_epoch: int) -> int:
+    # timedelta.seconds wraps around every day; count the whole interval.
+    return int(stale_since(MayaDT(utc_epoch)).timedelta.total_seconds())
+
+
 def check_and_report_mirror_delay(changesets, mirror, reporting_function):
     """Check a mirrored repository's replication delay and report the result.
 
     Returns: ReplicationStatus for the mirror.
     """
     mirror_replication_status = find_first_lagged_changset(mirror, changesets)
-    reporting_function(mirror, mirror_replication_status)
+    report_replication_status(mirror, mirror_replication_status, reporting_function)
     return mirror_replication_status
+
+
+def report_replication_status(mirror, replication_status, reporting_function):
+    """Record a mirror's replication status and report it.
+
+    When instances are coordinated, only the mirror's elected reporter calls
+    `reporting_function`, with the worst status any instance measured recently.
+    See monitor.coordination.
+    """
+    replication_lag.labels(repository=mirror.repo_callsign).set(
+        replication_status.seconds_behind
+    )
+    coordinator = coordination.current()
+    if coordinator is not None:
+        replication_status = coordinator.reconcile(mirror, replication_status)
+        if replication_status is None:
+            return
+    with time_stage("reporting"), tracing.span(
+        "reporting", seconds_behind=replication_status.seconds_behind
+    ):
+        reporting_function(mirror, replication_status)
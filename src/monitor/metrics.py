@@ -0,0 +1,326 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+In-process metrics that can be scraped over HTTP.
+
+Metric values live in small per-series objects that are updated from the
+program's hot paths.  Each update takes a private lock for a single addition,
+so writers never wait on each other across series and never wait on a scrape
+for longer than one read.  Scrapes are served from a daemon thread and render
+the values in the Prometheus text exposition format.
+
+See https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List, Tuple
+
+log = logging.getLogger(__name__)
+
+# Bucket upper bounds, in seconds, for latency histograms.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """A monotonically increasing value."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def samples(self, name, labels):
+        yield name, labels, self._value
+
+    def snapshot(self):
+        return self._value
+
+    def restore(self, state):
+        self._value = state
+
+
+class Gauge:
+    """A value that can go up and down."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    @property
+    def value(self):
+        return self._value
+
+    def samples(self, name, labels):
+        yield name, labels, self._value
+
+    def snapshot(self):
+        return self._value
+
+    def restore(self, state):
+        self._value = state
+
+
+class Histogram:
+    """Counts observations into fixed, cumulative buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._upper_bounds = tuple(buckets)
+        self._counts = [0] * (len(self._upper_bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self._upper_bounds + (float("inf"),), counts):
+            cumulative += count
+            bucket_labels = labels + (("le", _format_value(bound)),)
+            yield f"{name}_bucket", bucket_labels, cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+    def snapshot(self):
+        with self._lock:
+            return self._upper_bounds, list(self._counts), self._sum
+
+    def restore(self, state):
+        _, counts, total = state
+        with self._lock:
+            self._counts = list(counts)
+            self._sum = total
+
+
+class MetricFamily:
+    """A named metric with one child series per unique set of label values."""
+
+    def __init__(self, name: str, kind: str, documentation: str, factory):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self._factory = factory
+        self._children = {}  # type: Dict[Tuple, object]
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        """Return the child series for the given label values, creating it if needed."""
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._factory())
+        return child
+
+    def children(self) -> List[Tuple[Tuple, object]]:
+        """Return (label key, series) pairs for every child series."""
+        return list(self._children.items())
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for key, child in list(self._children.items()):
+            for name, labels, value in child.samples(self.name, key):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    """A collection of metric families that are rendered together."""
+
+    def __init__(self):
+        self._families = {}  # type: Dict[str, MetricFamily]
+        self._lock = threading.Lock()
+
+    def register(self, name, kind, documentation, factory) -> MetricFamily:
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = MetricFamily(name, kind, documentation, factory)
+                self._families[name] = family
+            elif family.kind != kind:
+                raise ValueError(
+                    f"metric {name} is already registered as a {family.kind}"
+                )
+            return family
+
+    def get(self, name) -> MetricFamily:
+        return self._families[name]
+
+    def snapshot(self) -> List[Tuple]:
+        """Return the current value of every series in a picklable form.
+
+        See merge().
+        """
+        return [
+            (
+                family.name,
+                family.kind,
+                family.documentation,
+                [(key, child.snapshot()) for key, child in family.children()],
+            )
+            for family in list(self._families.values())
+        ]
+
+    def merge(self, snapshot: List[Tuple], **labels):
+        """Copy the series in another registry's snapshot into this one.
+
+        Every series gets the extra labels, which should name the snapshot's
+        source.  A later snapshot from the same source replaces the values of the
+        earlier one, so snapshots must hold totals, not changes.
+        """
+        for name, kind, documentation, series in snapshot:
+            if not series:
+                continue
+            factory = _FACTORIES[kind]
+            if kind == "histogram":
+                buckets = series[0][1][0]
+                factory = functools.partial(Histogram, buckets)
+            family = self.register(name, kind, documentation, factory)
+            for key, state in series:
+                family.labels(**dict(key, **labels)).restore(state)
+
+    def render(self) -> str:
+        lines = []
+        for family in list(self._families.values()):
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+_FACTORIES = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+
+def counter(name: str, documentation: str) -> MetricFamily:
+    """Register and return a counter metric family."""
+    return REGISTRY.register(name, "counter", documentation, Counter)
+
+
+def gauge(name: str, documentation: str) -> MetricFamily:
+    """Register and return a gauge metric family."""
+    return REGISTRY.register(name, "gauge", documentation, Gauge)
+
+
+def histogram(name: str, documentation: str, buckets=DEFAULT_BUCKETS) -> MetricFamily:
+    """Register and return a histogram metric family."""
+    return REGISTRY.register(
+        name, "histogram", documentation, lambda: Histogram(buckets)
+    )
+
+
+stage_duration = histogram(
+    "monitor_stage_duration_seconds", "Time spent in each processing stage."
+)
+
+
+@contextmanager
+def time_stage(stage: str):
+    """Record the time spent inside the with-block as a processing stage latency."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.labels(stage=stage).observe(time.perf_counter() - start)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("metrics scrape: " + format, *args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port: int, addr: str = "", registry: Registry = REGISTRY):
+    """Serve the registry's metrics from a background thread.
+
+    Args:
+        port: The TCP port to listen on.  Pass 0 to pick a free port.
+        addr: The address to bind to.  Defaults to all interfaces.
+        registry: The metrics registry to expose.
+
+    Returns:
+        The running HTTPServer.  Call .shutdown() on it to stop serving.
+    """
+    handler = type(
+        "MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": registry}
+    )
+    server = _ThreadingHTTPServer((addr, port), handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    )
+    thread.start()
+    log.info(f"serving metrics on port {server.server_address[1]}")
+    return server
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Compact storage for Mercurial changeset IDs.
+
+A 40 character hex changeset ID held as a Python str costs about 90 bytes.  The
+NodeList type stores the same IDs as raw 20 byte nodes in one contiguous buffer,
+plus a small open-addressing hash index for constant time membership tests.
+"""
+from array import array
+from typing import Iterable, Iterator, Union
+
+NODE_LENGTH = 20
+
+# Grow the hash index when it is more than this full.
+_MAX_LOAD = 0.5
+
+
+def to_binary(node: Union[str, bytes]) -> bytes:
+    """Return the 20 byte binary form of a changeset ID.
+
+    Args:
+        node: A 40 character hex string or 20 raw bytes.
+
+    Raises:
+        ValueError if the node is not a full-length changeset ID.
+    """
+    if isinstance(node, str):
+        if len(node) != NODE_LENGTH * 2:
+            raise ValueError(f"expected a 40 character changeset ID, got {node!r}")
+        return bytes.fromhex(node)
+    if len(node) != NODE_LENGTH:
+        raise ValueError(f"expected a 20 byte node, got {len(node)} bytes")
+    return bytes(node)
+
+
+class NodeList:
+    """An ordered, de-duplicating container of changeset IDs.
+
+    Items are accepted as hex strings or raw bytes and are returned as 40 character
+    hex strings, so a NodeList can be used anywhere a list of changeset ID strings
+    is expected.  Adding a node that is already present has no effect.
+    """
+
+    __slots__ = ("_nodes", "_index", "_mask")
+
+    def __init__(self, nodes: Iterable[Union[str, bytes]] = ()):
+        self._nodes = bytearray()
+        # Slot values are node positions + 1; zero marks an empty slot.
+        self._index = array("i", bytes(array("i").itemsize * 8))
+        self._mask = 7
+        for node in nodes:
+            self.append(node)
+
+    def append(self, node: Union[str, bytes]) -> bool:
+        """Add a node to the end of the list.
+
+        Returns:
+            True if the node was added, False if it was already present.
+        """
+        binary = to_binary(node)
+        slot = self._find_slot(binary)
+        if self._index[slot]:
+            return False
+        self._nodes += binary
+        self._index[slot] = len(self)
+        if len(self) > (self._mask + 1) * _MAX_LOAD:
+            self._grow()
+        return True
+
+    def extend(self, nodes: Iterable[Union[str, bytes]]):
+        for node in nodes:
+            self.append(node)
+
+    def binary(self, position: int) -> bytes:
+        """Return the raw 20 byte node at a position."""
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("NodeList index out of range")
+        start = position * NODE_LENGTH
+        return bytes(self._nodes[start : start + NODE_LENGTH])
+
+    def nbytes(self) -> int:
+        """Return the number of bytes used to store the nodes and their index."""
+        return len(self._nodes) + len(self._index) * self._index.itemsize
+
+    def __len__(self) -> int:
+        return len(self._nodes) // NODE_LENGTH
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return NodeList(self.binary(i) for i in range(*position.indices(len(self))))
+        return self.binary(position).hex()
+
+    def __iter__(self) -> Iterator[str]:
+        for start in range(0, len(self._nodes), NODE_LENGTH):
+            yield self._nodes[start : start + NODE_LENGTH].hex()
+
+    def __contains__(self, node) -> bool:
+        try:
+            binary = to_binary(node)
+        except (ValueError, TypeError):
+            return False
+        return bool(self._index[self._find_slot(binary)])
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, NodeList):
+            return self._nodes == other._nodes
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"NodeList({list(self)!r})"
+
+    def _find_slot(self, binary: bytes) -> int:
+        """Return the index slot holding a node, or the empty slot it belongs in."""
+        # Changeset IDs are SHA-1 hashes, so their leading bytes are already
+        # uniformly distributed.
+        slot = int.from_bytes(binary[:8], "little") & self._mask
+        while True:
+            position = self._index[slot]
+            if not position:
+                return slot
+            start = (position - 1) * NODE_LENGTH
+            if self._nodes[start : start + NODE_LENGTH] == binary:
+                return slot
+            slot = (slot + 1) & self._mask
+
+    def _grow(self):
+        size = (self._mask + 1) * 2
+        self._index = array("i", bytes(self._index.itemsize * size))
+        self._mask = size - 1
+        for position in range(len(self)):
+            slot = self._find_slot(self.binary(position))
+            self._index[slot] = position + 1
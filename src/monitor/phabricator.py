@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Functions for interacting with the Phabricator Conduit API.
+
+See https://secure.phabricator.com/book/phabricator/article/conduit/
+"""
+import logging
+
+from monitor import config
+from monitor.config import Mirror
+from monitor.metrics import time_stage
+from monitor.util import requests_retry_session
+
+log = logging.getLogger(__name__)
+
+
+def latest_imported_commit(mirror: Mirror, session=None) -> str:
+    """Return the ID of the commit most recently discovered in a mirror.
+
+    Commits are ordered by the order Phabricator found them in, not by their
+    commit dates, so this is the newest commit the mirror knows about even if it
+    was committed long ago.
+
+    Args:
+        mirror: The mirror to ask about.
+        session: Optional requests.Session to reuse.
+
+    Raises:
+        MissingAPIToken if PHABRICATOR_API_TOKEN is not set.
+        ConduitError if the API call fails.
+        NoImportedCommits if the mirror has no commits.
+        requests.HTTPError for all other problems.
+    """
+    api_token = config.phabricator_config_from_environ().PHABRICATOR_API_TOKEN
+    if not api_token:
+        raise MissingAPIToken("PHABRICATOR_API_TOKEN is not set")
+
+    # See https://phabricator.services.mozilla.com/conduit/method/diffusion.commit.search/
+    # The 'id' order vector sorts the newest commit record first.
+    params = {
+        "api.token": api_token,
+        "constraints[repositories][0]": f"r{mirror.repo_callsign}",
+        "order[0]": "id",
+        "limit": 1,
+    }
+    session = session or requests_retry_session()
+    with time_stage("conduit_call"):
+        response = session.post(
+            f"{mirror.url}/api/diffusion.commit.search", data=params
+        )
+    response.raise_for_status()
+    result = response.json()
+    if result.get("error_code"):
+        raise ConduitError(f"{result['error_code']}: {result.get('error_info')}")
+
+    commits = result["result"]["data"]
+    if not commits:
+        raise NoImportedCommits(
+            f"Phabricator has no commits for repository r{mirror.repo_callsign}"
+        )
+    commit = commits[0]["fields"]["identifier"]
+    log.debug(f"latest commit in r{mirror.repo_callsign} is {commit}")
+    return commit
+
+
+class Error(Exception):
+    """Generic error class for this module."""
+
+
+class MissingAPIToken(Error):
+    """Raised if no Conduit API token is configured."""
+
+
+class ConduitError(Error):
+    """Raised if a Conduit API call returns an error."""
+
+
+class NoImportedCommits(Error):
+    """Raised if a mirror has no commits yet."""
@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Read new pushes by polling the pushlog instead of listening to Pulse.
+
+The last pushid checked for each mirror is kept in a small JSON state file, or
+in the coordination store when several instances share the mirrors.  Each poll
+asks the pushlog only for the pushes after it, a batch at a time, and checks
+and reports them exactly like pushes announced over Pulse.  A push whose
+changesets are not all mirrored yet is retried on the next poll, the way an
+unacknowledged Pulse message is redelivered.  Polls that find nothing new are
+conditional requests, so they cost one small response.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from monitor import metrics, pushlog, tracing
+from monitor.config import Mirror
+from monitor.main import check_and_report_mirror_delay
+
+log = logging.getLogger(__name__)
+
+# The number of pushes requested from the pushlog at a time.
+DEFAULT_BATCH_SIZE = 50
+
+pushes_polled = metrics.counter(
+    "monitor_poll_pushes_total", "Pushes read by polling the pushlog, by outcome."
+)
+
+
+class PollState:
+    """The last checked pushid of each mirror, optionally saved.
+
+    Args:
+        path: The JSON file to load and save the state in.  If None, the state is
+            only kept in memory.
+        coordinator: A coordination.Coordinator whose shared store keeps the state
+            instead of the file, so that the next instance to own a mirror carries
+            on where the last one stopped.
+    """
+
+    def __init__(self, path=None, coordinator=None):
+        self.path = Path(path) if path else None
+        self.coordinator = coordinator
+        self._lock = threading.Lock()
+        self._state = {}  # type: Dict[str, Dict]
+        if coordinator is None and self.path is not None and self.path.exists():
+            self._state = json.loads(self.path.read_text())
+
+    def get(self, mirror: Mirror) -> Dict:
+        """Return a copy of a mirror's state: its last pushid and validators."""
+        if self.coordinator is not None:
+            return self.coordinator.poll_state(mirror)
+        with self._lock:
+            return dict(self._state.get(mirror.repo_callsign, {}))
+
+    def set(self, mirror: Mirror, last_pushid: int, validators: Dict = None):
+        """Record a mirror's last checked pushid and save the state."""
+        state = {"last_pushid": last_pushid, "validators": validators or {}}
+        if self.coordinator is not None:
+            self.coordinator.save_poll_state(mirror, state)
+            return
+        with self._lock:
+            self._state[mirror.repo_callsign] = state
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        # Write a new file and move it into place so a crash never leaves a
+        # truncated state file behind.
+        fd, name = tempfile.mkstemp(dir=str(self.path.parent), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._state, f)
+        os.replace(name, str(self.path))
+
+
+def poll_pushes(
+    mirror: Mirror,
+    state: PollState,
+    reporting_function: Callable,
+    empty_queue_callback: Optional[Callable] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    session=None,
+):
+    """Check and report every push made since the last poll.
+
+    The first poll of a mirror only records the newest pushid, so that the
+    monitor starts from the present instead of reading the whole pushlog.
+
+    Args:
+        mirror: The mirror to check.
+        state: Where the last checked pushid is kept.
+        reporting_function: Called with the mirror and its ReplicationStatus for
+            every push checked.
+        empty_queue_callback: Called if there were no new pushes.
+        batch_size: The number of pushes requested from the pushlog at a time.
+        session: Optional requests.Session to reuse.
+    """
+    source = pushlog.source_for_mirror(mirror)
+    saved = state.get(mirror)
+
+    if "last_pushid" not in saved:
+        last_pushid = source.push_tips(0, 0, session).last_pushid
+        log.info(f"starting to poll {mirror.repo_callsign} after pushid {last_pushid}")
+        state.set(mirror, last_pushid)
+        saved = state.get(mirror)
+
+    last_pushid = saved["last_pushid"]
+    validators = saved.get("validators")
+    checked = 0
+
+    while True:
+        end_id = last_pushid + batch_size
+        with tracing.start_trace("poll_pushlog", start_id=last_pushid, end_id=end_id):
+            batch = source.new_pushes(last_pushid, end_id, validators, session)
+        if batch is None:
+            log.debug(f"no new pushes after pushid {last_pushid}")
+            pushes_polled.labels(outcome="not_modified").inc()
+            break
+        if not batch.pushes:
+            # Keep the validators so the next poll of this range is conditional.
+            state.set(mirror, last_pushid, batch.validators)
+            break
+
+        for push in batch.pushes:
+            with tracing.start_trace(
+                "process_push", repository=mirror.repo_callsign, pushid=push.pushid
+            ):
+                log.info(f"processing pushid {push.pushid}")
+                status = check_and_report_mirror_delay(
+                    push.changesets, mirror, reporting_function
+                )
+            checked += 1
+            if status.is_stale:
+                # Check this push again on the next poll.
+                pushes_polled.labels(outcome="stale").inc()
+                return
+            pushes_polled.labels(outcome="fresh").inc()
+            last_pushid = push.pushid
+            state.set(mirror, last_pushid)
+
+        validators = None
+        if len(batch.pushes) < batch_size:
+            break
+
+    if not checked and empty_queue_callback:
+        empty_queue_callback()
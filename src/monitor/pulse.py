@@ -13,11 +13,18 @@ from functools import partial
 
 from kombu import Connection, Exchange, Queue
 
-from monitor.hgmo import changesets_for_pushid
+from monitor import cassette, deadline, metrics, pushlog, tracing
 from monitor.main import check_and_report_mirror_delay
 
 log = logging.getLogger(__name__)
 
+messages_processed = metrics.counter(
+    "monitor_pulse_messages_total", "Pulse messages processed, by outcome."
+)
+queue_depth = metrics.gauge(
+    "monitor_pulse_queue_depth", "Messages waiting in the Pulse queue, by queue name."
+)
+
 
 def noop(*args, **kwargs):
     return None
@@ -38,50 +45,96 @@ def process_push_message(body, message, no_send=False, extra_data=None):
     ack = noop if no_send else message.ack
 
     log.debug(f"received message: {message}")
-
-    payload = body["payload"]
-    log.debug(f"message payload: {payload}")
-
-    msgtype = payload["type"]
-    if msgtype != "changegroup.1":
-        log.info(f"skipped message of type {msgtype}")
-        ack()
-        return
-
-    pushlog_pushes = payload["data"]["pushlog_pushes"]
-    # The count should always be 0 or 1.
-    # See https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/notifications.html#changegroup-1
-    pcount = len(pushlog_pushes)
-    if pcount == 0:
-        log.info(f"skipped message with zero pushes")
-        ack()
-        return
-    elif pcount > 1:
-        # Raise this as a warning to draw attention.  According to
-        # https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/notifications.html#changegroup-1
-        # this isn't supposed to happen, and we should contact the hgpush
-        # service admin in #vcs on IRC.
-        log.warning(
-            f"skipped invalid message with multiple pushes (expected 0 or 1, got {pcount})"
+    cassette.record_message(body)
+
+    with tracing.start_trace("process_push_message") as trace_span:
+        payload = body["payload"]
+        log.debug(f"message payload: {payload}")
+
+        msgtype = payload["type"]
+        trace_span.set_attribute("message.type", msgtype)
+        if msgtype != "changegroup.1":
+            log.info(f"skipped message of type {msgtype}")
+            _count_message(trace_span, "skipped")
+            ack()
+            return
+
+        pushlog_pushes = payload["data"]["pushlog_pushes"]
+        # The count should always be 0 or 1.
+        # See https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/notifications.html#changegroup-1
+        pcount = len(pushlog_pushes)
+        if pcount == 0:
+            log.info(f"skipped message with zero pushes")
+            _count_message(trace_span, "skipped")
+            ack()
+            return
+        elif pcount > 1:
+            # Raise this as a warning to draw attention.  According to
+            # https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/notifications.html#changegroup-1
+            # this isn't supposed to happen, and we should contact the hgpush
+            # service admin in #vcs on IRC.
+            log.warning(
+                f"skipped invalid message with multiple pushes (expected 0 or 1, got {pcount})"
+            )
+            _count_message(trace_span, "invalid")
+            ack()
+            return
+
+        pushdata = pushlog_pushes.pop()
+
+        mirror = extra_data["mirror_config"]
+        reporting_fn = extra_data["reporting_function"]
+        trace_span.set_attribute("repository", mirror.repo_callsign)
+        trace_span.set_attribute("pushid", pushdata["pushid"])
+
+        source = pushlog.source_for_mirror(mirror)
+        # Changesets are checked while the pushlog data is still downloading.  The
+        # first stale changeset ends the check and closing the generator ends the
+        # download.
+        changesets = tracing.iter_in_span(
+            "pushlog_fetch",
+            _fetch_changesets(
+                source.iter_changesets_for_pushid(
+                    pushdata["pushid"], pushdata["push_json_url"]
+                ),
+                trace_span,
+            ),
+            pushid=pushdata["pushid"],
         )
+        with closing(changesets):
+            replication_status = check_and_report_mirror_delay(
+                changesets, mirror, reporting_fn
+            )
+
+        if replication_status.is_stale:
+            # Don't ack() the message, leave processing where it is for the next job
+            # run.
+            _count_message(trace_span, "stale")
+            raise HaltQueueProcessing()
+
+        # The changesets in this push have all been replicated.  Move on to the next
+        # push.
+        _count_message(trace_span, "fresh")
         ack()
-        return
 
-    pushdata = pushlog_pushes.pop()
 
-    mirror = extra_data["mirror_config"]
-    reporting_fn = extra_data["reporting_function"]
+def _fetch_changesets(changesets, trace_span):
+    """Yield changesets, timing the fetch and recording how many were read.
 
-    changesets = changesets_for_pushid(pushdata["pushid"], pushdata["push_json_url"])
-    replication_status = check_and_report_mirror_delay(changesets, mirror, reporting_fn)
+    The pushlog_fetch stage lasts until the generator is closed, so it includes
+    the mirror checks made while the download is in progress.
+    """
+    count = 0
+    with closing(changesets), metrics.time_stage("pushlog_fetch"):
+        for node in changesets:
+            count += 1
+            trace_span.set_attribute("changesets_read", count)
+            yield node
 
-    if replication_status.is_stale:
-        # Don't ack() the message, leave processing where it is for the next job run.
-        raise HaltQueueProcessing()
 
-    # The changesets in this push have all been replicated.  Move on to the next
-    # push.
-    ack()
+def _count_message(trace_span, outcome):
+    messages_processed.labels(outcome=outcome).inc()
+    trace_span.set_attribute("outcome", outcome)
 
 
 def run_pulse_listener(
@@ -99,9 +152,10 @@ def run_pulse_listener(
     connection = build_connection(password, username)
 
     # Connect and pass in our own low value for retries so the connection
-    # fails fast if there is a problem.
+    # fails fast if there is a problem.  The timeout is None, for no limit, unless
+    # the job has a deadline.
     connection.ensure_connection(
-        max_retries=1
+        max_retries=1, timeout=deadline.timeout()
     )  # Retries must be >=1 or it will retry forever.
 
     with closing(connection):
@@ -126,8 +180,10 @@ def run_pulse_listener(
         # Queue.declare() also declares the exchange, which isn't allowed by
         # the Pulse server. Use the low-level Queue API to only declare the
         # queue itself.
-        queue.queue_declare()
+        declared = queue.queue_declare()
         queue.queue_bind()
+        if declared is not None:
+            queue_depth.labels(queue=queue_name).set(declared.message_count)
 
         callback = partial(
             process_push_message, no_send=no_send, extra_data=worker_args
@@ -145,8 +201,10 @@ def run_pulse_listener(
 
             log.info("reading messages")
             try:
-                connection.drain_events(timeout=timeout)
+                connection.drain_events(timeout=deadline.timeout(float(timeout)))
             except socket.timeout:
+                # The wait may have been cut short by the job's deadline.
+                deadline.check()
                 log.info("message queue is empty")
                 if empty_queue_callback:
                     empty_queue_callback()
@@ -0,0 +1,331 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Sources of pushlog data for a mirrored repository.
+
+Pushlog data can be read over HTTP from hg.mozilla.org, or straight from the
+SQLite database kept by the pushlog extension in a local clone of the source
+repository.
+
+See https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/pushlog.html
+"""
+import functools
+import logging
+import sqlite3
+import threading
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from monitor import hgmo
+from monitor.config import Mirror
+from monitor.hgmo import Push, PushBatch, PushTips
+from monitor.metrics import time_stage
+from monitor.nodes import NodeList
+
+log = logging.getLogger(__name__)
+
+
+class HTTPPushlog:
+    """Reads pushlog data from a hgweb server such as hg.mozilla.org.
+
+    Args:
+        repo_url: The full URL of the source repository.
+    """
+
+    def __init__(self, repo_url: str):
+        self.repo_url = repo_url.rstrip("/")
+
+    def push_json_url(self, start_id: int, end_id: int) -> str:
+        """Return the json-pushes URL for pushes start_id (exclusive) to end_id."""
+        # See https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/pushlog.html#query-parameters
+        return (
+            f"{self.repo_url}/json-pushes?version=2&startID={start_id}&endID={end_id}"
+        )
+
+    def changesets_for_pushid(self, pushid: int, push_json_url: str = None) -> NodeList:
+        """Return the changeset IDs in a push.
+
+        Args:
+            pushid: The integer pushlog pushid we want information about.
+            push_json_url: Optional json-pushes URL for the push, such as the one
+                given in a hgpush message.  Built from the pushid if omitted.
+        """
+        url = push_json_url or self.push_json_url(pushid - 1, pushid)
+        return hgmo.changesets_for_pushid(pushid, url)
+
+    def iter_changesets_for_pushid(
+        self, pushid: int, push_json_url: str = None
+    ) -> Iterator[str]:
+        """Yield the changeset IDs in a push while the pushlog data downloads.
+
+        Closing the generator early stops the download.  Takes the same arguments
+        as changesets_for_pushid().
+        """
+        url = push_json_url or self.push_json_url(pushid - 1, pushid)
+        yield from hgmo.iter_changesets_for_pushid(pushid, url)
+
+    def pushes(self, start_id: int, end_id: int, session=None) -> Iterator[Push]:
+        """Yield the pushes after start_id up to and including end_id.
+
+        Pushes are decoded as the response arrives.
+
+        Args:
+            start_id: The pushid before the first push to return.
+            end_id: The last pushid to return.
+            session: Optional requests.Session to reuse.
+        """
+        return hgmo.stream_pushes(self.push_json_url(start_id, end_id), session)
+
+    def push_time(self, changeset: str, session=None) -> int:
+        """Return the UTC Unix time a changeset was pushed to the repository.
+
+        Args:
+            changeset: The changeset ID to look up.
+            session: Optional requests.Session to reuse.
+        """
+        changeset_json = hgmo.fetch_changeset(changeset, self.repo_url, session)
+        return hgmo.utc_hgwebdate(changeset_json["pushdate"])
+
+    def new_pushes(
+        self, start_id: int, end_id: int, validators: Dict = None, session=None
+    ) -> Optional[PushBatch]:
+        """Return the pushes after start_id up to end_id unless nothing has changed.
+
+        Args:
+            start_id: The pushid before the first push to return.
+            end_id: The last pushid to return.
+            validators: The validators of the PushBatch last returned for the same
+                range, to make a conditional request.
+            session: Optional requests.Session to reuse.
+
+        Returns:
+            A PushBatch, or None if the range is unchanged since `validators` were
+            issued.
+        """
+        url = self.push_json_url(start_id, end_id)
+        return hgmo.fetch_pushes(url, validators, session)
+
+    def push_tips(self, start_id: int, end_id: int, session=None) -> PushTips:
+        """Return the newest changeset of the pushes after start_id up to end_id.
+
+        Also returns the repository's last pushid.  The response size does not
+        depend on the size of the pushes.
+
+        Args:
+            start_id: The pushid before the first push to return.
+            end_id: The last pushid to return.
+            session: Optional requests.Session to reuse.
+        """
+        url = self.push_json_url(start_id, end_id) + "&tipsonly=1"
+        return hgmo.fetch_push_tips(url, session)
+
+    def pushid_for_changeset(self, changeset: str, session=None) -> int:
+        """Return the pushid of the push that introduced a changeset.
+
+        Args:
+            changeset: The changeset ID to look up.
+            session: Optional requests.Session to reuse.
+        """
+        return hgmo.fetch_changeset(changeset, self.repo_url, session)["pushid"]
+
+
+class LocalPushlog:
+    """Reads pushlog data from a local clone's pushlog2.db SQLite database.
+
+    The database is opened read-only, so the clone can keep receiving pushes while
+    it is being read.
+
+    Args:
+        repo_path: The path to the root of a local Mercurial repository that has the
+            pushlog extension enabled.
+
+    Raises:
+        NoPushlogDatabase if the repository has no pushlog database.
+    """
+
+    def __init__(self, repo_path: str):
+        self.db_path = Path(repo_path).resolve() / ".hg" / "pushlog2.db"
+        if not self.db_path.is_file():
+            raise NoPushlogDatabase(f"No pushlog database found at {self.db_path}")
+        # sqlite3 connections may only be used by the thread that created them.
+        self._local = threading.local()
+
+    def changesets_for_pushid(self, pushid: int, push_json_url: str = None) -> NodeList:
+        """Return the changeset IDs in a push, oldest first.
+
+        Args:
+            pushid: The integer pushlog pushid we want information about.
+            push_json_url: Ignored.  Accepted for compatibility with HTTPPushlog.
+
+        Returns:
+            A NodeList of the push's changeset IDs.  It is empty if the push has
+            no changesets.
+
+        Raises:
+            hgmo.NoSuchPush if the push does not exist.
+        """
+        with time_stage("pushlog_fetch"):
+            changesets = NodeList(self.iter_changesets_for_pushid(pushid))
+        log.info(f"got {len(changesets)} changesets for pushid {pushid}")
+        return changesets
+
+    def iter_changesets_for_pushid(
+        self, pushid: int, push_json_url: str = None
+    ) -> Iterator[str]:
+        """Yield the changeset IDs in a push, oldest first.
+
+        Takes the same arguments as changesets_for_pushid().
+
+        Raises:
+            hgmo.NoSuchPush if the push does not exist.
+        """
+        log.info(f"processing pushid {pushid}")
+        connection = self._connection()
+        # A push can have no changesets, so look for the push itself.
+        row = connection.execute(
+            "SELECT 1 FROM pushlog WHERE id = ?", (pushid,)
+        ).fetchone()
+        if row is None:
+            raise hgmo.NoSuchPush(f"The pushlog at {self.db_path} has no push {pushid}")
+        rows = connection.execute(
+            "SELECT node FROM changesets WHERE pushid = ? ORDER BY rev", (pushid,)
+        )
+        for (node,) in rows:
+            yield node
+
+    def pushes(self, start_id: int, end_id: int, session=None) -> Iterator[Push]:
+        """Yield the pushes after start_id up to and including end_id, in order.
+
+        Args:
+            start_id: The pushid before the first push to return.
+            end_id: The last pushid to return.
+            session: Ignored.  Accepted for compatibility with HTTPPushlog.
+        """
+        rows = self._connection().execute(
+            "SELECT pushlog.id, pushlog.date, changesets.node FROM pushlog "
+            "LEFT JOIN changesets ON changesets.pushid = pushlog.id "
+            "WHERE pushlog.id > ? AND pushlog.id <= ? "
+            "ORDER BY pushlog.id, changesets.rev",
+            (start_id, end_id),
+        )
+        for (pushid, date), push_rows in groupby(rows, key=lambda row: row[:2]):
+            changesets = NodeList(node for _, _, node in push_rows if node)
+            yield Push(pushid, date, changesets)
+
+    def push_time(self, changeset: str, session=None) -> int:
+        """Return the UTC Unix time a changeset was pushed to the repository.
+
+        Args:
+            changeset: The changeset ID to look up.
+            session: Ignored.  Accepted for compatibility with HTTPPushlog.
+
+        Raises:
+            hgmo.NoSuchChangeset if the changeset is not in the pushlog.
+        """
+        # The pushlog stores push dates as UTC Unix times.  The lookup uses the
+        # unique index on changesets.node.
+        row = (
+            self._connection()
+            .execute(
+                "SELECT pushlog.date FROM changesets "
+                "JOIN pushlog ON pushlog.id = changesets.pushid "
+                "WHERE changesets.node = ?",
+                (changeset,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise hgmo.NoSuchChangeset(
+                f"The changeset {changeset} does not exist in the pushlog at {self.db_path}"
+            )
+        return row[0]
+
+    def new_pushes(
+        self, start_id: int, end_id: int, validators: Dict = None, session=None
+    ) -> Optional[PushBatch]:
+        """Return the pushes after start_id up to end_id.
+
+        Args:
+            start_id: The pushid before the first push to return.
+            end_id: The last pushid to return.
+            validators: Ignored.  Accepted for compatibility with HTTPPushlog.
+            session: Ignored.  Accepted for compatibility with HTTPPushlog.
+        """
+        return PushBatch(list(self.pushes(start_id, end_id)), {})
+
+    def push_tips(self, start_id: int, end_id: int, session=None) -> PushTips:
+        """Return the newest changeset of the pushes after start_id up to end_id.
+
+        Also returns the repository's last pushid.
+
+        Args:
+            start_id: The pushid before the first push to return.
+            end_id: The last pushid to return.
+            session: Ignored.  Accepted for compatibility with HTTPPushlog.
+        """
+        connection = self._connection()
+        rows = connection.execute(
+            "SELECT pushlog.id, pushlog.date, "
+            "(SELECT node FROM changesets WHERE changesets.pushid = pushlog.id "
+            "ORDER BY rev DESC LIMIT 1) "
+            "FROM pushlog WHERE pushlog.id > ? AND pushlog.id <= ? "
+            "ORDER BY pushlog.id",
+            (start_id, end_id),
+        )
+        pushes = [
+            Push(pushid, date, NodeList([node] if node else []))
+            for pushid, date, node in rows
+        ]
+        (last_pushid,) = connection.execute("SELECT MAX(id) FROM pushlog").fetchone()
+        return PushTips(pushes, last_pushid or 0)
+
+    def pushid_for_changeset(self, changeset: str, session=None) -> int:
+        """Return the pushid of the push that introduced a changeset.
+
+        Args:
+            changeset: The changeset ID to look up.
+            session: Ignored.  Accepted for compatibility with HTTPPushlog.
+
+        Raises:
+            hgmo.NoSuchChangeset if the changeset is not in the pushlog.
+        """
+        row = (
+            self._connection()
+            .execute("SELECT pushid FROM changesets WHERE node = ?", (changeset,))
+            .fetchone()
+        )
+        if row is None:
+            raise hgmo.NoSuchChangeset(
+                f"The changeset {changeset} does not exist in the pushlog at {self.db_path}"
+            )
+        return row[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"{self.db_path.as_uri()}?mode=ro", uri=True)
+            self._local.connection = connection
+        return connection
+
+
+@functools.lru_cache(maxsize=None)
+def source_for_mirror(mirror: Mirror):
+    """Return the pushlog source configured for a mirror's source repository.
+
+    Mirrors with a local_repository_path read the pushlog database from that
+    clone.  All others read from the source repository URL over HTTP.
+    """
+    if mirror.local_repository_path:
+        log.debug(f"reading pushlog data from {mirror.local_repository_path}")
+        return LocalPushlog(mirror.local_repository_path)
+    return HTTPPushlog(mirror.source_repository_url)
+
+
+class Error(Exception):
+    """Generic error class for this module."""
+
+
+class NoPushlogDatabase(Error):
+    """Raised if a local repository does not have a pushlog database."""
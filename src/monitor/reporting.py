@@ -2,13 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """Functions for reporting this program's results"""
+import json
 import logging
 
 import click
 from datadog import statsd
 
+from monitor.batch import NodeResult
 from monitor.config import Mirror
-from monitor.main import ReplicationStatus
+from monitor.main import ReplicationStatus, report_replication_status
 
 log = logging.getLogger(__name__)
 
@@ -25,6 +27,24 @@ def print_replication_lag(_, replication_status: ReplicationStatus):
     click.echo(report)
 
 
+def print_node_result(result: NodeResult, fmt: str = "table"):
+    """Print one changeset's replication lag as a table row or a JSON line."""
+    if fmt == "jsonl":
+        record = {"node": result.node, "error": result.error}
+        if result.status is not None:
+            record.update(result.status._asdict())
+        click.echo(json.dumps(record))
+        return
+
+    if result.error is not None:
+        report = click.style(f"error: {result.error}", fg="red", bold=True)
+    elif result.status.is_stale:
+        report = click.style(str(result.status.seconds_behind), fg="yellow", bold=True)
+    else:
+        report = click.style("0", fg="green", bold=True)
+    click.echo(f"{result.node:<40}  {report}")
+
+
 def report_to_statsd(mirror: Mirror, replication_status: ReplicationStatus):
     repo_label = mirror.repo_callsign.lower()
     log.info(
@@ -38,5 +58,12 @@ def report_to_statsd(mirror: Mirror, replication_status: ReplicationStatus):
     )
 
 
+def report_overrun_to_statsd(job_name: str):
+    """Count a job run that was stopped because it used up its time budget."""
+    metric = f"phabricator.monitor.{job_name.lower()}.overruns"
+    log.info(f"reporting overrun: {metric}")
+    statsd.increment(metric)
+
+
 def report_all_caught_up_to_statsd(mirror: Mirror):
-    report_to_statsd(mirror, ReplicationStatus.fresh())
+    report_replication_status(mirror, ReplicationStatus.fresh(), report_to_statsd)
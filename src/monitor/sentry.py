@@ -2,22 +2,188 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
-Sentry client instance.
+Sentry error reporting.
+
+Exceptions are handed off to a background thread for delivery so that a slow or
+unreachable Sentry server never stalls the job that raised them.
 """
+import atexit
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
 from functools import wraps
 from typing import Callable
 
 from raven import Client
 
-client = Client(
-    # DSN is automatically pulled from os.environ if present
-    # dsn='https://<key>:<secret>@sentry.io/<project>',
-    include_paths=[__name__.split(".", 1)[0]],
-    # The release name should come from the HEROKU_SLUG_COMMIT environment var.
-    # release=fetch_git_sha(os.path.dirname(__file__)),
-    processors=("raven.processors.SanitizePasswordsProcessor",),
+from monitor import metrics
+
+log = logging.getLogger(__name__)
+
+# The most error events that may wait for delivery.  Newer events are dropped
+# when the buffer is full.
+MAX_QUEUED_EVENTS = 100
+
+# Identical exceptions raised within this many seconds of each other are only
+# sent once.
+DEDUPLICATION_WINDOW_SECONDS = 300
+
+# How long to wait for queued events to be sent when the program exits.
+EXIT_FLUSH_TIMEOUT_SECONDS = 5
+
+events_sent = metrics.counter(
+    "monitor_sentry_events_sent_total", "Error events delivered to Sentry."
+)
+events_dropped = metrics.counter(
+    "monitor_sentry_events_dropped_total", "Error events not sent to Sentry, by reason."
 )
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> Client:
+    """Return the shared Sentry client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client(
+                # DSN is automatically pulled from os.environ if present
+                # dsn='https://<key>:<secret>@sentry.io/<project>',
+                include_paths=[__name__.split(".", 1)[0]],
+                # The release name should come from the HEROKU_SLUG_COMMIT environment var.
+                # release=fetch_git_sha(os.path.dirname(__file__)),
+                processors=("raven.processors.SanitizePasswordsProcessor",),
+            )
+        return _client
+
+
+class BackgroundReporter:
+    """Sends exceptions to Sentry from a background thread.
+
+    Args:
+        client_factory: A callable returning the raven Client to send events with.
+            It is not called until the first event is sent.
+        max_queued: The maximum number of events waiting to be sent.
+        dedup_window: Seconds during which repeats of an exception are dropped.
+        sample_rate: The fraction of events to send, between 0.0 and 1.0.
+    """
+
+    def __init__(
+        self,
+        client_factory=get_client,
+        max_queued=MAX_QUEUED_EVENTS,
+        dedup_window=DEDUPLICATION_WINDOW_SECONDS,
+        sample_rate=1.0,
+    ):
+        self.client_factory = client_factory
+        self.dedup_window = dedup_window
+        self.sample_rate = sample_rate
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def report(self, exc_info=None) -> bool:
+        """Queue an exception for delivery to Sentry.
+
+        Args:
+            exc_info: A (type, value, traceback) tuple.  Defaults to the exception
+                currently being handled.
+
+        Returns:
+            True if the event was queued, False if it was dropped.
+        """
+        exc_info = exc_info or sys.exc_info()
+
+        if self._is_duplicate(exc_info):
+            events_dropped.labels(reason="duplicate").inc()
+            return False
+
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            events_dropped.labels(reason="sampled").inc()
+            return False
+
+        try:
+            self._queue.put_nowait(exc_info)
+        except queue.Full:
+            log.warning("error report buffer is full, dropping event")
+            events_dropped.labels(reason="buffer_full").inc()
+            return False
+
+        self._ensure_worker()
+        return True
+
+    def flush(self, timeout=None) -> bool:
+        """Wait for queued events to be sent.
+
+        Returns:
+            True if the queue drained before the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _is_duplicate(self, exc_info) -> bool:
+        fingerprint = exception_fingerprint(exc_info)
+        now = time.monotonic()
+        with self._lock:
+            last_seen = self._last_seen.get(fingerprint)
+            if last_seen is not None and now - last_seen < self.dedup_window:
+                return True
+            self._last_seen = {
+                key: seen
+                for key, seen in self._last_seen.items()
+                if now - seen < self.dedup_window
+            }
+            self._last_seen[fingerprint] = now
+            return False
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="sentry-reporter", daemon=True
+                )
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            exc_info = self._queue.get()
+            try:
+                self.client_factory().captureException(exc_info=exc_info)
+                events_sent.labels().inc()
+            except Exception:
+                log.exception("failed to send an error report to Sentry")
+                events_dropped.labels(reason="send_failed").inc()
+            finally:
+                self._queue.task_done()
+
+
+def exception_fingerprint(exc_info) -> tuple:
+    """Return a key that is equal for repeats of the same exception.
+
+    Exceptions are considered the same if they have the same type and message and
+    were raised from the same line of code.
+    """
+    exc_type, exc_value, tb = exc_info
+    frames = traceback.extract_tb(tb) if tb is not None else []
+    origin = (frames[-1].filename, frames[-1].lineno) if frames else None
+    return exc_type, str(exc_value), origin
+
+
+reporter = BackgroundReporter()
+atexit.register(lambda: reporter.flush(EXIT_FLUSH_TIMEOUT_SECONDS))
+
 
 def record_exceptions(f: Callable, ignored_exceptions=None):
     """Decorator that watches for exceptions and sends them to Sentry.
@@ -25,8 +191,9 @@ def record_exceptions(f: Callable, ignored_exceptions=None):
     This can be used for frameworks where you do not have access to the full exception
     while it is being raised, such as APScheduler.  Simply decorate the function that
     will be executed by the framework. The decorator will capture any exceptions it
-    raises and send them to Sentry while still allowing the APScheduler code to handle
-    them as it sees fit (which usually means turning them into out-of-stack job events).
+    raises and queue them for Sentry while still allowing the APScheduler code to
+    handle them as it sees fit (which usually means turning them into out-of-stack job
+    events).  Events are sent by a background thread; see BackgroundReporter.
 
     Args:
         f: The function to decorate.
@@ -45,7 +212,7 @@ def record_exceptions(f: Callable, ignored_exceptions=None):
                 # Ignore the exception, let the surrounding framework handle it.
                 raise
             else:
-                client.captureException()
+                reporter.report(sys.exc_info())
                 raise
 
     return wrapper
@@ -0,0 +1,292 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Run the lag monitor for many mirrors across a pool of worker processes.
+
+Each worker process listens to the Pulse queues of the mirrors assigned to it,
+checking every mirror on its own scheduler thread so a slow repository never
+delays the others.  Workers send their replication measurements back to the
+supervisor, which reports them all through one reporting function and restarts
+any worker that dies.  Workers also send snapshots of their metrics, which the
+supervisor serves with a `worker` label alongside its own.
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Callable, List, NamedTuple
+
+import datadog
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from monitor import coordination, deadline, jobs, metrics, reporting
+from monitor.config import Shard
+from monitor.main import ReplicationStatus, replication_lag, report_replication_status
+from monitor.pulse import run_pulse_listener
+from monitor.sentry import record_exceptions
+
+log = logging.getLogger(__name__)
+
+# Minutes between checks of each mirror.
+CHECK_INTERVAL_MINUTES = 5
+
+# Restart delays for crashed workers double from the first value up to the second.
+MIN_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+
+# A worker that stays up this long is considered healthy again.
+HEALTHY_UPTIME = 600.0
+
+# Seconds between the metrics snapshots each worker sends to the supervisor.
+METRICS_INTERVAL_SECONDS = 15
+
+worker_restarts = metrics.counter(
+    "monitor_worker_restarts_total", "Worker processes restarted, by worker."
+)
+workers_alive = metrics.gauge(
+    "monitor_workers_alive", "Worker processes currently running."
+)
+
+
+class MetricsSnapshot(NamedTuple):
+    """A worker's metrics, sent over the results queue; see send_metrics()."""
+
+    worker: str
+    series: list
+
+
+def send_metrics(results):
+    """Send a snapshot of this worker process's metrics to the supervisor.
+
+    The replication lag is left out: the supervisor sets it from the results it
+    receives, and a copy with a worker label would export each mirror twice.
+    """
+    series = [
+        family
+        for family in metrics.REGISTRY.snapshot()
+        if family[0] != replication_lag.name
+    ]
+    results.put(MetricsSnapshot(_worker_id(), series))
+
+
+def _worker_id() -> str:
+    """Return the supervisor's number for this worker process."""
+    return multiprocessing.current_process().name.rsplit("-", 1)[-1]
+
+
+def assign_shards(shards: List[Shard], workers: int) -> List[List[Shard]]:
+    """Spread shards over a number of workers as evenly as possible."""
+    workers = max(1, min(workers, len(shards)))
+    return [shards[i::workers] for i in range(workers)]
+
+
+def default_worker_count(shards: List[Shard]) -> int:
+    """Return one worker per shard, up to the number of CPU cores."""
+    return max(1, min(len(shards), os.cpu_count() or 1))
+
+
+def worker_main(
+    shards: List[Shard], pulse_config, no_send, job_timeout, overlap, results, log_level
+):
+    """Monitor a set of shards, sending measurements to the supervisor.
+
+    This is the entry point of each worker process.
+
+    Args:
+        shards: The shards this worker is responsible for.
+        pulse_config: The Pulse settings from config.pulse_config_from_environ().
+        no_send: Do not drain any queues.
+        job_timeout: The time budget in seconds for each check, or 0 for none.
+        overlap: One of jobs.OVERLAP_POLICIES.
+        results: A multiprocessing queue for (Mirror, ReplicationStatus) tuples
+            and MetricsSnapshots.
+        log_level: The logging level for this process.
+    """
+    logging.basicConfig(level=log_level)
+    # Every worker is an instance of its own, taking leases for its shards.
+    coordination.install(coordination.from_environ(f"worker-{_worker_id()}"))
+
+    def send_result(mirror, replication_status):
+        results.put((mirror, replication_status))
+
+    if no_send:
+        overrun_function = None
+    else:
+        # Overruns are counted from here; measurements go through the supervisor.
+        datadog.initialize()
+        overrun_function = reporting.report_overrun_to_statsd
+
+    # Each shard can have one running and one overlapping run; see OverlapGuard.
+    sched = BlockingScheduler(
+        executors={"default": {"type": "threadpool", "max_workers": 2 * len(shards)}}
+    )
+
+    for shard in shards:
+        if no_send:
+            empty_queue_callback = None
+        else:
+            empty_queue_callback = functools.partial(
+                report_replication_status,
+                shard.mirror,
+                ReplicationStatus.fresh(),
+                send_result,
+            )
+        job_name = f"report_lag_{shard.mirror.repo_callsign}"
+
+        @record_exceptions
+        @deadline.with_budget(
+            job_timeout, name=job_name, overrun_function=overrun_function
+        )
+        def job(shard=shard, empty_queue_callback=empty_queue_callback):
+            run_pulse_listener(
+                pulse_config.PULSE_USERNAME,
+                pulse_config.PULSE_PASSWORD,
+                pulse_config.PULSE_EXCHANGE,
+                shard.queue_name,
+                shard.routing_key,
+                pulse_config.PULSE_QUEUE_READ_TIMEOUT,
+                no_send,
+                worker_args=dict(
+                    mirror_config=shard.mirror, reporting_function=send_result
+                ),
+                empty_queue_callback=empty_queue_callback,
+            )
+
+        guarded_job = jobs.OverlapGuard(job, overlap, name=job_name)
+
+        # Run once right away, then run at intervals
+        sched.add_job(guarded_job, **jobs.SCHEDULER_JOB_OPTIONS)
+        sched.add_job(
+            guarded_job,
+            "interval",
+            minutes=CHECK_INTERVAL_MINUTES,
+            **jobs.SCHEDULER_JOB_OPTIONS,
+        )
+
+    sched.add_job(
+        functools.partial(send_metrics, results),
+        "interval",
+        seconds=METRICS_INTERVAL_SECONDS,
+        **jobs.SCHEDULER_JOB_OPTIONS,
+    )
+
+    # This does not return
+    sched.start()
+
+
+class Supervisor:
+    """Starts, watches and restarts a pool of worker processes.
+
+    Args:
+        assignments: The shards for each worker, see assign_shards().
+        worker_args: Extra positional arguments for the target after the shards
+            and before the results queue and log level.
+        reporting_function: Called in the supervisor process with each
+            (Mirror, ReplicationStatus) sent by a worker.
+        target: The worker entry point.
+        log_level: The logging level for worker processes.
+    """
+
+    def __init__(
+        self,
+        assignments: List[List[Shard]],
+        worker_args: tuple,
+        reporting_function: Callable,
+        target: Callable = worker_main,
+        log_level=logging.INFO,
+    ):
+        self.assignments = assignments
+        self.worker_args = worker_args
+        self.reporting_function = reporting_function
+        self.target = target
+        self.log_level = log_level
+        self._context = multiprocessing.get_context("spawn")
+        self.results = self._context.Queue()
+        self.processes = [None] * len(assignments)
+        self._started_at = [0.0] * len(assignments)
+        self._restart_delay = [MIN_RESTART_DELAY] * len(assignments)
+        self._restart_at = [0.0] * len(assignments)
+
+    def start(self):
+        for worker_id in range(len(self.assignments)):
+            self._start_worker(worker_id)
+
+    def stop(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=5)
+
+    def run(self):
+        """Supervise the workers until interrupted."""
+        self.start()
+        try:
+            while True:
+                self.poll(timeout=1.0)
+        finally:
+            self.stop()
+
+    def poll(self, timeout: float):
+        """Report worker results for up to `timeout` seconds, then check on workers."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.results.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if isinstance(item, MetricsSnapshot):
+                metrics.REGISTRY.merge(item.series, worker=item.worker)
+                continue
+            mirror, replication_status = item
+            replication_lag.labels(repository=mirror.repo_callsign).set(
+                replication_status.seconds_behind
+            )
+            self.reporting_function(mirror, replication_status)
+        self.check_workers()
+
+    def check_workers(self):
+        """Restart any worker that has exited, backing off if it keeps crashing."""
+        now = time.monotonic()
+        for worker_id, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                if now - self._started_at[worker_id] > HEALTHY_UPTIME:
+                    self._restart_delay[worker_id] = MIN_RESTART_DELAY
+                log.error(
+                    f"worker {worker_id} exited with code {process.exitcode}, "
+                    f"restarting in {self._restart_delay[worker_id]:.0f}s"
+                )
+                self._restart_at[worker_id] = now + self._restart_delay[worker_id]
+                self._restart_delay[worker_id] = min(
+                    MAX_RESTART_DELAY, self._restart_delay[worker_id] * 2
+                )
+                self.processes[worker_id] = None
+            if now >= self._restart_at[worker_id]:
+                worker_restarts.labels(worker=worker_id).inc()
+                self._start_worker(worker_id)
+        workers_alive.labels().set(
+            sum(1 for p in self.processes if p is not None and p.is_alive())
+        )
+
+    def _start_worker(self, worker_id: int):
+        shards = self.assignments[worker_id]
+        process = self._context.Process(
+            target=self.target,
+            args=(shards,) + tuple(self.worker_args) + (self.results, self.log_level),
+            name=f"monitor-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+        callsigns = ", ".join(shard.mirror.repo_callsign for shard in shards)
+        log.info(f"started worker {worker_id} (pid {process.pid}) for {callsigns}")
@@ -0,0 +1,233 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Lightweight in-process tracing.
+
+Each unit of work, such as one Pulse message, can start a trace with a root span.
+Work done on the same thread inside that span opens child spans, which record
+their name, timing, attributes and outcome.  Finished spans are written one per
+line to a size-rotated JSON-lines file using the field names of the OpenTelemetry
+span data model, so they can be loaded by standard trace tooling.
+
+Tracing is off unless TRACE_FILE is set.  Whether a trace is recorded is decided
+once, when its root span starts, using TRACE_SAMPLE_RATE.  When tracing is off or
+a trace was not sampled, opening a span costs one thread-local lookup.
+"""
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+from typing import Dict, Iterable, Iterator, Optional
+
+from monitor import config
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Tracer:
+    """Samples traces and writes finished spans to a rotating file.
+
+    Args:
+        path: The file to write spans to.
+        sample_rate: The fraction of traces to record, from 0.0 to 1.0.
+        max_bytes: Rotate the file when it grows past this size.
+        backup_count: The number of rotated files to keep.
+    """
+
+    def __init__(self, path, sample_rate=1.0, max_bytes=0, backup_count=0):
+        self.sample_rate = sample_rate
+        self._handler = RotatingFileHandler(
+            str(path), maxBytes=max_bytes, backupCount=backup_count
+        )
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+        # A private logger, outside the logging hierarchy, gives us thread-safe
+        # writes and rotation without spans showing up in the application log.
+        self._logger = logging.Logger(__name__ + ".spans")
+        self._logger.addHandler(self._handler)
+
+    def sample(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def export(self, record: Dict):
+        self._logger.info(json.dumps(record, default=str))
+
+    def close(self):
+        self._handler.close()
+
+
+class Span:
+    """A timed operation within a trace.  Use it as a context manager.
+
+    Exceptions raised inside the with-block mark the span as failed and are
+    re-raised.
+    """
+
+    def __init__(
+        self,
+        tracer: Tracer,
+        name: str,
+        trace_id: str,
+        parent_span_id: Optional[str],
+        attributes: Dict,
+    ):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent_span_id
+        self.attributes = attributes
+        self._parent = None
+        self._start_time = 0.0
+        self._start_counter = 0.0
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self._parent = getattr(_local, "span", None)
+        _local.span = self
+        self._start_time = time.time()
+        self._start_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self._start_counter
+        _local.span = self._parent
+        status = {"code": "OK"}
+        if exc_type is not None:
+            status = {"code": "ERROR", "message": f"{exc_type.__name__}: {exc_value}"}
+        start_ns = int(self._start_time * 1e9)
+        self.tracer.export(
+            {
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_span_id": self.parent_span_id,
+                "name": self.name,
+                "start_time_unix_nano": start_ns,
+                "end_time_unix_nano": start_ns + int(duration * 1e9),
+                "attributes": self.attributes,
+                "status": status,
+                "resource": {"service.name": "phabricator-repo-monitor"},
+            }
+        )
+        return False
+
+
+class _NoopSpan:
+    """Stands in for a Span when nothing is being recorded."""
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+@functools.lru_cache(maxsize=None)
+def tracer() -> Optional[Tracer]:
+    """Return the process-wide Tracer, or None if tracing is off.
+
+    A '{pid}' in TRACE_FILE is replaced with the process ID, so that every worker
+    process of the supervisor can write its own file.
+    """
+    settings = config.tracing_config_from_environ()
+    if not settings.TRACE_FILE:
+        return None
+    path = settings.TRACE_FILE.replace("{pid}", str(os.getpid()))
+    log.info(f"writing trace spans to {path}")
+    return Tracer(
+        path,
+        sample_rate=settings.TRACE_SAMPLE_RATE,
+        max_bytes=settings.TRACE_FILE_MAX_BYTES,
+        backup_count=settings.TRACE_FILE_BACKUP_COUNT,
+    )
+
+
+def start_trace(name: str, **attributes):
+    """Return the root span of a new trace.
+
+    Inside an existing span this returns a child span instead, so a traced unit of
+    work can be called from another one.  If tracing is off or the trace is not
+    sampled, a span that records nothing is returned and so are all its children.
+
+    Args:
+        name: The name of the operation.
+        **attributes: Initial attributes for the span.
+    """
+    if getattr(_local, "span", None) is not None:
+        return span(name, **attributes)
+    current_tracer = tracer()
+    if current_tracer is None or not current_tracer.sample():
+        return NOOP_SPAN
+    trace_id = f"{random.getrandbits(128):032x}"
+    return Span(current_tracer, name, trace_id, None, attributes)
+
+
+def span(name: str, **attributes):
+    """Return a child span of the current thread's span.
+
+    If there is no current span, a span that records nothing is returned.
+
+    Args:
+        name: The name of the operation.
+        **attributes: Initial attributes for the span.
+    """
+    parent = getattr(_local, "span", None)
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.tracer, name, parent.trace_id, parent.span_id, attributes)
+
+
+def iter_in_span(name: str, iterable: Iterable, **attributes) -> Iterator:
+    """Yield the items of an iterable inside a child span of the current span.
+
+    The span lasts until the iteration ends or the returned generator is closed,
+    which also closes the iterable.  It is only the current span while the
+    iterable produces an item, so spans the consumer opens between items are not
+    its children.
+
+    Args:
+        name: The name of the operation.
+        iterable: The items to yield.
+        **attributes: Initial attributes for the span.
+    """
+    child = span(name, **attributes)
+    if child is NOOP_SPAN:
+        yield from iterable
+        return
+    outer = _local.span
+    iterator = iter(iterable)
+    try:
+        with child:
+            try:
+                for item in iterator:
+                    _local.span = outer
+                    try:
+                        yield item
+                    finally:
+                        outer = _local.span
+                        _local.span = child
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+    finally:
+        _local.span = outer
+
+
+def current_span():
+    """Return the current thread's span, or a span that records nothing."""
+    return getattr(_local, "span", None) or NOOP_SPAN
@@ -4,13 +4,138 @@
 """
 General purpose utility functions.
 """
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
+from monitor import cassette, deadline, metrics, tracing
+from monitor.governor import governor_for
+
+http_requests = metrics.counter(
+    "monitor_http_requests_total", "HTTP requests made, by host, method and status."
+)
+http_request_duration = metrics.histogram(
+    "monitor_http_request_duration_seconds", "HTTP request latency, by host."
+)
+
+
+class InstrumentedHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter that records request metrics and obeys per-host limits.
+
+    Requests made while a monitor.deadline.Deadline is current time out when the
+    deadline passes, and are not sent at all once it has passed.
+
+    Requests made inside a trace also get a span with the HTTP status and the
+    number of body bytes received; see _response_size().  While a monitor.cassette
+    Recorder or Player is installed, responses are recorded or replayed.  See
+    monitor.governor for the limits, which do not apply to replayed responses.
+    """
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).hostname or ""
+        kwargs["timeout"] = _deadline_timeout(kwargs.get("timeout"))
+        tape = cassette.current()
+        if isinstance(tape, cassette.Player):
+            # No server is involved, so there is nothing to protect.
+            limits = _ungoverned()
+        else:
+            limits = governor_for(host).request()
+        with tracing.span(
+            "http_request", **{"http.method": request.method, "http.url": request.url}
+        ) as span, limits as observe:
+            start = time.perf_counter()
+            try:
+                if tape is None:
+                    response = super().send(request, **kwargs)
+                else:
+                    response = tape.send(super().send, request, **kwargs)
+            except Exception as e:
+                http_requests.labels(
+                    host=host, method=request.method, status="error"
+                ).inc()
+                budget = deadline.current()
+                # Timeouts surface as Timeout or, after retries, ConnectionError.
+                timed_out = isinstance(e, requests.RequestException)
+                if timed_out and budget is not None and budget.expired:
+                    raise deadline.DeadlineExceeded(
+                        f"{request.method} {request.url} cut short by the job deadline"
+                    ) from e
+                raise
+            finally:
+                http_request_duration.labels(host=host).observe(
+                    time.perf_counter() - start
+                )
+            observe(response.status_code)
+            span.set_attribute("http.status_code", response.status_code)
+            size = _response_size(response, kwargs.get("stream"))
+            if size is not None:
+                span.set_attribute("http.response_content_length", size)
+        http_requests.labels(
+            host=host, method=request.method, status=response.status_code
+        ).inc()
+        return response
+
+
+class DeadlineRetry(Retry):
+    """A urllib3 Retry policy that stops retrying once the job deadline passes.
+
+    Without this every retry would get the full remaining budget again as its
+    timeout, and a request could run several times past its deadline.
+    """
+
+    def is_exhausted(self):
+        budget = deadline.current()
+        if budget is not None and budget.expired:
+            return True
+        return super().is_exhausted()
+
+
+@contextmanager
+def _ungoverned():
+    """Stand in for HostGovernor.request() for requests that need no limits."""
+    yield lambda status_code: None
+
+
+def _response_size(response, stream) -> Optional[int]:
+    """Return the number of body bytes received for a response, if known.
+
+    A body that is not streamed is read here, as requests would do right after, so
+    the bytes read can be counted.  A streamed body is read later by the caller, so
+    only a Content-Length header gives its size.  Chunked responses have none.
+    """
+    if stream:
+        content_length = response.headers.get("Content-Length")
+        return None if content_length is None else int(content_length)
+    content = response.content
+    try:
+        # The bytes read off the wire, before any Content-Encoding is undone.
+        return response.raw.tell()
+    except AttributeError:
+        return len(content)
+
+
+def _deadline_timeout(timeout):
+    """Limit a requests timeout or (connect, read) timeout pair to the deadline."""
+    if deadline.current() is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(deadline.timeout(part) for part in timeout)
+    return deadline.timeout(timeout)
+
 
 def requests_retry_session(
-    retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504), session=None
+    retries=3,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 504),
+    session=None,
+    pool_maxsize=10,
 ):
     """Return a python-requests Session that retries on HTTP failure.
 
@@ -23,19 +148,71 @@ def requests_retry_session(
         status_forcelist: optional list of HTTP status codes that will trigger
             a retry.
         session: optional pre-built requests.Session object.
+        pool_maxsize: optional int, the number of connections to keep open to
+            each host.  Raise this when sharing the session between threads.
 
     Returns:
         A requests.Session object we can use to call .get(), post() etc.
     """
     session = session or requests.Session()
-    retry = Retry(
+    retry = DeadlineRetry(
         total=retries,
         read=retries,
         connect=retries,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = InstrumentedHTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     return session
+
+
+def iter_concurrently(
+    fn: Callable, items: Iterable, concurrency: int, ordered: bool = True
+) -> Iterator[Tuple[object, Future]]:
+    """Call fn(item) for each item using a pool of threads.
+
+    At most `concurrency` calls run at once and at most twice that many items are
+    read ahead from `items`, so arbitrarily long iterables are processed in bounded
+    memory.
+
+    Args:
+        fn: The function to call.
+        items: An iterable of arguments for fn.
+        concurrency: The number of worker threads.
+        ordered: If True, yield results in the order of `items`.  If False, yield
+            results as soon as they are done.
+
+    Yields:
+        (item, future) pairs.  The future is done; call .result() to get fn's
+        return value or raise its exception.
+    """
+    window = concurrency * 2
+    items = iter(items)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        def fill():
+            while len(pending) < window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending.append((item, executor.submit(fn, item)))
+
+        fill()
+        while pending:
+            if ordered:
+                item, future = pending.popleft()
+                wait([future])
+                yield item, future
+            else:
+                done, _ = wait([f for _, f in pending], return_when=FIRST_COMPLETED)
+                finished = [(i, f) for i, f in pending if f in done]
+                for entry in finished:
+                    pending.remove(entry)
+                for item, future in finished:
+                    yield item, future
+            fill()
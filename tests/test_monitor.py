@@ -2,6 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import copy
+import http.server
+import json
+import os
+import socketserver
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
 from unittest.mock import ANY, Mock, patch
 
 import kombu as kombu
@@ -10,20 +19,47 @@ import pytest
 from click.testing import CliRunner
 from apscheduler.schedulers.base import BaseScheduler
 
-from monitor.cli import display_lag, report_lag
+from monitor import (
+    backfill,
+    batch,
+    cache,
+    cassette,
+    cli,
+    config,
+    coordination,
+    deadline,
+    governor,
+    hgmo,
+    jobs,
+    metrics,
+    phabricator,
+    poll,
+    pushlog,
+    supervisor,
+    tracing,
+)
+from monitor.cli import backfill_lag, display_lag, replay_lag, report_lag
 from monitor.main import (
     ReplicationStatus,
+    commit_in_mirror,
     determine_commit_replication_status,
     fetch_commit_publication_time,
+    determine_mirror_replication_status,
     find_first_lagged_changset,
+    probe_mirror_replication_status,
+    replication_lag,
+    walk_mirror_replication_status,
 )
 from monitor.config import Mirror
+from monitor.nodes import NodeList
+from monitor.pulse import process_push_message
 # This structure is described here:
 # https://mozilla-version-control-tools.readthedocs.io/en/latest/hgmo/notifications.html#common-properties-of-notifications
 # Example messages can be collected from this URL:
 # https://tools.taskcluster.net/pulse-inspector?bindings[0][exchange]=exchange%2Fhgpushes%2Fv2&bindings[0][routingKeyPattern]=%23
 from monitor.reporting import report_to_statsd
-from monitor.sentry import record_exceptions
+from monitor.sentry import BackgroundReporter, record_exceptions
+from monitor.util import requests_retry_session
 
 example_message = {
     "payload": {
@@ -219,7 +255,7 @@ def test_cli_display_lag_for_repo(memory_queue):
 
     with replace_function(
         "monitor.main.determine_commit_replication_status", delayed_five_minutes
-    ), replace_function("monitor.hgmo.changesets_for_pushid", changesets):
+    ), replace_function("monitor.hgmo.iter_changesets_for_pushid", changesets):
         runner = CliRunner()
         result = runner.invoke(display_lag)
         assert result.exit_code == 0
@@ -239,7 +275,7 @@ def test_cli_report_lag_for_repo(memory_queue):
 
     with replace_function(
         "monitor.main.determine_commit_replication_status", delayed_five_minutes
-    ), replace_function("monitor.hgmo.changesets_for_pushid", changesets), patch(
+    ), replace_function("monitor.hgmo.iter_changesets_for_pushid", changesets), patch(
         "monitor.reporting.report_to_statsd"
     ) as report_to_statsd:
         runner = CliRunner()
@@ -270,7 +306,7 @@ def test_cli_queue_message_is_not_acknowledged_if_lag_found(memory_queue):
 
     with replace_function(
         "monitor.main.determine_commit_replication_status", delayed_five_minutes
-    ), replace_function("monitor.hgmo.changesets_for_pushid", changesets), patch(
+    ), replace_function("monitor.hgmo.iter_changesets_for_pushid", changesets), patch(
         "kombu.message.Message.ack"
     ) as ack:
         runner = CliRunner()
@@ -306,11 +342,13 @@ def test_report_to_statsd():
         )
 
 
-def test_sentry_records_job_errors():
+def test_sentry_records_job_errors(monkeypatch):
     def kaboom(*_, **__):
         raise Exception("BOOM")
 
     captureException = Mock()
+    reporter = BackgroundReporter()
+    monkeypatch.setattr("monitor.sentry.reporter", reporter)
 
     with replace_function("monitor.cli.run_pulse_listener", kaboom), replace_function(
         "monitor.sentry.Client.captureException", captureException
@@ -319,6 +357,7 @@ def test_sentry_records_job_errors():
         result = runner.invoke(report_lag)
 
         assert result.exit_code == -1  # This would be zero if we did not use stubs.
+        assert reporter.flush(timeout=5)
         captureException.assert_called_once()
 
 
@@ -339,3 +378,1375 @@ def test_sentry_ignores_expected_exceptions():
         with pytest.raises(IgnoredError):
             wrapped()
         captureException.assert_not_called()
+
+
+def test_metrics_registry_renders_prometheus_text():
+    registry = metrics.Registry()
+    requests_total = registry.register(
+        "test_requests_total", "counter", "Requests.", metrics.Counter
+    )
+    latency = registry.register(
+        "test_latency_seconds",
+        "histogram",
+        "Latency.",
+        lambda: metrics.Histogram((0.1, 1)),
+    )
+
+    requests_total.labels(host="hg.mozilla.org").inc()
+    requests_total.labels(host="hg.mozilla.org").inc(2)
+    latency.labels(stage="fetch").observe(0.5)
+
+    text = registry.render()
+    assert "# TYPE test_requests_total counter" in text
+    assert 'test_requests_total{host="hg.mozilla.org"} 3' in text
+    assert 'test_latency_seconds_bucket{stage="fetch",le="0.1"} 0' in text
+    assert 'test_latency_seconds_bucket{stage="fetch",le="1"} 1' in text
+    assert 'test_latency_seconds_bucket{stage="fetch",le="+Inf"} 1' in text
+    assert 'test_latency_seconds_count{stage="fetch"} 1' in text
+
+
+def test_metrics_http_endpoint_serves_registry():
+    registry = metrics.Registry()
+    registry.register("test_lag_seconds", "gauge", "Lag.", metrics.Gauge).labels(
+        repository="TESTREPO"
+    ).set(42)
+
+    server = metrics.start_http_server(0, addr="127.0.0.1", registry=registry)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+
+    assert 'test_lag_seconds{repository="TESTREPO"} 42' in body
+
+
+def test_sentry_reporter_deduplicates_repeated_exceptions():
+    client = Mock()
+    reporter = BackgroundReporter(client_factory=lambda: client)
+
+    def badfn():
+        raise ValueError("same every time")
+
+    for _ in range(3):
+        try:
+            badfn()
+        except ValueError:
+            reporter.report()
+
+    assert reporter.flush(timeout=5)
+    client.captureException.assert_called_once()
+
+
+def test_sentry_reporter_does_not_block_on_slow_client():
+    release = threading.Event()
+    client = Mock()
+    client.captureException.side_effect = lambda **_: release.wait(5)
+    reporter = BackgroundReporter(client_factory=lambda: client, max_queued=1)
+
+    queued = []
+    for i in range(5):
+        try:
+            raise RuntimeError(f"error {i}")
+        except RuntimeError:
+            queued.append(reporter.report())
+
+    # The first event is being sent, the second waits in the buffer, and the rest
+    # are dropped instead of blocking the caller.
+    assert queued.count(False) >= 3
+    release.set()
+    assert reporter.flush(timeout=5)
+
+
+def test_pushlog_changesets_are_streamed_across_chunk_boundaries():
+    pushlog = json.dumps(
+        {
+            "lastpushid": 64752,
+            "pushes": {
+                "64751": {"changesets": ["a" * 40], "date": 1527872155, "user": "x"},
+                "64752": {
+                    "changesets": ["b" * 40, "c" * 40],
+                    "date": 1527872156,
+                    "user": "y",
+                },
+            },
+        },
+        indent=4,
+    ).encode("utf-8")
+    chunks = [pushlog[i : i + 7] for i in range(0, len(pushlog), 7)]
+
+    assert list(hgmo.iter_pushlog_changesets(chunks, [64752])) == [
+        (64752, "b" * 40),
+        (64752, "c" * 40),
+    ]
+    assert len(list(hgmo.iter_pushlog_changesets(chunks))) == 3
+
+
+def test_pushlog_full_changesets_yield_nodes():
+    pushlog = json.dumps(
+        {
+            "lastpushid": 1,
+            "pushes": {
+                "1": {
+                    "changesets": [{"node": "a" * 40, "parents": ["b" * 40]}],
+                    "date": 1527872155,
+                    "user": "x",
+                }
+            },
+        }
+    ).encode("utf-8")
+
+    assert list(hgmo.iter_pushlog_changesets([pushlog])) == [(1, "a" * 40)]
+
+
+def test_changesets_for_missing_pushid_raises():
+    pushlog = json.dumps({"lastpushid": 1, "pushes": {}}).encode("utf-8")
+
+    with patch("monitor.hgmo.requests_retry_session") as session:
+        session().get().iter_content.return_value = [pushlog]
+        with pytest.raises(hgmo.NoSuchPush):
+            hgmo.changesets_for_pushid(2, "https://hg.example.com/json-pushes")
+
+
+def test_changesets_for_empty_push_is_empty():
+    pushlog = json.dumps(
+        {"lastpushid": 2, "pushes": {"2": {"changesets": [], "date": 1, "user": "x"}}}
+    ).encode("utf-8")
+
+    with patch("monitor.hgmo.requests_retry_session") as session:
+        session().get().iter_content.return_value = [pushlog]
+        assert hgmo.changesets_for_pushid(2, "https://hg.example.com/json-pushes") == []
+
+
+def test_push_changesets_are_checked_while_downloading():
+    pushlog = json.dumps(
+        {"pushes": {"1": {"changesets": ["a" * 40, "b" * 40], "date": 1}}}
+    ).encode("utf-8")
+    chunks_read = []
+
+    def chunks(_):
+        for i in range(0, len(pushlog), 16):
+            chunks_read.append(i)
+            yield pushlog[i : i + 16]
+
+    def first_is_stale(_, node):
+        if node == "a" * 40:
+            return ReplicationStatus.behind_by(60)
+        return ReplicationStatus.fresh()
+
+    with patch("monitor.hgmo.requests_retry_session") as session, replace_function(
+        "monitor.main.determine_commit_replication_status", first_is_stale
+    ):
+        session().get().iter_content.side_effect = chunks
+        changesets = hgmo.iter_changesets_for_pushid(1, "https://hg.example.com/p")
+        status = find_first_lagged_changset(null_mirror, changesets)
+        changesets.close()
+
+    assert status == ReplicationStatus.behind_by(60)
+    # The second changeset and the rest of the document were never downloaded.
+    assert len(chunks_read) < len(pushlog) / 16
+    session().get().close.assert_called()
+
+
+def test_nodelist_stores_hex_changesets_compactly():
+    hex_nodes = [f"{i:040x}" for i in range(1000)]
+
+    nodes = NodeList(hex_nodes)
+
+    assert len(nodes) == 1000
+    assert list(nodes) == hex_nodes
+    assert nodes[0] == hex_nodes[0]
+    assert nodes[-1] == hex_nodes[-1]
+    assert hex_nodes[500] in nodes
+    assert bytes.fromhex(hex_nodes[500]) in nodes
+    assert f"{1000:040x}" not in nodes
+    assert "not-a-node" not in nodes
+    # 20 bytes per node plus the hash index, instead of ~90 bytes per str.
+    assert nodes.nbytes() < 40 * len(nodes)
+
+
+def test_nodelist_ignores_duplicates():
+    nodes = NodeList()
+    assert nodes.append("a" * 40)
+    assert not nodes.append("a" * 40)
+    assert nodes == ["a" * 40]
+
+
+@pytest.fixture
+def local_repository(tmp_path):
+    """Build a local repository directory with a pushlog extension database.
+
+    Pushes 1 and 2 have changesets.  Push 3 has none.
+    """
+    hgdir = tmp_path / ".hg"
+    hgdir.mkdir()
+    db = sqlite3.connect(str(hgdir / "pushlog2.db"))
+    # Schema from the pushlog extension in version-control-tools.
+    db.executescript(
+        """
+        CREATE TABLE changesets (pushid INTEGER, rev INTEGER, node text);
+        CREATE TABLE pushlog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT, date INTEGER
+        );
+        CREATE UNIQUE INDEX changeset_node ON changesets (node);
+        CREATE UNIQUE INDEX changeset_rev ON changesets (rev);
+        INSERT INTO pushlog (id, user, date) VALUES (1, 'a@example.com', 1000);
+        INSERT INTO pushlog (id, user, date) VALUES (2, 'b@example.com', 2000);
+        INSERT INTO pushlog (id, user, date) VALUES (3, 'c@example.com', 2000);
+        """
+    )
+    db.executemany(
+        "INSERT INTO changesets (pushid, rev, node) VALUES (?, ?, ?)",
+        [(1, 0, "a" * 40), (2, 2, "c" * 40), (2, 1, "b" * 40)],
+    )
+    db.commit()
+    db.close()
+    return tmp_path
+
+
+def test_local_pushlog_reads_push_changesets(local_repository):
+    source = pushlog.LocalPushlog(str(local_repository))
+
+    assert source.changesets_for_pushid(2) == ["b" * 40, "c" * 40]
+    # Push 3 exists but has no changesets.
+    assert source.changesets_for_pushid(3) == []
+    with pytest.raises(hgmo.NoSuchPush):
+        source.changesets_for_pushid(4)
+
+
+def test_local_pushlog_reads_push_time(local_repository):
+    source = pushlog.LocalPushlog(str(local_repository))
+
+    assert source.push_time("c" * 40) == 2000
+    with pytest.raises(hgmo.NoSuchChangeset):
+        source.push_time("d" * 40)
+
+
+def test_pushlog_source_chosen_by_mirror_config(local_repository):
+    http_mirror = Mirror("https://hg.example.com/repo", "", "REPO")
+    local_mirror = http_mirror._replace(local_repository_path=str(local_repository))
+
+    assert isinstance(pushlog.source_for_mirror(http_mirror), pushlog.HTTPPushlog)
+    assert isinstance(pushlog.source_for_mirror(local_mirror), pushlog.LocalPushlog)
+
+
+def test_backfill_checks_every_changeset_in_push_order(local_repository):
+    mirror = Mirror("", "", "REPO", str(local_repository))
+
+    def only_a_mirrored(_, node, **__):
+        return node == "a" * 40
+
+    with replace_function("monitor.backfill.commit_in_mirror", only_a_mirrored):
+        records = list(backfill.check_pushes(mirror, 1, 3, chunk_size=1, concurrency=4))
+
+    assert records == [
+        backfill.BackfillRecord(1, "a" * 40, 1000, True),
+        backfill.BackfillRecord(2, "b" * 40, 2000, False),
+        backfill.BackfillRecord(2, "c" * 40, 2000, False),
+        backfill.BackfillRecord(3, None, 2000, True),
+    ]
+
+
+def test_backfill_reads_the_pushlog_with_the_shared_session():
+    mirror = Mirror("https://hg.example.com/repo", "", "REPO")
+    sessions = []
+
+    def pushes(_, session=None):
+        sessions.append(session)
+        return iter([hgmo.Push(1, 1000, NodeList(["a" * 40]))])
+
+    def mirrored(_, node, session=None):
+        sessions.append(session)
+        return True
+
+    with replace_function("monitor.hgmo.stream_pushes", pushes):
+        with replace_function("monitor.backfill.commit_in_mirror", mirrored):
+            records = list(backfill.check_pushes(mirror, 1, 1))
+
+    assert records == [backfill.BackfillRecord(1, "a" * 40, 1000, True)]
+    assert sessions[0] is not None
+    assert sessions[0] is sessions[1]
+
+
+def test_backfill_resume_drops_last_partial_push(tmp_path):
+    output = tmp_path / "lag.csv"
+    output.write_text(
+        "pushid,node,pushdate,mirrored\n"
+        "1,aaa,1000,True\n"
+        "2,bbb,2000,True\n"
+        "2,ccc,2000,Tr"
+    )
+
+    assert backfill.truncate_partial_push(str(output), "csv") == 2
+    assert output.read_text() == "pushid,node,pushdate,mirrored\n1,aaa,1000,True\n"
+
+
+def test_cli_backfill_lag_writes_jsonl(local_repository, monkeypatch, tmp_path):
+    monkeypatch.setenv("LOCAL_REPOSITORY_PATH", str(local_repository))
+    output = tmp_path / "lag.jsonl"
+
+    def mirrored(*_, **__):
+        return True
+
+    with replace_function("monitor.backfill.commit_in_mirror", mirrored):
+        runner = CliRunner()
+        result = runner.invoke(
+            backfill_lag,
+            ["--start", "1", "--end", "2", "--format", "jsonl", "-o", str(output)],
+        )
+
+    assert result.exit_code == 0
+    rows = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [row["pushid"] for row in rows] == [1, 2, 2]
+    assert all(row["mirrored"] for row in rows)
+
+
+def test_cli_display_lag_batch_dedups_and_summarizes():
+    checked = []
+
+    def lag_for_node(_, node, *__):
+        checked.append(node)
+        if node == "bbb":
+            return ReplicationStatus.behind_by(60)
+        return ReplicationStatus.fresh()
+
+    with replace_function(
+        "monitor.batch.determine_commit_replication_status", lag_for_node
+    ):
+        runner = CliRunner()
+        result = runner.invoke(
+            display_lag,
+            ["--batch", "-", "--format", "jsonl"],
+            input="aaa\nbbb\n# a comment\n\naaa ccc\n",
+        )
+
+    assert result.exit_code == 0
+    assert sorted(checked) == ["aaa", "bbb", "ccc"]
+    lines = result.output.splitlines()
+    records = {
+        record["node"]: record
+        for record in map(json.loads, (line for line in lines if line.startswith("{")))
+    }
+    assert records["bbb"]["seconds_behind"] == 60
+    assert not records["aaa"]["is_stale"]
+    assert "checked 3 changesets (1 stale, 0 errors, 1 duplicates skipped)" in (
+        result.output
+    )
+
+
+def test_batch_check_reports_errors_per_node():
+    def kaboom(_, node, *__):
+        raise RuntimeError("HTTP 503")
+
+    with replace_function("monitor.batch.determine_commit_replication_status", kaboom):
+        results = list(batch.check_nodes(null_mirror, ["aaa"], concurrency=2))
+
+    assert results == [batch.NodeResult("aaa", None, "RuntimeError: HTTP 503")]
+
+
+@pytest.fixture
+def stub_server():
+    """Run a local HTTP server that answers every request with a chosen status.
+
+    Set `stub_server.status` and `stub_server.delay` to change the responses.  Set
+    `stub_server.body` to send a body without a Content-Length header.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(server.delay)
+            self.send_response(server.status)
+            if server.body is None:
+                self.send_header("Content-Length", "0")
+            self.end_headers()
+            if server.body is not None:
+                self.wfile.write(server.body)
+
+        do_HEAD = do_GET
+
+        def log_message(self, *_):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    server.status = 200
+    server.delay = 0
+    server.body = None
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def fresh_governors(monkeypatch):
+    monkeypatch.setattr("monitor.governor._governors", {})
+    monkeypatch.setenv("HTTP_INITIAL_CONCURRENCY", "8")
+    monkeypatch.setenv("HTTP_RATE_LIMIT", "1000")
+    monkeypatch.setenv("HTTP_RATE_BURST", "1000")
+
+
+def test_governor_backs_off_when_server_is_overloaded(stub_server, fresh_governors):
+    session = requests_retry_session(retries=0)
+    stub_server.status = 429
+
+    for _ in range(5):
+        session.get(stub_server.url)
+
+    host_governor = governor.governor_for("127.0.0.1")
+    assert host_governor.limit.limit == 1
+    limit_metric = metrics.REGISTRY.get("monitor_governor_concurrency_limit")
+    assert limit_metric.labels(host="127.0.0.1").value == 1
+
+
+def test_governor_grows_limit_while_server_is_healthy(stub_server, fresh_governors):
+    session = requests_retry_session(retries=0)
+
+    for _ in range(30):
+        session.get(stub_server.url)
+
+    assert governor.governor_for("127.0.0.1").limit.limit > 8
+
+
+def test_adaptive_limit_backs_off_on_rising_latency():
+    limit = governor.AdaptiveLimit(initial=10, minimum=1, maximum=20)
+    for _ in range(20):
+        limit.acquire()
+        limit.release(0.01, overloaded=False)
+    healthy_limit = limit.limit
+
+    for _ in range(3):
+        limit.acquire()
+        limit.release(1.0, overloaded=False)
+
+    assert limit.limit < healthy_limit
+
+
+def test_token_bucket_limits_rate():
+    bucket = governor.TokenBucket(rate=100, burst=1)
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
+
+
+@pytest.fixture
+def response_cache(monkeypatch, tmp_path):
+    disk_cache = cache.DiskCache(tmp_path / "cache", max_bytes=2 ** 20)
+    monkeypatch.setattr("monitor.hgmo.response_cache", lambda: disk_cache)
+    return disk_cache
+
+
+def test_fetched_changesets_are_cached(response_cache):
+    with patch("monitor.hgmo.requests_retry_session") as session:
+        response = session().get.return_value
+        response.status_code = 200
+        response.encoding = "utf-8"
+        response.content = json.dumps(example_commit).encode("utf-8")
+        session().get.reset_mock()
+
+        first = hgmo.fetch_changeset(example_commit["node"], "https://hg.example.com")
+        second = hgmo.fetch_changeset(example_commit["node"], "https://hg.example.com")
+
+    assert session().get.call_count == 1
+    assert second == json.loads(response.content)
+    assert first is response.json.return_value
+
+
+def test_complete_pushlog_responses_are_cached(response_cache):
+    pushlog_body = json.dumps(
+        {"lastpushid": 2, "pushes": {"2": {"changesets": ["a" * 40], "date": 5}}}
+    ).encode("utf-8")
+    url = "https://hg.example.com/json-pushes?version=2&startID=1&endID=2"
+
+    with patch("monitor.hgmo.requests_retry_session") as session:
+        response = session().get.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [pushlog_body]
+        session().get.reset_mock()
+
+        assert list(hgmo.stream_pushes(url)) == [hgmo.Push(2, 5, ["a" * 40])]
+        assert list(hgmo.stream_pushes(url)) == [hgmo.Push(2, 5, ["a" * 40])]
+
+    assert session().get.call_count == 1
+
+
+def test_open_pushlog_ranges_are_not_cached(response_cache):
+    pushlog_body = json.dumps({"lastpushid": 1, "pushes": {}}).encode("utf-8")
+    url = "https://hg.example.com/json-pushes?version=2&startID=1&endID=2"
+
+    with patch("monitor.hgmo.requests_retry_session") as session:
+        response = session().get.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [pushlog_body]
+
+        list(hgmo.stream_pushes(url))
+
+    assert response_cache.lookup(url) is None
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    disk_cache = cache.DiskCache(tmp_path, max_bytes=250)
+    disk_cache.put("https://example.com/a", b"a" * 100)
+    disk_cache.put("https://example.com/b", b"b" * 100)
+    old = time.time() - 60
+    os.utime(str(disk_cache.lookup("https://example.com/a").path), (old, old))
+
+    disk_cache.put("https://example.com/c", b"c" * 100)
+
+    assert disk_cache.lookup("https://example.com/a") is None
+    assert disk_cache.read(disk_cache.lookup("https://example.com/c")) == b"c" * 100
+
+
+def test_disk_cache_removes_stale_temporary_files(tmp_path):
+    stale = tmp_path / "crashed.tmp"
+    stale.write_bytes(b"partial")
+    old = time.time() - cache.STALE_TEMP_SECONDS - 60
+    os.utime(str(stale), (old, old))
+    in_progress = tmp_path / "writing.tmp"
+    in_progress.write_bytes(b"partial")
+
+    disk_cache = cache.DiskCache(tmp_path, max_bytes=1000)
+    disk_cache.put("https://example.com/a", b"a" * 10)
+
+    assert not stale.exists()
+    assert in_progress.exists()
+    assert disk_cache.read(disk_cache.lookup("https://example.com/a")) == b"a" * 10
+
+
+def test_cache_writer_discards_uncommitted_bodies(tmp_path):
+    disk_cache = cache.DiskCache(tmp_path, max_bytes=1000)
+
+    with pytest.raises(RuntimeError):
+        with disk_cache.writer("https://example.com/a") as writer:
+            writer.write(b"a" * 10)
+            raise RuntimeError("download failed")
+    with disk_cache.writer("https://example.com/b") as writer:
+        writer.write(b"b" * 10)
+
+    assert list(tmp_path.glob("*.tmp")) == []
+    assert disk_cache.lookup("https://example.com/a") is None
+    assert disk_cache.lookup("https://example.com/b") is None
+
+
+def report_once_then_crash(shards, results, log_level):
+    """A supervisor worker that sends one measurement per shard and dies."""
+    for shard in shards:
+        results.put((shard.mirror, ReplicationStatus.behind_by(7)))
+    # Flush the queue before exiting without any clean-up.
+    results.close()
+    results.join_thread()
+    os._exit(1)
+
+
+worker_events = metrics.counter(
+    "monitor_test_worker_events_total", "Events counted in a test worker."
+)
+
+
+def count_then_crash(shards, results, log_level):
+    """A supervisor worker that counts an event per shard, sends its metrics and dies."""
+    for shard in shards:
+        worker_events.labels(shard=shard.queue_name).inc(3)
+        replication_lag.labels(repository="WORKERLAG").set(5)
+    supervisor.send_metrics(results)
+    results.close()
+    results.join_thread()
+    os._exit(1)
+
+
+def test_mirror_shards_from_environ(monkeypatch):
+    monkeypatch.setenv(
+        "MIRRORS",
+        json.dumps(
+            [
+                {
+                    "source_repository_url": "https://hg.mozilla.org/integration/autoland",
+                    "repo_callsign": "AUTOLAND",
+                    "routing_key": "integration/autoland",
+                },
+                {
+                    "source_repository_url": "https://hg.mozilla.org/mozilla-central",
+                    "repo_callsign": "MOZILLACENTRAL",
+                    "routing_key": "mozilla-central",
+                    "queue_name": "central",
+                },
+            ]
+        ),
+    )
+
+    shards = config.mirror_shards_from_environ()
+
+    assert [shard.mirror.repo_callsign for shard in shards] == [
+        "AUTOLAND",
+        "MOZILLACENTRAL",
+    ]
+    assert [shard.queue_name for shard in shards] == ["bar-autoland", "central"]
+
+
+def test_shards_are_spread_over_workers():
+    shards = [config.Shard(null_mirror, str(i), "") for i in range(5)]
+
+    assignments = supervisor.assign_shards(shards, 2)
+
+    assert [len(worker_shards) for worker_shards in assignments] == [3, 2]
+    assert supervisor.assign_shards(shards, 10) == [[shard] for shard in shards]
+
+
+def test_supervisor_restarts_crashed_workers_and_reports_results(monkeypatch):
+    monkeypatch.setattr("monitor.supervisor.MIN_RESTART_DELAY", 0.1)
+    mirror = Mirror("", "", "TESTREPO")
+    reported = []
+
+    pool = supervisor.Supervisor(
+        [[config.Shard(mirror, "queue", "key")]],
+        (),
+        lambda *args: reported.append(args),
+        target=report_once_then_crash,
+    )
+    pool.start()
+    try:
+        deadline = time.monotonic() + 60
+        while len(reported) < 2 and time.monotonic() < deadline:
+            pool.poll(timeout=0.5)
+    finally:
+        pool.stop()
+
+    assert reported[:2] == [(mirror, ReplicationStatus.behind_by(7))] * 2
+
+
+def test_supervisor_serves_worker_metrics():
+    pool = supervisor.Supervisor(
+        [[config.Shard(null_mirror, "queue", "key")]],
+        (),
+        lambda *args: None,
+        target=count_then_crash,
+    )
+    expected = 'monitor_test_worker_events_total{shard="queue",worker="0"} 3'
+    pool.start()
+    try:
+        deadline = time.monotonic() + 60
+        while expected not in metrics.REGISTRY.render() and time.monotonic() < deadline:
+            pool.poll(timeout=0.5)
+    finally:
+        pool.stop()
+
+    assert expected in metrics.REGISTRY.render()
+    # The supervisor exports replication lag from the results it receives.
+    assert "WORKERLAG" not in metrics.REGISTRY.render()
+
+
+@pytest.fixture
+def trace_file(monkeypatch, tmp_path):
+    """Record every trace to a file and return a function that reads the spans."""
+    path = tmp_path / "spans.jsonl"
+    tracer = tracing.Tracer(path)
+    monkeypatch.setattr("monitor.tracing.tracer", lambda: tracer)
+
+    def read_spans():
+        with open(str(path)) as f:
+            return [json.loads(line) for line in f]
+
+    yield read_spans
+    tracer.close()
+
+
+def test_pulse_message_is_traced(trace_file, stub_server, fresh_governors):
+    mirror = Mirror("", stub_server.url, "TESTREPO")
+    message = Mock()
+
+    def changesets(*_):
+        return ["aaa", "bbb"]
+
+    with replace_function("monitor.hgmo.iter_changesets_for_pushid", changesets):
+        process_push_message(
+            copy.deepcopy(example_message),
+            message,
+            extra_data=dict(mirror_config=mirror, reporting_function=noop),
+        )
+
+    recorded = trace_file()
+    spans = {span["name"]: span for span in recorded}
+    names = [span["name"] for span in recorded]
+    root = spans["process_push_message"]
+    assert names.count("mirror_check") == 2
+    assert names.count("http_request") == 2
+    assert root["parent_span_id"] is None
+    assert root["attributes"]["outcome"] == "fresh"
+    assert root["attributes"]["pushid"] == 64752
+    assert {span["trace_id"] for span in spans.values()} == {root["trace_id"]}
+    for name in ("mirror_check", "reporting"):
+        assert spans[name]["parent_span_id"] == root["span_id"]
+    assert root["attributes"]["changesets_read"] == 2
+    http = spans["http_request"]
+    assert http["parent_span_id"] == spans["mirror_check"]["span_id"]
+    assert http["attributes"]["http.status_code"] == 200
+    assert http["attributes"]["http.response_content_length"] == 0
+    assert root["end_time_unix_nano"] >= http["end_time_unix_nano"]
+
+
+def test_http_spans_count_the_bytes_read(trace_file, stub_server, fresh_governors):
+    stub_server.body = b"x" * 1000
+    session = requests_retry_session(retries=0)
+
+    with tracing.start_trace("read"):
+        assert len(session.get(stub_server.url).content) == 1000
+    with tracing.start_trace("stream"):
+        response = session.get(stub_server.url, stream=True)
+        assert len(response.content) == 1000
+
+    http_spans = [span for span in trace_file() if span["name"] == "http_request"]
+    assert http_spans[0]["attributes"]["http.response_content_length"] == 1000
+    assert "http.response_content_length" not in http_spans[1]["attributes"]
+
+
+def test_pulse_pushlog_fetch_is_traced_and_timed(trace_file, fresh_governors):
+    body = json.dumps(
+        {"pushes": {"64752": {"changesets": ["a" * 40, "b" * 40], "date": 1}}}
+    ).encode("utf-8")
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            # A streamed pushlog response, without a Content-Length.
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), 16):
+                chunk = body[i : i + 16]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *_):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        # The pushlog download is still open while the mirror is checked.
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    message_body = copy.deepcopy(example_message)
+    push = message_body["payload"]["data"]["pushlog_pushes"][0]
+    push["push_json_url"] = f"{url}/json-pushes?version=2&startID=64751&endID=64752"
+    fetches = metrics.stage_duration.labels(stage="pushlog_fetch")
+    before = fetches.snapshot()[1]
+
+    try:
+        process_push_message(
+            message_body,
+            Mock(),
+            extra_data=dict(
+                mirror_config=Mirror("", url, "TESTREPO"), reporting_function=noop
+            ),
+        )
+    finally:
+        server.shutdown()
+
+    spans = trace_file()
+    root = next(span for span in spans if span["name"] == "process_push_message")
+    fetch = next(span for span in spans if span["name"] == "pushlog_fetch")
+    checks = [span for span in spans if span["name"] == "mirror_check"]
+    assert fetch["parent_span_id"] == root["span_id"]
+    assert fetch["attributes"]["pushlog.bytes_read"] == len(body)
+    # The download request belongs to the fetch, the mirror checks do not.
+    assert any(
+        span["name"] == "http_request" and span["parent_span_id"] == fetch["span_id"]
+        for span in spans
+    )
+    assert [span["parent_span_id"] for span in checks] == [root["span_id"]] * 2
+    assert sum(fetches.snapshot()[1]) == sum(before) + 1
+
+
+def test_spans_are_not_recorded_when_tracing_is_off(monkeypatch, tmp_path):
+    monkeypatch.setattr("monitor.tracing.tracer", lambda: None)
+    with tracing.start_trace("work") as root, tracing.span("child") as child:
+        assert root is tracing.NOOP_SPAN
+        assert child is tracing.NOOP_SPAN
+
+    unsampled = tracing.Tracer(tmp_path / "spans.jsonl", sample_rate=0.0)
+    monkeypatch.setattr("monitor.tracing.tracer", lambda: unsampled)
+    with tracing.start_trace("work"), tracing.span("child"):
+        pass
+    unsampled.close()
+
+    assert (tmp_path / "spans.jsonl").read_text() == ""
+
+
+@pytest.fixture
+def no_cassette(monkeypatch):
+    """Make sure no recording or replay outlives the test."""
+    monkeypatch.setattr("monitor.cassette._current", None)
+
+
+def test_recorded_traffic_replays_without_network(
+    no_cassette, stub_server, fresh_governors, tmp_path
+):
+    path = tmp_path / "traffic.jsonl.gz"
+    mirror = Mirror("", stub_server.url, "TESTREPO")
+    recorder = cassette.Recorder(path, mirror)
+    cassette.install(recorder)
+
+    def changesets(*_):
+        return ["aaa", "bbb"]
+
+    with replace_function("monitor.hgmo.iter_changesets_for_pushid", changesets):
+        process_push_message(
+            copy.deepcopy(example_message),
+            Mock(),
+            extra_data=dict(mirror_config=mirror, reporting_function=noop),
+        )
+        cassette.install(None)
+        recorder.close()
+
+        # Any request that reached the server now would fail.
+        stub_server.status = 500
+        result = CliRunner().invoke(replay_lag, [str(path)])
+
+    assert result.exit_code == 0, result.output
+    assert "replication lag (seconds): 0" in result.output
+    assert "replayed 1 messages (0 stale, 0 errors)" in result.output
+    assert "2 recorded HTTP responses" in result.output
+
+
+def test_player_repeats_last_response_and_rejects_unknown_requests(tmp_path):
+    path = tmp_path / "traffic.jsonl.gz"
+    request = Mock(method="GET", url="https://hg.example/json-rev/aaa")
+    recorder = cassette.Recorder(path, null_mirror)
+    for status in (503, 200):
+        response = Mock(status_code=status, reason="", content=b"{}", headers={})
+        recorder.send(lambda *_: response, request)
+    recorder.close()
+
+    player = cassette.Player(path)
+    statuses = [player.send(None, request).status_code for _ in range(3)]
+
+    assert statuses == [503, 200, 200]
+    with pytest.raises(cassette.NoRecordedResponse):
+        player.send(None, Mock(method="GET", url="https://hg.example/json-rev/bbb"))
+
+
+def test_replayed_requests_are_not_rate_limited(no_cassette, tmp_path):
+    path = tmp_path / "traffic.jsonl.gz"
+    url = "https://hg.example/json-rev/aaa"
+    recorder = cassette.Recorder(path, null_mirror)
+    response = Mock(status_code=200, reason="", content=b"{}", headers={})
+    recorder.send(lambda *_: response, Mock(method="GET", url=url))
+    recorder.close()
+
+    def governor_for(host):
+        raise AssertionError(f"replayed request to {host} was governed")
+
+    cassette.install(cassette.Player(path))
+    with replace_function("monitor.util.governor_for", governor_for):
+        session = requests_retry_session()
+        statuses = [session.get(url).status_code for _ in range(50)]
+
+    assert statuses == [200] * 50
+
+
+@pytest.fixture
+def pushlog_clock(monkeypatch):
+    """Pretend it is 500 seconds after the last push in local_repository."""
+    monkeypatch.setattr("monitor.main.now", lambda: maya.MayaDT(2500))
+
+
+@pytest.mark.parametrize(
+    "latest,expected",
+    [
+        ("a" * 40, ReplicationStatus.behind_by(500)),
+        ("b" * 40, ReplicationStatus.behind_by(500)),
+        ("c" * 40, ReplicationStatus.fresh()),
+    ],
+)
+def test_repository_probe_measures_oldest_unmirrored_push(
+    local_repository, pushlog_clock, latest, expected
+):
+    mirror = Mirror("", "", "REPO", str(local_repository))
+
+    def latest_imported_commit(*_):
+        return latest
+
+    with replace_function(
+        "monitor.phabricator.latest_imported_commit", latest_imported_commit
+    ):
+        assert probe_mirror_replication_status(mirror) == expected
+
+
+def test_repository_probe_skips_empty_pushes(local_repository, pushlog_clock):
+    # Push 3, after the newest mirrored commit, has no changesets.
+    mirror = Mirror("", "", "REPO", str(local_repository))
+
+    with replace_function(
+        "monitor.phabricator.latest_imported_commit", lambda *_: "c" * 40
+    ):
+        assert probe_mirror_replication_status(mirror) == ReplicationStatus.fresh()
+
+
+def test_repository_probe_reads_past_empty_pushes(local_repository, pushlog_clock):
+    # Push 3, after the newest mirrored commit, has no changesets, but push 4 does
+    # and is not mirrored.
+    db = sqlite3.connect(str(local_repository / ".hg" / "pushlog2.db"))
+    db.execute("INSERT INTO pushlog (id, user, date) VALUES (4, 'd@example.com', 2200)")
+    db.execute(
+        "INSERT INTO changesets (pushid, rev, node) VALUES (4, 3, ?)", ("d" * 40,)
+    )
+    db.commit()
+    db.close()
+    mirror = Mirror("", "", "REPO", str(local_repository))
+
+    def commit_in_mirror(_, node, *__):
+        return node != "d" * 40
+
+    with replace_function(
+        "monitor.phabricator.latest_imported_commit", lambda *_: "c" * 40
+    ), replace_function("monitor.main.commit_in_mirror", commit_in_mirror):
+        probed = probe_mirror_replication_status(mirror)
+        walked = walk_mirror_replication_status(mirror)
+
+    assert probed == walked == ReplicationStatus.behind_by(300)
+
+
+def test_repository_probe_falls_back_to_checking_push_heads(
+    local_repository, pushlog_clock, monkeypatch
+):
+    monkeypatch.delenv("PHABRICATOR_API_TOKEN", raising=False)
+    mirror = Mirror("", "", "REPO", str(local_repository))
+    mirrored = {"a" * 40}
+    checked = []
+
+    def commit_in_mirror(_, node, *__):
+        checked.append(node)
+        return node in mirrored
+
+    with replace_function("monitor.main.commit_in_mirror", commit_in_mirror):
+        lagging = determine_mirror_replication_status(mirror)
+        mirrored.add("c" * 40)
+        caught_up = determine_mirror_replication_status(mirror)
+
+    assert lagging == ReplicationStatus.behind_by(500)
+    assert caught_up == ReplicationStatus.fresh()
+    assert checked == ["c" * 40, "a" * 40, "c" * 40]
+
+
+def test_repository_probe_measures_lag_longer_than_a_day(local_repository, monkeypatch):
+    mirror = Mirror("", "", "REPO", str(local_repository))
+    monkeypatch.setattr("monitor.main.now", lambda: maya.MayaDT(2000 + 86400 + 5))
+
+    with replace_function(
+        "monitor.phabricator.latest_imported_commit", lambda *_: "a" * 40
+    ):
+        status = probe_mirror_replication_status(mirror)
+
+    assert status == ReplicationStatus.behind_by(86405)
+
+
+def test_cli_display_lag_cross_check_tolerates_probe_failure_and_small_drift():
+    def probe_fails(*_):
+        raise phabricator.MissingAPIToken("PHABRICATOR_API_TOKEN is not set")
+
+    with replace_function(
+        "monitor.cli.probe_mirror_replication_status", probe_fails
+    ), replace_function(
+        "monitor.cli.walk_mirror_replication_status",
+        lambda *_: ReplicationStatus.behind_by(300),
+    ):
+        result = CliRunner().invoke(
+            display_lag, ["--probe", "repository", "--cross-check"]
+        )
+    assert result.exit_code == 0, result.output
+    assert "replication lag (seconds): 300" in result.output
+
+    probed = ReplicationStatus.behind_by(300)
+    assert cli.statuses_agree(probed, ReplicationStatus.behind_by(301))
+    assert not cli.statuses_agree(probed, ReplicationStatus.behind_by(900))
+    assert not cli.statuses_agree(ReplicationStatus.fresh(), probed)
+
+
+def test_cli_report_lag_probe_needs_no_pulse_settings(monkeypatch):
+    for name in ("PULSE_USERNAME", "PULSE_PASSWORD", "PULSE_QUEUE_NAME"):
+        monkeypatch.delenv(name)
+
+    with replace_function(
+        "monitor.cli.determine_mirror_replication_status",
+        lambda *_: ReplicationStatus.behind_by(60),
+    ):
+        result = CliRunner().invoke(report_lag, ["--probe", "repository", "--no-send"])
+
+    assert result.exit_code == 0, result.output
+    assert "replication lag (seconds): 60" in result.output
+
+
+def test_latest_imported_commit_asks_conduit_for_newest_commit(monkeypatch):
+    monkeypatch.setenv("PHABRICATOR_API_TOKEN", "api-token")
+    session = Mock()
+    session.post.return_value.json.return_value = {
+        "result": {"data": [{"fields": {"identifier": "a" * 40}}]},
+        "error_code": None,
+        "error_info": None,
+    }
+    mirror = Mirror("", "https://phabricator.example.com", "REPO")
+
+    assert phabricator.latest_imported_commit(mirror, session) == "a" * 40
+    session.post.assert_called_once_with(
+        "https://phabricator.example.com/api/diffusion.commit.search",
+        data={
+            "api.token": "api-token",
+            "constraints[repositories][0]": "rREPO",
+            "order[0]": "id",
+            "limit": 1,
+        },
+    )
+
+
+@pytest.fixture
+def fake_hgmo():
+    """Run a local server with a pushlog for /repo and a mirror of it.
+
+    Add pushes to `fake_hgmo.pushes` as {pushid: (date, [nodes])} and mirrored
+    nodes to `fake_hgmo.mirrored`.  Served status codes are kept in
+    `fake_hgmo.statuses`.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == "/repo/json-pushes":
+                query = urllib.parse.parse_qs(url.query)
+                start_id = int(query["startID"][0])
+                end_id = int(query["endID"][0])
+                pushes = {
+                    str(pushid): {"date": date, "changesets": nodes}
+                    for pushid, (date, nodes) in server.pushes.items()
+                    if start_id < pushid <= end_id
+                }
+                if "tipsonly" in query:
+                    for push in pushes.values():
+                        push["changesets"] = push["changesets"][-1:]
+                lastpushid = max(server.pushes, default=0)
+                self.reply({"lastpushid": lastpushid, "pushes": pushes})
+            elif url.path.startswith("/repo/json-rev/"):
+                node = url.path.rsplit("/", 1)[1]
+                for pushid, (date, nodes) in server.pushes.items():
+                    if node in nodes:
+                        self.reply(
+                            {"node": node, "pushid": pushid, "pushdate": [date, 0]}
+                        )
+                        return
+                self.respond(404)
+            else:
+                self.respond(404)
+
+        def do_HEAD(self):
+            node = self.path[len("/rREPO") :]
+            self.respond(200 if node in server.mirrored else 404)
+
+        def reply(self, data):
+            body = json.dumps(data).encode("utf-8")
+            etag = f'"{hash(body)}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.respond(304)
+                return
+            self.respond(200, body, {"ETag": etag, "Content-Type": "application/json"})
+
+        def respond(self, status, body=b"", headers=None):
+            server.statuses.append(status)
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    server.pushes = {}
+    server.mirrored = set()
+    server.statuses = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_poll_checks_only_new_pushes(fake_hgmo, fresh_governors, tmp_path):
+    mirror = Mirror(f"{fake_hgmo.url}/repo", fake_hgmo.url, "REPO")
+    state = poll.PollState(tmp_path / "state.json")
+    reported = []
+    caught_up = []
+
+    def poll_once():
+        poll.poll_pushes(
+            mirror,
+            state,
+            lambda _, status: reported.append(status),
+            empty_queue_callback=lambda: caught_up.append(True),
+            batch_size=2,
+        )
+
+    fake_hgmo.pushes[1] = (1000, ["a" * 40])
+    fake_hgmo.mirrored.add("a" * 40)
+    poll_once()
+    assert state.get(mirror)["last_pushid"] == 1
+    assert (reported, caught_up) == ([], [True])
+
+    fake_hgmo.pushes[2] = (2000, ["b" * 40, "c" * 40])
+    fake_hgmo.pushes[3] = (3000, ["d" * 40])
+    fake_hgmo.mirrored.update(["b" * 40, "c" * 40])
+    poll_once()
+    assert [status.is_stale for status in reported] == [False, True]
+    assert state.get(mirror)["last_pushid"] == 2
+
+    fake_hgmo.mirrored.add("d" * 40)
+    poll_once()
+    assert reported[-1] == ReplicationStatus.fresh()
+    assert poll.PollState(tmp_path / "state.json").get(mirror)["last_pushid"] == 3
+
+    del fake_hgmo.statuses[:]
+    poll_once()
+    poll_once()
+    assert fake_hgmo.statuses == [200, 304]
+    assert caught_up == [True, True, True]
+
+
+def test_deadline_cuts_requests_short_and_counts_overrun(stub_server, fresh_governors):
+    stub_server.delay = 2
+    session = requests_retry_session(retries=0)
+    requests_made = []
+    overruns = deadline.job_overruns.labels(job="slow")
+
+    @deadline.with_budget(0.2, name="slow")
+    def slow_job():
+        requests_made.append(time.monotonic())
+        session.get(stub_server.url)
+        # Never reached: the deadline has passed, so this is not even sent.
+        requests_made.append(time.monotonic())
+        session.get(stub_server.url)
+
+    before = overruns.value
+    started = time.monotonic()
+    slow_job()
+
+    assert time.monotonic() - started < 1.5
+    assert len(requests_made) == 1
+    assert overruns.value == before + 1
+
+
+def test_deadline_stops_retries_and_reports_overrun(stub_server, fresh_governors):
+    stub_server.delay = 3
+    session = requests_retry_session()
+    reported = []
+
+    @deadline.with_budget(0.5, name="slow", overrun_function=reported.append)
+    def slow_job():
+        session.get(stub_server.url)
+
+    started = time.monotonic()
+    slow_job()
+
+    assert time.monotonic() - started < 1.5
+    assert reported == ["slow"]
+
+
+def test_governor_waits_end_at_the_deadline():
+    limit = governor.AdaptiveLimit(initial=1, minimum=1, maximum=1)
+    bucket = governor.TokenBucket(rate=0.1, burst=1)
+    host = governor.HostGovernor("saturated.example", bucket, limit)
+    limit.acquire()
+
+    started = time.monotonic()
+    with deadline.Deadline(0.2), pytest.raises(deadline.DeadlineExceeded):
+        with host.request():
+            pass
+    assert time.monotonic() - started < 1
+    limit.release(0.0, overloaded=False)
+
+    # The bucket's only token is taken; the next one is 10s away.
+    bucket.acquire()
+    with deadline.Deadline(0.2), pytest.raises(deadline.DeadlineExceeded):
+        with host.request():
+            pass
+    assert limit.in_flight == 0
+    assert time.monotonic() - started < 1
+
+
+@pytest.mark.parametrize(
+    "policy,expected_runs", [("skip", 1), ("coalesce", 2), ("queue", 3)]
+)
+def test_overlapping_job_runs_follow_policy(policy, expected_runs):
+    release = threading.Event()
+    started = threading.Event()
+    runs = []
+
+    def job():
+        runs.append(policy)
+        started.set()
+        release.wait(timeout=5)
+
+    guarded = jobs.OverlapGuard(job, policy, name="test")
+    first = threading.Thread(target=guarded)
+    first.start()
+    started.wait(timeout=5)
+    # Two runs come due while the first is still going.  They return at once.
+    guarded()
+    guarded()
+    release.set()
+    first.join(timeout=5)
+
+    assert len(runs) == expected_runs
+
+
+@pytest.fixture
+def coordinated(monkeypatch, tmp_path):
+    """Return a function that makes Coordinators for instances sharing a store.
+
+    The store's clock is `coordinated.now`, which tests can move forward.
+    """
+
+    def clock():
+        return make_coordinator.now
+
+    store = coordination.SQLiteStore(tmp_path / "coordination.db", clock=clock)
+
+    def make_coordinator(instance_id):
+        return coordination.Coordinator(store, instance_id, lease_seconds=600)
+
+    make_coordinator.now = 1000.0
+    monkeypatch.setattr("monitor.coordination._current", None)
+    return make_coordinator
+
+
+def test_coordinated_instances_hold_leases_and_elect_one_reporter(coordinated):
+    mirror = Mirror("", "", "REPO")
+    first, second = coordinated("first"), coordinated("second")
+
+    assert first.owns(mirror)
+    assert not second.owns(mirror)
+
+    # Only the reporter reports, and it reports the worst measurement taken
+    # within the last check interval.
+    assert first.reconcile(mirror, ReplicationStatus.fresh()) == (
+        ReplicationStatus.fresh()
+    )
+    assert second.reconcile(mirror, ReplicationStatus.behind_by(120)) is None
+    assert first.reconcile(mirror, ReplicationStatus.fresh()) == (
+        ReplicationStatus.behind_by(120)
+    )
+
+    # An older stale measurement does not outlive the check interval.
+    coordinated.now += coordination.MEASUREMENT_SECONDS + 1
+    assert first.reconcile(mirror, ReplicationStatus.fresh()) == (
+        ReplicationStatus.fresh()
+    )
+
+    # An instance that stops renewing its leases loses them.
+    coordinated.now += 601
+    assert second.owns(mirror)
+    assert second.reconcile(mirror, ReplicationStatus.fresh()) == (
+        ReplicationStatus.fresh()
+    )
+    assert not first.owns(mirror)
+
+    second.release_all()
+    assert first.owns(mirror)
+    assert first.is_reporter(mirror)
+
+
+def test_mirrored_commits_are_shared_between_instances(
+    coordinated, fake_hgmo, fresh_governors
+):
+    mirror = Mirror(f"{fake_hgmo.url}/repo", fake_hgmo.url, "REPO")
+    fake_hgmo.mirrored.add("a" * 40)
+
+    coordination.install(coordinated("first"))
+    assert commit_in_mirror(mirror, "a" * 40)
+    assert not commit_in_mirror(mirror, "b" * 40)
+    assert fake_hgmo.statuses == [200, 404]
+
+    # The other instance only asks about the commit nobody has found yet.
+    coordination.install(coordinated("second"))
+    assert commit_in_mirror(mirror, "a" * 40)
+    assert not commit_in_mirror(mirror, "b" * 40)
+    assert fake_hgmo.statuses == [200, 404, 404]
+
+
+class FakeRedis:
+    """Just enough of a decoding redis.Redis client for coordination.RedisStore."""
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = str(value)
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def scan_iter(self, match):
+        return [key for key in self.values if key.startswith(match.rstrip("*"))]
+
+    def register_script(self, script):
+        def run(keys, args):
+            if self.values.get(keys[0]) != args[0]:
+                return 0
+            if "del" in script:
+                del self.values[keys[0]]
+            return 1
+
+        return run
+
+
+def test_poll_position_is_shared_between_instances(coordinated, tmp_path):
+    mirror = Mirror("", "", "REPO")
+    first = poll.PollState(tmp_path / "first.json", coordinated("first"))
+    second = poll.PollState(tmp_path / "second.json", coordinated("second"))
+
+    first.set(mirror, 7, {"etag": "x"})
+
+    assert second.get(mirror) == {"last_pushid": 7, "validators": {"etag": "x"}}
+    assert not (tmp_path / "first.json").exists()
+
+
+def test_worker_coordination_ids_are_unique(monkeypatch, tmp_path):
+    monkeypatch.setenv("COORDINATION_URL", f"sqlite:///{tmp_path}/coordination.db")
+    monkeypatch.setenv("COORDINATION_INSTANCE_ID", "monitor.1")
+
+    assert coordination.from_environ().instance_id == "monitor.1"
+    assert coordination.from_environ("worker-0").instance_id == "monitor.1:worker-0"
+
+
+def test_redis_store_holds_leases_and_values():
+    store = coordination.RedisStore("redis://localhost/0", client=FakeRedis())
+
+    assert store.acquire_lease("owner:REPO", "first", 60)
+    assert store.acquire_lease("owner:REPO", "first", 60)
+    assert not store.acquire_lease("owner:REPO", "second", 60)
+    store.release_lease("owner:REPO", "second")
+    assert not store.acquire_lease("owner:REPO", "second", 60)
+    store.release_lease("owner:REPO", "first")
+    assert store.acquire_lease("owner:REPO", "second", 60)
+
+    store.put("status:REPO", "first", "a", 60)
+    store.put("status:REPO", "second", "b", 60)
+    store.put("status:OTHER", "first", "c", 60)
+    assert store.get("status:REPO", "first") == "a"
+    assert store.get("status:REPO", "third") is None
+    assert store.items("status:REPO") == {"first": "a", "second": "b"}